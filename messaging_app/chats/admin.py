@@ -1,6 +1,12 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Conversation, Message
+from django.db import connections
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.fields import BooleanField
+from .models import User, Conversation, ConversationParticipant, Message
+from .pagination import EstimatedCountPaginator
+from . import search
 
 @admin.register(User)
 class UserAdmin(BaseUserAdmin):
@@ -8,6 +14,9 @@ class UserAdmin(BaseUserAdmin):
     list_filter = ('role', 'created_at')
     search_fields = ('email', 'first_name', 'last_name')
     ordering = ('email',)
+    paginator = EstimatedCountPaginator
+    # The unfiltered total would be a second full count
+    show_full_result_count = False
     
     fieldsets = (
         (None, {'fields': ('email', 'password')}),
@@ -23,24 +32,74 @@ class UserAdmin(BaseUserAdmin):
         }),
     )
 
+class ConversationParticipantInline(admin.TabularInline):
+    model = ConversationParticipant
+    raw_id_fields = ('user',)
+    extra = 1
+
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ('conversation_id', 'created_at', 'participant_count')
+    list_display = (
+        'conversation_id', 'created_at', 'last_activity_at', 'message_count',
+        'participant_count'
+    )
     list_filter = ('created_at',)
     search_fields = ('participants__email', 'participants__first_name', 'participants__last_name')
-    filter_horizontal = ('participants',)
+    ordering = ('-last_activity_at',)
+    inlines = [ConversationParticipantInline]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     
+    def get_queryset(self, request):
+        """
+        Count participants in the changelist query instead of once per row
+        """
+        participant_count = ConversationParticipant.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by().values('conversation').annotate(
+            count=Count('pk')
+        ).values('count')
+        return super().get_queryset(request).annotate(
+            participant_count=Subquery(participant_count)
+        )
+    
+    @admin.display(description='Participants', ordering='participant_count')
     def participant_count(self, obj):
-        return obj.participants.count()
-    participant_count.short_description = 'Participants'
+        return obj.participant_count or 0
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('message_id', 'sender', 'conversation', 'sent_at', 'message_preview')
     list_filter = ('sent_at',)
+    list_select_related = ('sender', 'conversation')
     search_fields = ('sender__email', 'message_body')
     readonly_fields = ('message_id', 'sent_at')
+    # Select widgets would list every user and conversation
+    raw_id_fields = ('sender', 'conversation')
+    # Newest first, straight off the (sent_at, message_id) index
+    ordering = ('-sent_at', '-message_id')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Match message bodies through the full-text index rather than by
+        scanning every body, and senders by exact email
+        """
+        connection = connections[queryset.db]
+        match = search.build_match_query(search_term)
+        if not search.is_supported(connection) or match is None:
+            return super().get_search_results(request, queryset, search_term)
+        in_index = RawSQL(
+            f'{connection.ops.quote_name(Message._meta.db_table)}.message_id IN ('
+            f'{search.MATCHING_IDS_SQL})',
+            [match], output_field=BooleanField(),
+        )
+        # Both sides test columns of messages, so SQLite can answer each
+        # from an index
+        senders = User.objects.filter(email__iexact=search_term.strip()).values('pk')
+        return queryset.filter(Q(in_index) | Q(sender__in=senders)), False
     
     def message_preview(self, obj):
         return obj.message_body[:50] + "..." if len(obj.message_body) > 50 else obj.message_body
-    message_preview.short_description = 'Message Preview'
\ No newline at end of file
+    message_preview.short_description = 'Message Preview'
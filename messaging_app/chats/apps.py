@@ -1,6 +1,28 @@
+from celery.signals import task_postrun, task_prerun
 from django.apps import AppConfig
+from django.core.checks import register
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class ChatsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chats'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .checks import check_message_sequences, check_shared_caches
+        from .querybudget import enter_eager_task, exit_eager_task
+        from .search import ensure_index
+        from .sequence import ensure_trigger
+        from .sqlite import configure_connection, optimize_open_connections
+
+        check_shared_caches()
+        register(check_message_sequences)
+        post_migrate.connect(ensure_index, sender=self)
+        post_migrate.connect(ensure_trigger, sender=self)
+        connection_created.connect(configure_connection)
+        request_finished.connect(optimize_open_connections)
+        task_prerun.connect(enter_eager_task)
+        task_postrun.connect(exit_eager_task)
@@ -0,0 +1,288 @@
+"""
+Cold storage of old messages in compressed, append-only segment files
+
+Each conversation has one segment file in CHATS_ARCHIVE['DIRECTORY'].
+The file is a sequence of blocks. A block is a zlib-compressed JSON
+array holding up to BLOCK_SIZE messages in (sent_at, message_id) order,
+and `ArchivedBlock` rows index the blocks by key range and byte offset.
+Archival moves the oldest messages of a conversation into a new block
+and deletes them from `messages` in the same transaction as the index
+row. Bytes appended by a run that then rolled back are never indexed,
+so they are simply skipped.
+
+Reads merge archived rows with the hot table wherever a history
+endpoint crosses the boundary. Blocks never overlap: archival only
+takes messages newer than what is already archived, so a message
+back-dated below the boundary after archival stays hot.
+
+Archived messages are no longer in the full-text index. Run a single
+archiver at a time; concurrent runs would interleave their appends.
+"""
+import heapq
+import json
+import os
+import uuid
+import zlib
+from datetime import timedelta
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ArchivedBlock, Conversation, Message, PendingNotification
+
+DEFAULTS = {
+    'DIRECTORY': None,
+    'AGE_DAYS': 365,
+    'BLOCK_SIZE': 1000,
+}
+
+
+def get_setting(name):
+    return {**DEFAULTS, **getattr(settings, 'CHATS_ARCHIVE', {})}[name]
+
+
+def is_enabled():
+    return get_setting('DIRECTORY') is not None
+
+
+def segment_path(conversation_id):
+    return Path(get_setting('DIRECTORY')) / f'{conversation_id}.seg'
+
+
+def key(message):
+    return (message.sent_at, message.message_id)
+
+
+def encode_block(messages):
+    return zlib.compress(json.dumps([
+        [m.message_id.hex, m.sender_id.hex, m.message_body, m.sent_at.isoformat()]
+        for m in messages
+    ], ensure_ascii=False).encode())
+
+
+def decode_block(data):
+    return tuple(
+        (uuid.UUID(message_id), uuid.UUID(sender_id), message_body,
+         parse_datetime(sent_at))
+        for message_id, sender_id, message_body, sent_at
+        in json.loads(zlib.decompress(data))
+    )
+
+
+@lru_cache(maxsize=32)
+def load_block(path, offset, length):
+    """
+    Read and decode one block; blocks never change once indexed
+
+    Paging through history rereads the same block for every page it
+    spans, so recently read blocks are kept decoded.
+    """
+    with open(path, 'rb') as segment:
+        segment.seek(offset)
+        return decode_block(segment.read(length))
+
+
+def append_block(conversation_id, data):
+    """
+    Append `data` to the conversation's segment and return its offset
+    """
+    path = segment_path(conversation_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'ab') as segment:
+        offset = segment.seek(0, os.SEEK_END)
+        segment.write(data)
+        segment.flush()
+        os.fsync(segment.fileno())
+    return offset
+
+
+def archive_conversation(conversation, cutoff, block_size=None):
+    """
+    Move messages of `conversation` sent before `cutoff` into its segment
+
+    The newest message is always kept hot as the conversation's summary
+    points at it. Returns the number of messages archived.
+    """
+    block_size = block_size or get_setting('BLOCK_SIZE')
+    queryset = Message.objects.filter(
+        conversation=conversation, sent_at__lt=cutoff
+    ).exclude(pk=conversation.last_message_id).order_by('sent_at', 'message_id')
+    last_block = conversation.archived_blocks.order_by(
+        '-last_sent_at', '-last_message_id'
+    ).first()
+    if last_block is not None:
+        queryset = queryset.filter(Q(sent_at__gt=last_block.last_sent_at) | Q(
+            sent_at=last_block.last_sent_at, message_id__gt=last_block.last_message_id
+        ))
+
+    archived = 0
+    while True:
+        messages = list(queryset.only(
+            'message_id', 'sender_id', 'message_body', 'sent_at'
+        )[:block_size])
+        if not messages:
+            return archived
+        with transaction.atomic():
+            data = encode_block(messages)
+            offset = append_block(conversation.pk, data)
+            ArchivedBlock.objects.create(
+                conversation=conversation,
+                first_sent_at=messages[0].sent_at,
+                first_message_id=messages[0].message_id,
+                last_sent_at=messages[-1].sent_at,
+                last_message_id=messages[-1].message_id,
+                offset=offset,
+                length=len(data),
+                message_count=len(messages),
+            )
+            # Notifications still pending are stale once their message is
+            # archived; they cascade from messages, and the raw delete below
+            # would leave them dangling
+            pks = [m.pk for m in messages]
+            PendingNotification.objects.filter(message__in=pks).delete()
+            # Skip the collector: the summary already counts these messages
+            # and must not be rewound as if they had been deleted
+            deleted = Message.objects.filter(pk__in=pks)._raw_delete(Message.objects.db)
+        archived += deleted
+        last = messages[-1]
+        queryset = queryset.filter(Q(sent_at__gt=last.sent_at) | Q(
+            sent_at=last.sent_at, message_id__gt=last.message_id
+        ))
+
+
+def archive_messages(age=None, block_size=None, progress=None):
+    """
+    Archive messages older than `age` in every conversation
+
+    `age` defaults to CHATS_ARCHIVE['AGE_DAYS'] days.
+    """
+    if age is None:
+        age = timedelta(days=get_setting('AGE_DAYS'))
+    cutoff = timezone.now() - age
+    conversation_ids = Message.objects.filter(
+        sent_at__lt=cutoff
+    ).order_by().values_list('conversation_id', flat=True).distinct()
+
+    archived = 0
+    conversations = Conversation.objects.filter(pk__in=list(conversation_ids))
+    for conversation in conversations.iterator():
+        archived += archive_conversation(conversation, cutoff, block_size)
+        if progress:
+            progress(archived)
+    return archived
+
+
+def read_block(block, cached=True):
+    """
+    Return the (message_id, sender_id, message_body, sent_at) records of
+    `block`, oldest first
+    """
+    load = load_block if cached else load_block.__wrapped__
+    return load(segment_path(block.conversation_id), block.offset, block.length)
+
+
+def record_key(record):
+    return (record[3], record[0])
+
+
+def to_messages(conversation_id, records):
+    """
+    Build unsaved messages with their senders from archived records
+
+    Messages of senders deleted since archival are dropped, as the
+    cascade would have dropped them from the hot table.
+    """
+    messages = [
+        Message(
+            message_id=message_id, sender_id=sender_id,
+            conversation_id=conversation_id, message_body=message_body,
+            sent_at=sent_at,
+        )
+        for message_id, sender_id, message_body, sent_at in records
+    ]
+    prefetch_related_objects(messages, 'sender')
+    return [m for m in messages if m.sender is not None]
+
+
+def read_messages(conversation_id, cursor=None, limit=20):
+    """
+    Return up to `limit` archived messages strictly past `cursor`
+
+    Messages come in page order: ascending for forward cursors and
+    descending for reverse ones, like the keyset paginator's query. A
+    reverse cursor without a position reads back from the newest message.
+    Only the returned records are turned into model instances.
+    """
+    blocks = ArchivedBlock.objects.filter(conversation_id=conversation_id)
+    reverse = cursor is not None and cursor.reverse
+    boundary = None
+    if cursor is not None and cursor.sent_at is not None:
+        boundary = (cursor.sent_at, cursor.message_id)
+    if reverse:
+        if boundary is not None:
+            blocks = blocks.filter(first_sent_at__lte=cursor.sent_at)
+        blocks = blocks.order_by('-last_sent_at', '-last_message_id')
+    else:
+        if boundary is not None:
+            blocks = blocks.filter(last_sent_at__gte=cursor.sent_at)
+        blocks = blocks.order_by('first_sent_at', 'first_message_id')
+
+    messages = []
+    for block in blocks.iterator():
+        records = read_block(block)
+        if reverse:
+            records = records[::-1]
+        if boundary is not None:
+            records = [
+                r for r in records
+                if (record_key(r) < boundary if reverse else record_key(r) > boundary)
+            ]
+        messages.extend(to_messages(conversation_id, records[:limit - len(messages)]))
+        if len(messages) >= limit:
+            break
+    return messages
+
+
+def iter_messages(conversation_id, checkpoint=None):
+    """
+    Yield every archived message after `checkpoint`, oldest first, block by block
+
+    `checkpoint` is a (sent_at, message_id) pair.
+    """
+    blocks = ArchivedBlock.objects.filter(conversation_id=conversation_id)
+    if checkpoint is not None:
+        blocks = blocks.filter(last_sent_at__gte=checkpoint[0])
+    for block in blocks.order_by('first_sent_at', 'first_message_id').iterator():
+        # Whole-history reads would only flush the block cache
+        records = read_block(block, cached=False)
+        if checkpoint is not None:
+            records = [r for r in records if record_key(r) > checkpoint]
+        yield from to_messages(conversation_id, records)
+
+
+def last_key(conversation_id):
+    """
+    Return the (sent_at, message_id) of the newest archived message, if any
+    """
+    return ArchivedBlock.objects.filter(conversation_id=conversation_id).order_by(
+        '-last_sent_at', '-last_message_id'
+    ).values_list('last_sent_at', 'last_message_id').first()
+
+
+def merge(archived, hot):
+    """
+    Merge two streams of messages or rows ordered by (sent_at, message_id)
+    """
+    return heapq.merge(archived, hot, key=key)
+
+
+def delete_segment(conversation_id):
+    try:
+        segment_path(conversation_id).unlink()
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,210 @@
+"""
+Helpers shared by the chats benchmark management commands
+"""
+import itertools
+import random
+import statistics
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from .models import User, Conversation, ConversationParticipant, Message
+
+
+@contextmanager
+def scratch_database(path=None):
+    """
+    Run a benchmark against a throwaway test database
+
+    Benchmarks insert millions of rows, so they never touch the configured
+    database; the test database is created on entry and destroyed on exit.
+    Pass `path` to keep it in a file, as benchmarks with several processes
+    need.
+    """
+    if path is not None:
+        connection.settings_dict['TEST']['NAME'] = str(path)
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def create_users(count, prefix='bench'):
+    """
+    Bulk create `count` users and return them
+    """
+    users = [
+        User(
+            email=f'{prefix}{i}@example.com',
+            first_name=f'First{i}',
+            last_name=f'Last{i}',
+            password='!',
+        )
+        for i in range(count)
+    ]
+    return User.objects.bulk_create(users, batch_size=1000)
+
+
+def create_conversation(participants):
+    """
+    Create a conversation between the given users
+    """
+    conversation = Conversation.objects.create()
+    conversation.participants.set(participants)
+    return conversation
+
+
+def fill_conversation(conversation, senders, count, batch_size=5000, start=None,
+                      body=None):
+    """
+    Bulk insert `count` messages into a conversation, one second apart
+
+    `body` is an optional callable returning the text of message `i`.
+    """
+    start = start or timezone.now() - timedelta(seconds=count)
+    batch = []
+    for i in range(count):
+        batch.append(Message(
+            message_id=uuid.uuid4(),
+            sender=senders[i % len(senders)],
+            conversation=conversation,
+            message_body=body(i) if body else f'Message number {i}',
+            sent_at=start + timedelta(seconds=i),
+        ))
+        if len(batch) >= batch_size:
+            Message.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Message.objects.bulk_create(batch)
+    # bulk_create bypasses Message.save(), so rebuild the summary once
+    Conversation.objects.filter(pk=conversation.pk).refresh_summaries()
+    ConversationParticipant.objects.filter(
+        conversation=conversation
+    ).refresh_unread_counts()
+
+
+def generate_dataset(users, conversations, messages, max_group_size=5, seed=0,
+                     batch_size=10000):
+    """
+    Bulk create a synthetic workload and return its users and conversations
+
+    Conversations have 2 to `max_group_size` random participants. Message
+    counts per conversation follow a Zipf-like curve, so a few
+    conversations hold long histories and most hold short ones. Messages
+    are spread one second apart, in random senders' names, and inserted
+    `batch_size` at a time so that millions of rows never sit in memory.
+    Each conversation's `participant_ids` holds the ids of its members.
+    """
+    rng = random.Random(seed)
+    people = create_users(users)
+    chats = Conversation.objects.bulk_create(
+        [Conversation() for _ in range(conversations)], batch_size=batch_size
+    )
+    members = []
+    for conversation in chats:
+        group = rng.sample(people, min(rng.randint(2, max_group_size), len(people)))
+        conversation.participant_ids = [user.pk for user in group]
+        members.extend(
+            ConversationParticipant(conversation=conversation, user=user)
+            for user in group
+        )
+    ConversationParticipant.objects.bulk_create(members, batch_size=batch_size)
+
+    order = list(range(len(chats)))
+    rng.shuffle(order)
+    cum_weights = list(itertools.accumulate(
+        1 / (rank + 1) for rank in range(len(chats))
+    ))
+    start = timezone.now() - timedelta(seconds=messages)
+    for offset in range(0, messages, batch_size):
+        count = min(batch_size, messages - offset)
+        targets = rng.choices(order, cum_weights=cum_weights, k=count)
+        Message.objects.bulk_create([
+            Message(
+                message_id=uuid.uuid4(),
+                sender_id=rng.choice(chats[target].participant_ids),
+                conversation_id=chats[target].pk,
+                message_body=f'Message number {offset + i}',
+                sent_at=start + timedelta(seconds=offset + i),
+            )
+            for i, target in enumerate(targets)
+        ])
+    # bulk_create bypasses Message.save(), so rebuild the summaries once
+    Conversation.objects.all().refresh_summaries()
+    ConversationParticipant.objects.all().refresh_unread_counts()
+    return people, chats
+
+
+def word_generator(vocabulary_size=20000, seed=0):
+    """
+    Return a callable producing random sentences over a synthetic vocabulary
+
+    Word frequencies follow a Zipf-like curve so that common words match
+    many messages and rare words match few, as in real chat text.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f'w{n}' for n in range(vocabulary_size)]
+    cum_weights = list(itertools.accumulate(
+        1 / (rank + 1) for rank in range(vocabulary_size)
+    ))
+
+    def sentence(i, length=12):
+        return ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=length))
+    return sentence
+
+
+def report(worker):
+    """
+    Report worker failures, so that a crashed worker cannot hang a benchmark
+
+    The last argument of a decorated worker is the results queue; a
+    failure is put on it as `('error', repr(exc), 1)`.
+    """
+    def run(*args):
+        results = args[-1]
+        try:
+            worker(*args)
+        except BaseException as exc:
+            results.put(('error', repr(exc), 1))
+            raise
+    return run
+
+
+def measure(func, repeat=5):
+    """
+    Call `func` `repeat` times and return the timings in milliseconds
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def percentiles(timings, points=(50, 95, 99)):
+    """
+    Return the given percentiles of a list of timings, keyed 'p50' and so on
+    """
+    if len(timings) < 2:
+        return {f'p{point}': round(timings[0], 3) for point in points}
+    cuts = statistics.quantiles(timings, n=100, method='inclusive')
+    return {f'p{point}': round(cuts[point - 1], 3) for point in points}
+
+
+def summarize(timings):
+    """
+    Return median and max of a list of timings
+    """
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'max_ms': round(max(timings), 3),
+    }
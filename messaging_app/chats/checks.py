@@ -0,0 +1,60 @@
+"""
+Startup checks of the deployment chats depends on
+
+Some chats caches hold state that all processes must agree on: the
+conversation membership behind authorization checks, the list versions
+behind conditional GETs and token revocation epochs. The local-memory
+backend keeps a separate copy per process, which is only correct while
+a single process serves requests. Outside DEBUG such settings are
+refused when the app loads, so a multi-worker deployment cannot start
+with them.
+
+`check_message_sequences` is a system check: sync needs the sequence
+numbers only the SQLite trigger of `chats.sequence` hands out.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+
+
+def is_process_local(cache):
+    return isinstance(cache, LocMemCache)
+
+
+def require_shared_cache(alias, setting):
+    """
+    Raise ImproperlyConfigured if the cache `alias`, named by `setting`,
+    is local to the process outside DEBUG
+    """
+    if settings.DEBUG or not is_process_local(caches[alias]):
+        return
+    raise ImproperlyConfigured(
+        f'{setting} names the cache {alias!r}, which is local to each '
+        'process; point it at a cache shared by all processes, such as '
+        'Redis or Memcached'
+    )
+
+
+def check_shared_caches():
+    from . import membership, tokens, versions
+
+    require_shared_cache(versions.get_cache_alias(), 'CHATS_VERSION_CACHE')
+    require_shared_cache(tokens.get_config()['CACHE'], "CHATS_TOKENS['CACHE']")
+    require_shared_cache(membership.get_cache_alias(), 'CHATS_MEMBERSHIP_CACHE')
+
+
+def check_message_sequences(app_configs=None, **kwargs):
+    from .routers import PRIMARY
+    from .sequence import is_supported
+
+    if is_supported(connections[PRIMARY]):
+        return []
+    return [Error(
+        'Message sync needs sequence numbers, which chats only assigns '
+        'on SQLite; messages written to this database would never sync.',
+        hint='Use SQLite for the default database.',
+        id='chats.E001',
+    )]
@@ -0,0 +1,245 @@
+"""
+User directory search over an index of name and email tokens
+
+Substring matching with icontains scans every user on every keystroke of
+an autocomplete. Instead, each user's first name, last name and email
+are split into lowercase words without accents, which are stored as
+`UserSearchToken` rows. The (token, user) index of that table answers
+prefix matches as range scans. Saving a user re-indexes them, and
+`rebuild()` indexes users inserted in bulk.
+
+`search_users()` treats every word of the query as a prefix a user
+must match. It drives the search from the most selective word and
+checks the others for each candidate through the (user, token) index.
+A word matching nothing is retried as the indexed prefixes one typo
+away: a deleted, swapped or replaced character. Results rank users whose
+words equal the query words above prefix matches, and both above
+corrections.
+"""
+import re
+import unicodedata
+from functools import reduce
+from operator import or_
+
+from django.db import connections, router, transaction
+from django.db.models import Exists, OuterRef, Q
+
+from .models import User, UserSearchToken
+from .routers import use_primary
+
+MAX_TOKEN_LENGTH = 64
+
+# Words of a query taken into account, each costing one capped count
+# plus, when it matches nothing, one probe of its typo corrections
+MAX_QUERY_WORDS = 4
+
+# Users considered for ranking; the best prefix matches come first
+CANDIDATES = 100
+
+# Matches counted per query word to find the most selective one, and
+# the most considered for the word driving the search
+SELECTIVITY_SAMPLE = 2000
+
+# Shorter words are too ambiguous to correct
+FUZZY_MIN_LENGTH = 3
+FUZZY_ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+# Match scores of a query word
+EXACT, PREFIX, FUZZY = 3, 2, 1
+
+_WORD = re.compile(r'[^\W_]+')
+# Sorts after every character of a token, closing prefix ranges
+_MAX_CHAR = '\U0010ffff'
+
+
+def normalize(text):
+    """
+    Lowercase `text` and strip its accents
+    """
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(
+        char for char in decomposed if not unicodedata.combining(char)
+    ).casefold()
+
+
+def split_words(text):
+    return [word[:MAX_TOKEN_LENGTH] for word in _WORD.findall(normalize(text))]
+
+
+def user_tokens(user):
+    """
+    Return the set of tokens indexing `user`
+    """
+    return set(
+        split_words(user.first_name) + split_words(user.last_name) +
+        split_words(user.email)
+    )
+
+
+def index_users(users):
+    """
+    Replace the tokens of `users` with those of their current fields
+    """
+    users = list(users)
+    with transaction.atomic():
+        UserSearchToken.objects.filter(user__in=[user.pk for user in users]).delete()
+        UserSearchToken.objects.bulk_create([
+            UserSearchToken(user_id=user.pk, token=token)
+            for user in users
+            for token in sorted(user_tokens(user))
+        ])
+
+
+def rebuild(chunk_size=10000, progress=None):
+    """
+    Re-index every user, chunk by chunk in primary key order
+    """
+    indexed = 0
+    queryset = User.objects.order_by('pk').only('pk', 'first_name', 'last_name', 'email')
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        # A lagging replica could miss new users
+        with use_primary():
+            chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        index_users(chunk)
+        indexed += len(chunk)
+        last_pk = chunk[-1].pk
+        if progress:
+            progress(indexed)
+    return indexed
+
+
+def prefix_range(prefix):
+    return Q(token__gte=prefix, token__lt=prefix + _MAX_CHAR)
+
+
+def typo_variants(word):
+    """
+    Return the words one deleted, swapped or replaced character away
+    """
+    variants = set()
+    for i in range(len(word)):
+        variants.add(word[:i] + word[i + 1:])
+        if i + 1 < len(word):
+            variants.add(word[:i] + word[i + 1] + word[i] + word[i + 2:])
+        for char in FUZZY_ALPHABET:
+            variants.add(word[:i] + char + word[i + 1:])
+    variants.discard(word)
+    return sorted(variant for variant in variants if variant)
+
+
+def known_prefixes(prefixes):
+    """
+    Return the prefixes some token starts with, leaving out those
+    extending another one returned
+
+    All prefixes are probed in one statement, one index seek each.
+    """
+    if not prefixes:
+        return []
+    table = UserSearchToken._meta.db_table
+    values = ', '.join(['(%s)'] * len(prefixes))
+    with connections[router.db_for_read(UserSearchToken)].cursor() as cursor:
+        cursor.execute(
+            f'WITH prefixes(prefix) AS (VALUES {values}) '
+            f'SELECT prefix FROM prefixes WHERE EXISTS ('
+            f'SELECT 1 FROM {table} WHERE token >= prefix AND token < prefix || %s)',
+            [*prefixes, _MAX_CHAR],
+        )
+        known = sorted(row[0] for row in cursor.fetchall())
+    kept = []
+    for prefix in known:
+        if not kept or not prefix.startswith(kept[-1]):
+            kept.append(prefix)
+    return kept
+
+
+def score(word, token, corrections=()):
+    """
+    Return how well `token` matches the query word `word`, 0 if it does not
+    """
+    if token == word:
+        return EXACT
+    if token.startswith(word):
+        return PREFIX
+    if any(token.startswith(correction) for correction in corrections):
+        return FUZZY
+    return 0
+
+
+def search_users(text, limit=10, candidates=CANDIDATES):
+    """
+    Return up to `limit` users matching every word of `text` as a prefix,
+    best match first
+
+    Only the first SELECTIVITY_SAMPLE tokens matching the most selective
+    word are considered, so a query made of very common words costs no
+    more than one made of rare ones.
+    """
+    words = list(dict.fromkeys(split_words(text)))[:MAX_QUERY_WORDS]
+    if not words:
+        return []
+
+    ranges, counts, corrections = {}, {}, {}
+    for word in words:
+        ranges[word] = prefix_range(word)
+        counts[word] = sample_count(ranges[word])
+        if not counts[word]:
+            if len(word) < FUZZY_MIN_LENGTH:
+                return []
+            corrections[word] = known_prefixes(typo_variants(word))
+            if not corrections[word]:
+                return []
+            ranges[word] = reduce(or_, map(prefix_range, corrections[word]))
+            counts[word] = sample_count(ranges[word])
+
+    driver = min(words, key=lambda word: counts[word])
+    matches = UserSearchToken.objects.filter(ranges[driver]).order_by('token')
+    if driver in corrections:
+        # Ordered by token, SQLite would walk the whole index testing each
+        # correction; unordered, it scans just their ranges
+        matches = matches.order_by()
+    elif counts[driver] >= SELECTIVITY_SAMPLE:
+        last = matches.values_list('token', flat=True)[
+            SELECTIVITY_SAMPLE - 1:SELECTIVITY_SAMPLE
+        ].first()
+        matches = matches.filter(token__lte=last)
+    for word in words:
+        if word != driver:
+            matches = matches.filter(Exists(UserSearchToken.objects.filter(
+                ranges[word], user=OuterRef('user')
+            )))
+    candidate_ids = list(dict.fromkeys(
+        matches.values_list('user_id', flat=True)[:candidates]
+    ))
+    if not candidate_ids:
+        return []
+
+    word_scores = {}
+    scores = {pk: [0] * len(words) for pk in candidate_ids}
+    for user_id, token in UserSearchToken.objects.filter(
+            user_id__in=candidate_ids
+    ).values_list('user_id', 'token'):
+        # Tokens like email domains are shared by many users
+        if token not in word_scores:
+            word_scores[token] = [
+                score(word, token, corrections.get(word, ())) for word in words
+            ]
+        scores[user_id] = list(map(max, scores[user_id], word_scores[token]))
+    scores = {pk: sum(points) for pk, points in scores.items()}
+    # sorted() is stable, so equal scores keep the order users were found in
+    ranked = sorted(candidate_ids, key=lambda pk: -scores[pk])[:limit]
+    users = User.objects.in_bulk(ranked)
+    return [users[pk] for pk in ranked if pk in users]
+
+
+def sample_count(condition):
+    """
+    Count the tokens matching `condition`, up to SELECTIVITY_SAMPLE
+    """
+    return UserSearchToken.objects.filter(
+        condition
+    ).values('pk')[:SELECTIVITY_SAMPLE].count()
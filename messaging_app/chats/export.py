@@ -0,0 +1,80 @@
+"""
+Streaming export of a conversation's full message history
+
+Rows are read with a chunked queryset iterator and encoded one chunk
+at a time. Memory stays bounded by the chunk size however long the
+conversation is. Every record carries its sent_at and message_id, and
+the last one received is the checkpoint an interrupted export resumes
+from.
+
+Under ASGI, Django reads a sync iterator of a StreamingHttpResponse to
+the end before sending anything, so the export is wrapped by
+`aiterate()` there and sent as each chunk is encoded.
+"""
+from asgiref.sync import sync_to_async
+from rest_framework.utils.encoders import JSONEncoder
+
+from .pagination import Cursor, MessageCursorPagination
+
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+# Same compact encoding as DRF's JSONRenderer
+encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def export_queryset(queryset, checkpoint=None):
+    """
+    Order `queryset` for export, starting strictly after `checkpoint`
+
+    `checkpoint` is a (sent_at, message_id) pair.
+    """
+    if checkpoint is not None:
+        queryset = queryset.filter(MessageCursorPagination.get_boundary_filter(
+            Cursor(*checkpoint, reverse=False)
+        ))
+    return queryset.order_by('sent_at', 'message_id')
+
+
+def stream_export(rows, row_serializer, output='jsonl', chunk_size=2000):
+    """
+    Yield the encoded export of `rows`, one chunk of records at a time
+
+    `rows` is an iterable of `row_serializer` rows, typically a chunked
+    `values_list()` iterator. JSON Lines puts one message per line. The
+    JSON array form emits the brackets and separators around the same
+    records.
+    """
+    chunk = []
+    first = True
+    if output == 'json':
+        yield b'['
+    for record in row_serializer.iterate(rows):
+        if output == 'json':
+            chunk.append(encoder.encode(record) if first else ',' + encoder.encode(record))
+            first = False
+        else:
+            chunk.append(encoder.encode(record) + '\n')
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk).encode()
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode()
+    if output == 'json':
+        yield b']'
+
+
+async def aiterate(chunks):
+    """
+    Yield the items of the sync iterable `chunks`, each produced on a
+    worker thread
+
+    The thread is the request's own, which keeps a queryset iterator on
+    the database connection it started on.
+    """
+    iterator = iter(chunks)
+    get_next = sync_to_async(next, thread_sensitive=True)
+    while (chunk := await get_next(iterator, None)) is not None:
+        yield chunk
@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chats import archive
+
+
+class Command(BaseCommand):
+    help = 'Move messages older than the archive age into per-conversation segment files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--age-days', type=int,
+            help="Archive messages older than this (default: CHATS_ARCHIVE['AGE_DAYS'])"
+        )
+        parser.add_argument('--block-size', type=int)
+
+    def handle(self, *args, **options):
+        if not archive.is_enabled():
+            raise CommandError("Set CHATS_ARCHIVE['DIRECTORY'] to enable archival")
+        age = None
+        if options['age_days'] is not None:
+            age = timedelta(days=options['age_days'])
+        archived = archive.archive_messages(
+            age=age,
+            block_size=options['block_size'],
+            progress=lambda count: self.stdout.write(f'Archived {count} messages'),
+        )
+        self.stdout.write(self.style.SUCCESS(f'Done: {archived} messages archived'))
@@ -0,0 +1,68 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+
+from chats.bench import scratch_database, generate_dataset, measure, summarize
+from chats.models import Message, User
+from chats.querybudget import QueryRecorder
+
+PAGES = {
+    'messages': '/admin/chats/message/',
+    'messages, page 50': '/admin/chats/message/?p=50',
+    'messages, search': '/admin/chats/message/?q=number+12345',
+    'messages, sender': '/admin/chats/message/?q=bench0%40example.com',
+    'conversations': '/admin/chats/conversation/',
+    'users': '/admin/chats/user/',
+}
+
+
+class Command(BaseCommand):
+    help = 'Measure admin changelist latency over a large message table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--conversations', type=int, default=50000)
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--database', type=Path, default=None,
+                            help='Keep the scratch database in this file '
+                                 'instead of memory, for the largest datasets')
+
+    def handle(self, *args, **options):
+        with scratch_database(options['database']), \
+                override_settings(CELERY_TASK_ALWAYS_EAGER=False):
+            self.stdout.write(
+                f"Generating {options['messages']} messages in "
+                f"{options['conversations']} conversations..."
+            )
+            started = time.perf_counter()
+            generate_dataset(
+                options['users'], options['conversations'], options['messages']
+            )
+            self.stdout.write(f'  done in {time.perf_counter() - started:.1f}s')
+            admin = User.objects.create_superuser(
+                email='bench-admin@example.com', first_name='Bench',
+                last_name='Admin', password='bench'
+            )
+            client = Client()
+            client.force_login(admin)
+
+            exact = measure(lambda: Message.objects.count(), options['repeat'])
+            self.stdout.write(
+                f"  exact COUNT(*) of messages: median "
+                f"{summarize(exact)['median_ms']:.1f} ms"
+            )
+            for name, url in PAGES.items():
+                # Reads may go to the replica alias, so record every alias
+                with QueryRecorder() as captured:
+                    response = client.get(url)
+                assert response.status_code == 200, (url, response.status_code)
+                stats = summarize(measure(lambda: client.get(url), options['repeat']))
+                self.stdout.write(
+                    f"  {name:>18}: median {stats['median_ms']:8.1f} ms, "
+                    f"max {stats['max_ms']:8.1f} ms, {len(captured)} queries, "
+                    f"{response.context['cl'].result_count} results"
+                )
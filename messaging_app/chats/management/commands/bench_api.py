@@ -0,0 +1,177 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from chats.bench import scratch_database, generate_dataset, percentiles
+from chats.models import ConversationParticipant, Message
+
+
+# Each request is made by a random participant of a random conversation
+ENDPOINTS = {
+    'users list': ('GET', lambda c: '/api/users/'),
+    'conversations list': ('GET', lambda c: '/api/conversations/'),
+    'conversation retrieve': ('GET', lambda c: f'/api/conversations/{c.pk}/'),
+    'messages list': ('GET', lambda c: f'/api/conversations/{c.pk}/messages/'),
+    'by_conversation': (
+        'GET', lambda c: f'/api/messages/by_conversation/?conversation_id={c.pk}'
+    ),
+    'message create': ('POST', lambda c: f'/api/conversations/{c.pk}/messages/'),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Measure latency, throughput and query counts of every chats endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--conversations', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--max-group-size', type=int, default=5)
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--database', type=Path, default=None,
+                            help='Keep the scratch database in this file '
+                                 'instead of memory, for the largest datasets')
+        parser.add_argument('--output', type=Path, default=Path('bench_api.json'))
+        parser.add_argument('--baseline', type=Path, default=None,
+                            help='Earlier output to compare the results with')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # Side effects are queued and never run, as on a web server with
+        # separate workers; eager tasks would count toward create
+        with scratch_database(options['database']), \
+                override_settings(CELERY_TASK_ALWAYS_EAGER=False):
+            self.stdout.write(
+                f"Generating {options['users']} users, {options['conversations']} "
+                f"conversations and {options['messages']} messages..."
+            )
+            started = time.perf_counter()
+            users, conversations = generate_dataset(
+                options['users'], options['conversations'], options['messages'],
+                max_group_size=options['max_group_size'], seed=options['seed'],
+            )
+            self.stdout.write(f'  done in {time.perf_counter() - started:.1f}s')
+
+            results = {
+                'commit': git_commit(),
+                'created_at': timezone.now().isoformat(),
+                'options': {
+                    key: options[key] for key in [
+                        'users', 'conversations', 'messages', 'max_group_size',
+                        'requests', 'warmup', 'seed',
+                    ]
+                },
+                'dataset': {
+                    'participants': ConversationParticipant.objects.count(),
+                    'messages': Message.objects.count(),
+                },
+                'endpoints': {},
+            }
+            users = {user.pk: user for user in users}
+            for name, (method, url) in ENDPOINTS.items():
+                results['endpoints'][name] = self.run(
+                    rng, users, conversations, method, url, options
+                )
+
+        options['output'].write_text(json.dumps(results, indent=2) + '\n')
+        self.report(results, options['baseline'])
+        self.stdout.write(f"Results written to {options['output']}")
+
+    def run(self, rng, users, conversations, method, url, options):
+        """
+        Send the endpoint's requests one at a time and summarize them
+        """
+        client = APIClient()
+        latencies = []
+        queries = []
+        errors = 0
+        elapsed = 0
+        for i in range(options['warmup'] + options['requests']):
+            conversation = rng.choice(conversations)
+            # Forced authentication keeps session lookups out of the counts
+            client.force_authenticate(users[rng.choice(conversation.participant_ids)])
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                if method == 'POST':
+                    response = client.post(
+                        url(conversation), {'message_body': 'api benchmark'},
+                        format='json'
+                    )
+                else:
+                    response = client.get(url(conversation))
+                latency = time.perf_counter() - started
+            if i < options['warmup']:
+                continue
+            elapsed += latency
+            latencies.append(latency * 1000)
+            queries.append(len(captured))
+            errors += response.status_code >= 400
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'latency_ms': {
+                **percentiles(latencies),
+                'mean': round(statistics.fmean(latencies), 3),
+                'max': round(max(latencies), 3),
+            },
+            'queries': {
+                'mean': round(statistics.fmean(queries), 2),
+                'max': max(queries),
+            },
+        }
+
+    def report(self, results, baseline_path):
+        baseline = {}
+        if baseline_path is not None:
+            baseline = json.loads(baseline_path.read_text()).get('endpoints', {})
+        self.stdout.write(
+            f"{'endpoint':>22} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+            f"{'req/s':>7} {'queries':>7} {'errors':>6}"
+        )
+        for name, result in results['endpoints'].items():
+            latency = result['latency_ms']
+            self.stdout.write(
+                f"{name:>22} {latency['p50']:8.2f} {latency['p95']:8.2f} "
+                f"{latency['p99']:8.2f} {result['throughput_rps']:7.1f} "
+                f"{result['queries']['mean']:7.1f} {result['errors']:6}"
+            )
+            if name in baseline:
+                before = baseline[name]
+                self.stdout.write(
+                    f"{'vs baseline':>22} "
+                    + ' '.join(
+                        f"{_change(before['latency_ms'][key], latency[key]):>8}"
+                        for key in ['p50', 'p95', 'p99']
+                    )
+                    + f" {_change(before['throughput_rps'], result['throughput_rps']):>7}"
+                    f" {result['queries']['mean'] - before['queries']['mean']:+7.1f}"
+                )
+
+
+def _change(before, after):
+    if not before:
+        return 'n/a'
+    return f'{(after - before) / before:+.0%}'
@@ -0,0 +1,74 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIClient
+
+from chats.bench import (
+    scratch_database, create_users, create_conversation, fill_conversation,
+)
+
+
+class Command(BaseCommand):
+    help = 'Simulate polling clients revalidating list ETags while others write'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--group-size', type=int, default=5)
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--writes-per-round', type=int, default=10)
+        parser.add_argument('--history', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        size = options['group_size']
+        with scratch_database():
+            users = create_users(options['users'])
+            conversations = []
+            for i in range(0, len(users), size):
+                conversation = create_conversation(users[i:i + size])
+                fill_conversation(conversation, users[i:i + size], options['history'])
+                conversations.append(conversation)
+
+            client = APIClient()
+            etags = {}
+            timings = {200: [], 304: []}
+            for _ in range(options['rounds']):
+                for _ in range(options['writes_per_round']):
+                    index = rng.randrange(len(users))
+                    conversation = conversations[index // size]
+                    client.force_authenticate(users[index])
+                    client.post(
+                        f'/api/conversations/{conversation.conversation_id}/messages/',
+                        {'message_body': 'poll benchmark'}, format='json'
+                    )
+                # Every user polls the inbox and their conversation's first page
+                for index, user in enumerate(users):
+                    client.force_authenticate(user)
+                    conversation = conversations[index // size]
+                    for url in [
+                        '/api/conversations/',
+                        f'/api/conversations/{conversation.conversation_id}/messages/',
+                    ]:
+                        headers = {}
+                        if (user.pk, url) in etags:
+                            headers['HTTP_IF_NONE_MATCH'] = etags[user.pk, url]
+                        started = time.perf_counter()
+                        response = client.get(url, **headers)
+                        timings[response.status_code].append(
+                            (time.perf_counter() - started) * 1000
+                        )
+                        etags[user.pk, url] = response['ETag']
+
+            polls = len(timings[200]) + len(timings[304])
+            self.stdout.write(
+                f'{polls} polls, {options["writes_per_round"]} writes per round '
+                f'of {len(users)} users: {len(timings[304]) / polls:.1%} answered 304'
+            )
+            for code, values in timings.items():
+                self.stdout.write(
+                    f'  {code}: {len(values)} responses, '
+                    f'median {statistics.median(values):.2f} ms'
+                )
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from rest_framework.test import APIClient
+
+from chats.bench import (
+    scratch_database, create_users, create_conversation,
+    fill_conversation, measure, summarize,
+)
+from chats.models import Message
+from chats.pagination import Cursor, MessageCursorPagination
+
+
+class Command(BaseCommand):
+    help = 'Compare keyset and offset pagination latency at increasing page depth'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        page_size = options['page_size']
+        with scratch_database():
+            users = create_users(2)
+            conversation = create_conversation(users)
+            self.stdout.write(f"Seeding {options['messages']} messages...")
+            fill_conversation(conversation, users, options['messages'])
+
+            client = APIClient()
+            client.force_authenticate(users[0])
+            url = f'/api/conversations/{conversation.conversation_id}/messages/'
+            messages = Message.objects.filter(
+                conversation=conversation
+            ).order_by('sent_at', 'message_id')
+
+            for page in options['pages']:
+                offset = (page - 1) * page_size
+                if offset >= options['messages']:
+                    continue
+
+                # Position the cursor on the last row of the previous page
+                params = {'page_size': page_size}
+                if offset:
+                    boundary = messages[offset - 1]
+                    params['cursor'] = MessageCursorPagination.encode_token(
+                        Cursor(boundary.sent_at, boundary.message_id, False)
+                    )
+                keyset = measure(lambda: client.get(url, params), options['repeat'])
+
+                def offset_page():
+                    paginator = Paginator(messages.select_related('sender'), page_size)
+                    list(paginator.page(page).object_list)
+                offset_timings = measure(offset_page, options['repeat'])
+
+                self.stdout.write(
+                    f'page {page:>6}: keyset request {summarize(keyset)} '
+                    f'offset query {summarize(offset_timings)}'
+                )
@@ -0,0 +1,167 @@
+import logging
+import multiprocessing
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from chats import replication
+from chats.bench import (
+    scratch_database, create_users, create_conversation, fill_conversation,
+    report,
+)
+
+
+@report
+def reader(users, conversations, seconds, seed, results):
+    """
+    Poll conversation lists, details and message pages
+    """
+    rng = random.Random(seed)
+    # Lock timeouts are counted as errors rather than raised
+    client = APIClient(raise_request_exception=False)
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        index = rng.randrange(len(conversations))
+        conversation_id = conversations[index]
+        client.force_authenticate(users[index * 2])
+        url = rng.choice([
+            '/api/conversations/',
+            f'/api/conversations/{conversation_id}/',
+            f'/api/conversations/{conversation_id}/messages/',
+        ])
+        started = time.perf_counter()
+        response = client.get(url)
+        latencies.append(time.perf_counter() - started)
+        errors += response.status_code >= 500
+    results.put(('read', latencies, errors))
+
+
+@report
+def writer(users, conversations, seconds, seed, results):
+    """
+    Post messages to random conversations
+    """
+    rng = random.Random(seed)
+    # Lock timeouts are counted as errors rather than raised
+    client = APIClient(raise_request_exception=False)
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        index = rng.randrange(len(conversations))
+        client.force_authenticate(users[index * 2 + 1])
+        started = time.perf_counter()
+        response = client.post(
+            f'/api/conversations/{conversations[index]}/messages/',
+            {'message_body': 'replica benchmark'}, format='json'
+        )
+        latencies.append(time.perf_counter() - started)
+        errors += response.status_code >= 500
+    results.put(('write', latencies, errors))
+
+
+@report
+def replicator(seconds, interval, results):
+    """
+    Stand in for replication by copying the primary periodically
+    """
+    deadline = time.monotonic() + seconds
+    copies = []
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        replication.replicate()
+        copies.append(time.perf_counter() - started)
+        time.sleep(interval)
+    results.put(('replicate', copies, 0))
+
+
+class Command(BaseCommand):
+    help = 'Compare mixed read/write throughput with and without the read replica'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=6)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--interval', type=float, default=1.0)
+        parser.add_argument('--conversations', type=int, default=50)
+        parser.add_argument('--history', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        # Failed requests are counted; their tracebacks would drown the report
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        directory = Path(tempfile.mkdtemp())
+        # Processes must share the version stamps and read-your-writes pins
+        caches = {
+            alias: {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': str(directory / f'cache-{alias}'),
+            }
+            for alias in ['default', 'membership', 'versions']
+        }
+        connections['replica'].settings_dict['NAME'] = str(directory / 'replica.sqlite3')
+        with scratch_database(directory / 'primary.sqlite3'), \
+                override_settings(CACHES=caches, ALLOWED_HOSTS=['*']):
+            users = create_users(options['conversations'] * 2)
+            conversations = []
+            for i in range(options['conversations']):
+                conversation = create_conversation(users[i * 2:i * 2 + 2])
+                fill_conversation(conversation, users[i * 2:i * 2 + 2], options['history'])
+                conversations.append(conversation.conversation_id)
+            replication.replicate(target='replica')
+
+            for replica in [None, 'replica']:
+                with override_settings(CHATS_READ_REPLICA=replica):
+                    self.run(users, conversations, replica, options)
+
+    def run(self, users, conversations, replica, options):
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        seconds = options['seconds']
+        processes = [
+            context.Process(target=reader, args=(users, conversations, seconds, i, results))
+            for i in range(options['readers'])
+        ] + [
+            context.Process(target=writer, args=(users, conversations, seconds, i, results))
+            for i in range(options['writers'])
+        ]
+        if replica:
+            processes.append(context.Process(
+                target=replicator, args=(seconds, options['interval'], results)
+            ))
+        for process in processes:
+            process.start()
+        collected = {'read': [], 'write': [], 'replicate': []}
+        errors = dict.fromkeys(collected, 0)
+        for _ in processes:
+            kind, latencies, failed = results.get()
+            if kind == 'error':
+                raise RuntimeError(f'Benchmark worker failed: {latencies}')
+            collected[kind].extend(latencies)
+            errors[kind] += failed
+        for process in processes:
+            process.join()
+
+        self.stdout.write(f'reads from {replica or "default"}:')
+        for kind in ['read', 'write']:
+            latencies = sorted(collected[kind])
+            self.stdout.write(
+                f'  {kind:>5}: {len(latencies) / seconds:7.1f}/s, '
+                f'p50 {statistics.median(latencies) * 1000:6.1f} ms, '
+                f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.1f} ms, '
+                f'{errors[kind]} errors'
+            )
+        if collected['replicate']:
+            self.stdout.write(
+                f'  {len(collected["replicate"])} replications, median '
+                f'{statistics.median(collected["replicate"]) * 1000:.1f} ms'
+            )
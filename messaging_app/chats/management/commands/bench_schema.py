@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chats.bench import (
+    scratch_database, create_users, create_conversation, fill_conversation,
+)
+from chats.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = 'Print query plans of the chats hot queries and measure insert throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--inserts', type=int, default=5000)
+
+    def explain(self, label, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = cursor.fetchall()
+        self.stdout.write(label)
+        for row in plan:
+            self.stdout.write(f'    {row[-1]}')
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            users = create_users(50)
+            conversations = [
+                create_conversation([users[i], users[(i + 1) % len(users)]])
+                for i in range(len(users))
+            ]
+            fill_conversation(conversations[0], users[:2], options['messages'])
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+            user = users[0]
+            conversation = conversations[0]
+            self.explain(
+                'Messages in a conversation ordered by sent_at:',
+                Message.objects.filter(
+                    conversation=conversation
+                ).order_by('sent_at', 'message_id')[:20],
+            )
+            self.explain(
+                'Conversations of a user:',
+                Conversation.objects.filter(participants=user),
+            )
+            self.explain(
+                'Messages of all conversations of a user:',
+                Message.objects.filter(
+                    conversation__in=Conversation.objects.filter(participants=user)
+                ).order_by('sent_at', 'message_id')[:20],
+            )
+
+            started = time.perf_counter()
+            for i in range(options['inserts']):
+                Message.objects.create(
+                    sender=user, conversation=conversations[i % len(conversations)],
+                    message_body=f'insert {i}',
+                )
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"Inserted {options['inserts']} messages via save(): "
+                f"{options['inserts'] / elapsed:.0f} messages/s"
+            )
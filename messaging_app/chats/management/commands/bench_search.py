@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chats.bench import (
+    scratch_database, create_users, create_conversation, fill_conversation,
+    word_generator, measure, summarize,
+)
+from chats.models import Message
+from chats.search import search_messages
+
+
+class Command(BaseCommand):
+    help = 'Compare FTS5 message search with icontains on a large messages table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000000)
+        parser.add_argument('--conversations', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            users = create_users(options['conversations'] + 1)
+            sentence = word_generator()
+            per_conversation = options['messages'] // options['conversations']
+            self.stdout.write(f"Seeding {options['messages']} messages...")
+            # Every conversation includes the searching user, so icontains
+            # cannot be narrowed down by membership either
+            for i in range(options['conversations']):
+                conversation = create_conversation([users[0], users[i + 1]])
+                fill_conversation(
+                    conversation, [users[i + 1]], per_conversation, body=sentence
+                )
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+            user = users[0]
+            # A common word, a mid-frequency word and a rare word
+            for term in ['w1', 'w150', 'w15000']:
+                fts = measure(
+                    lambda: search_messages(user, term, limit=20), options['repeat']
+                )
+                icontains = measure(
+                    lambda: list(Message.objects.filter(
+                        conversation__participants=user,
+                        message_body__icontains=f'{term} ',
+                    ).order_by('-sent_at')[:20]),
+                    options['repeat'],
+                )
+                self.stdout.write(
+                    f'{term:>7}: fts5 {summarize(fts)} icontains {summarize(icontains)}'
+                )
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from chats.bench import (
+    scratch_database, create_users, create_conversation, fill_conversation,
+    measure, summarize,
+)
+from chats.models import Message
+from chats.serializers import MessageSerializer
+from chats.views import MessageViewSet
+
+
+class Command(BaseCommand):
+    help = 'Compare MessageSerializer with the compiled row serializer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        row_serializer = MessageViewSet.row_serializer
+        renderer = JSONRenderer()
+        with scratch_database():
+            users = create_users(10)
+            conversation = create_conversation(users)
+            fill_conversation(conversation, users, max(options['sizes']))
+
+            for size in options['sizes']:
+                queryset = Message.objects.order_by('sent_at', 'message_id')[:size]
+
+                def baseline():
+                    return renderer.render(MessageSerializer(
+                        queryset.select_related('sender'), many=True
+                    ).data)
+
+                def fast():
+                    return renderer.render(row_serializer.serialize(
+                        row_serializer.values_list(queryset)
+                    ))
+
+                if baseline() != fast():
+                    raise AssertionError(f'Output differs at {size} rows')
+                for name, func in [('serializer', baseline), ('rows', fast)]:
+                    timings = measure(func, options['repeat'])
+                    rate = size / (min(timings) / 1000)
+                    self.stdout.write(
+                        f'{size:>7} rows {name:>10}: {summarize(timings)} '
+                        f'{rate:,.0f} rows/s'
+                    )
@@ -0,0 +1,137 @@
+import multiprocessing
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from django.test.utils import override_settings
+
+from chats.bench import (
+    scratch_database, create_users, create_conversation, fill_conversation,
+    report,
+)
+from chats import sqlite
+from chats.models import Conversation, Message
+
+MODES = {
+    'sqlite defaults': None,
+    'production profile': sqlite.PROFILE,
+}
+
+
+def run_for(seconds, operation, rng, conversations):
+    """
+    Call `operation` on random conversations for `seconds`, counting lock errors
+    """
+    latencies = []
+    locked = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        conversation = rng.choice(conversations)
+        started = time.perf_counter()
+        try:
+            operation(conversation)
+        except OperationalError as exc:
+            if 'locked' not in str(exc):
+                raise
+            locked += 1
+        else:
+            latencies.append(time.perf_counter() - started)
+    return latencies, locked
+
+
+@report
+def writer(conversations, seconds, seed, results):
+    """
+    Post messages, each with its summary update, in its own transaction
+    """
+    def post(conversation):
+        Message.objects.create(
+            sender_id=conversation.sender_id, conversation_id=conversation.pk,
+            message_body='sqlite benchmark'
+        )
+    results.put(('write', *run_for(seconds, post, random.Random(seed), conversations)))
+
+
+@report
+def reader(conversations, seconds, seed, results):
+    """
+    Read the newest page of a conversation and its participant's list
+    """
+    def read(conversation):
+        list(Message.objects.filter(
+            conversation_id=conversation.pk
+        ).order_by('-sent_at', '-message_id')[:20])
+        list(Conversation.objects.filter(
+            participants=conversation.sender_id
+        ).with_last_message().order_by('-last_activity_at')[:20])
+    results.put(('read', *run_for(seconds, read, random.Random(seed), conversations)))
+
+
+class Command(BaseCommand):
+    help = 'Compare concurrent writers and readers with and without the SQLite profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--conversations', type=int, default=50)
+        parser.add_argument('--history', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        directory = Path(tempfile.mkdtemp())
+        for index, (mode, profile) in enumerate(MODES.items()):
+            # Each mode gets its own file; WAL mode persists in the file
+            with override_settings(CHATS_SQLITE=profile), \
+                    scratch_database(directory / f'bench-{index}.sqlite3'):
+                users = create_users(options['conversations'] * 2)
+                conversations = []
+                for i in range(options['conversations']):
+                    pair = users[i * 2:i * 2 + 2]
+                    conversation = create_conversation(pair)
+                    fill_conversation(conversation, pair, options['history'])
+                    conversation.sender_id = pair[0].pk
+                    conversations.append(conversation)
+                self.run(mode, conversations, options)
+
+    def run(self, mode, conversations, options):
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        seconds = options['seconds']
+        processes = [
+            context.Process(target=writer, args=(conversations, seconds, i, results))
+            for i in range(options['writers'])
+        ] + [
+            context.Process(target=reader, args=(conversations, seconds, i, results))
+            for i in range(options['readers'])
+        ]
+        for process in processes:
+            process.start()
+        collected = {'write': [], 'read': []}
+        locked = dict.fromkeys(collected, 0)
+        for _ in processes:
+            kind, latencies, failed = results.get()
+            if kind == 'error':
+                raise RuntimeError(f'Benchmark worker failed: {latencies}')
+            collected[kind].extend(latencies)
+            locked[kind] += failed
+        for process in processes:
+            process.join()
+
+        self.stdout.write(f'{mode}:')
+        for kind, label in [('write', 'messages'), ('read', 'reads')]:
+            latencies = sorted(collected[kind])
+            attempts = len(latencies) + locked[kind]
+            if not latencies:
+                self.stdout.write(f'  {label:>8}: none succeeded, {locked[kind]} lock errors')
+                continue
+            self.stdout.write(
+                f'  {label:>8}: {len(latencies) / seconds:7.1f}/s, '
+                f'p50 {statistics.median(latencies) * 1000:6.1f} ms, '
+                f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.1f} ms, '
+                f'{locked[kind]} lock errors ({locked[kind] / attempts:.1%})'
+            )
@@ -0,0 +1,126 @@
+import random
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from chats.bench import scratch_database, create_users, measure, summarize
+from chats.models import Conversation, ConversationParticipant, Message
+
+
+def counted_unread():
+    """
+    Count the unread messages of the outer membership from the messages
+    table, as listing conversations would without the maintained counter
+    """
+    return Coalesce(Subquery(
+        Message.objects.filter(
+            conversation=OuterRef('conversation_id')
+        ).exclude(
+            sender=OuterRef('user_id')
+        ).filter(
+            Q(sent_at__gt=OuterRef('last_read_at')) |
+            Q(sent_at=OuterRef('last_read_at'),
+              message_id__gt=OuterRef('last_read_message_id'))
+        ).order_by().values('conversation').annotate(
+            count=Count('pk')
+        ).values('count')
+    ), 0)
+
+
+class Command(BaseCommand):
+    help = 'Measure inbox latency and unread counts of a user in many conversations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversations', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=200,
+                            help='Messages per conversation')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        count = options['conversations']
+        per_conversation = options['messages']
+        with scratch_database():
+            reader, *others = create_users(count + 1)
+            conversations = Conversation.objects.bulk_create(
+                [Conversation() for _ in range(count)]
+            )
+            ConversationParticipant.objects.bulk_create([
+                ConversationParticipant(conversation=conversation, user=user)
+                for conversation, other in zip(conversations, others)
+                for user in (reader, other)
+            ])
+            start = timezone.now() - timedelta(seconds=count * per_conversation)
+            for index, (conversation, other) in enumerate(zip(conversations, others)):
+                Message.objects.bulk_create([
+                    Message(
+                        message_id=uuid.uuid4(),
+                        sender=other if i % 3 else reader,
+                        conversation=conversation,
+                        message_body=f'Message number {i}',
+                        sent_at=start + timedelta(seconds=index * per_conversation + i),
+                    )
+                    for i in range(per_conversation)
+                ])
+            Conversation.objects.all().refresh_summaries()
+            # The reader has read a random share of each conversation
+            for conversation in conversations:
+                read = Message.objects.filter(conversation=conversation).order_by(
+                    'sent_at', 'message_id'
+                ).values_list('sent_at', 'message_id')[rng.randrange(per_conversation)]
+                ConversationParticipant.objects.filter(
+                    conversation=conversation, user=reader
+                ).mark_read(*read)
+            ConversationParticipant.objects.exclude(user=reader).refresh_unread_counts()
+
+            memberships = ConversationParticipant.objects.filter(user=reader)
+            first_page = list(Conversation.objects.filter(
+                conversationparticipant__user=reader
+            ).order_by('-last_activity_at').values_list('pk', flat=True)[:20])
+            client = APIClient()
+            client.force_authenticate(reader)
+            url = '/api/conversations/'
+            assert client.get(url).status_code == 200
+            results = {
+                'inbox page (API)': measure(lambda: client.get(url), options['repeat']),
+                'page unread, counters': measure(lambda: list(memberships.filter(
+                    conversation_id__in=first_page
+                ).values_list('unread_count', flat=True)), options['repeat']),
+                'page unread, counting': measure(lambda: list(memberships.filter(
+                    conversation_id__in=first_page
+                ).annotate(unread=counted_unread()).values_list(
+                    'unread', flat=True
+                )), options['repeat']),
+                'total unread, counters': measure(lambda: memberships.aggregate(
+                    total=Sum('unread_count')
+                ), options['repeat']),
+                'total unread, counting': measure(lambda: memberships.annotate(
+                    unread=counted_unread()
+                ).aggregate(total=Sum('unread')), options['repeat']),
+            }
+            maintained = memberships.aggregate(total=Sum('unread_count'))['total']
+            counted = memberships.annotate(
+                unread=counted_unread()
+            ).aggregate(total=Sum('unread'))['total']
+
+            conversation = rng.choice(conversations)
+            mark_read = measure(lambda: client.post(
+                f'/api/conversations/{conversation.pk}/mark_read/'
+            ), options['repeat'])
+
+        self.stdout.write(
+            f'{count} conversations of {per_conversation} messages; '
+            f'{maintained} unread maintained, {counted} counted'
+        )
+        for name, timings in {**results, 'mark_read (API)': mark_read}.items():
+            stats = summarize(timings)
+            self.stdout.write(
+                f"  {name:>24}: median {stats['median_ms']:8.2f} ms, "
+                f"max {stats['max_ms']:8.2f} ms"
+            )
@@ -0,0 +1,88 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from chats import directory
+from chats.bench import scratch_database, measure, percentiles
+from chats.models import User, UserSearchToken
+
+SYLLABLES = [
+    'ka', 'li', 'mo', 'ra', 'ne', 'to', 'sa', 'vi', 'de', 'lo', 'ma', 'ri',
+    'an', 'el', 'is', 'on', 'ber', 'tha', 'gar', 'win', 'son', 'ley', 'ton',
+    'mar', 'jo', 'ha', 'ste', 'ven', 'chri', 'na', 'dy', 'ca', 'ro', 'lin',
+]
+
+
+def make_name(rng):
+    return ''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))).capitalize()
+
+
+class Command(BaseCommand):
+    help = 'Measure per-keystroke latency of the user directory search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000)
+        parser.add_argument('--names', type=int, default=20000,
+                            help='Distinct first and last names to draw from')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        first_names = [make_name(rng) for _ in range(options['names'])]
+        last_names = [make_name(rng) for _ in range(options['names'])]
+        with scratch_database():
+            self.stdout.write(f"Creating and indexing {options['users']} users...")
+            started = time.perf_counter()
+            for offset in range(0, options['users'], options['batch_size']):
+                User.objects.bulk_create([
+                    User(
+                        email=f'user{offset + i}@example.com',
+                        first_name=rng.choice(first_names),
+                        last_name=rng.choice(last_names),
+                        password='!',
+                    )
+                    for i in range(min(options['batch_size'], options['users'] - offset))
+                ])
+            directory.rebuild(chunk_size=options['batch_size'])
+            self.stdout.write(
+                f'  done in {time.perf_counter() - started:.1f}s, '
+                f'{UserSearchToken.objects.count()} tokens'
+            )
+
+            # Type "first last" of random users one keystroke at a time
+            typed = []
+            for _ in range(options['queries']):
+                full = f'{rng.choice(first_names)} {rng.choice(last_names)}'.lower()
+                typed.extend(full[:end] for end in range(1, len(full) + 1))
+            keystrokes = []
+            for text in typed:
+                keystrokes.extend(measure(lambda: directory.search_users(text), 1))
+
+            typos = []
+            for _ in range(options['queries']):
+                name = rng.choice(first_names).lower()
+                i = rng.randrange(len(name))
+                typo = name[:i] + rng.choice('aeiouxyz') + name[i + 1:]
+                typos.extend(measure(lambda: directory.search_users(typo), 1))
+
+            scans = []
+            for text in rng.sample(typed, min(20, len(typed))):
+                scans.extend(measure(lambda: list(User.objects.filter(
+                    Q(first_name__icontains=text) | Q(last_name__icontains=text) |
+                    Q(email__icontains=text)
+                )[:10]), 1))
+
+        for name, timings in [
+            ('keystrokes', keystrokes), ('one typo', typos),
+            ('icontains scan', scans),
+        ]:
+            stats = percentiles(timings)
+            self.stdout.write(
+                f"  {name:>14}: {len(timings)} searches, p50 {stats['p50']:.2f} ms, "
+                f"p95 {stats['p95']:.2f} ms, p99 {stats['p99']:.2f} ms, "
+                f"max {max(timings):.2f} ms"
+            )
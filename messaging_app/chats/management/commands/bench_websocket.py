@@ -0,0 +1,102 @@
+import statistics
+import time
+import tracemalloc
+
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIClient
+
+from chats.bench import scratch_database, create_users, create_conversation
+from chats.realtime import websocket_application
+
+
+def create_session(user):
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return session.session_key
+
+
+class Command(BaseCommand):
+    help = 'Hold many idle sockets open and measure write-to-push latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=2000)
+        parser.add_argument('--group-size', type=int, default=10)
+        parser.add_argument('--messages', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            users = create_users(options['sockets'])
+            size = options['group_size']
+            conversations = [
+                create_conversation(users[i:i + size])
+                for i in range(0, len(users), size)
+            ]
+            session_keys = [create_session(user) for user in users]
+            async_to_sync(self.run)(users, conversations, session_keys, options)
+
+    async def run(self, users, conversations, session_keys, options):
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        sockets = []
+        started = time.perf_counter()
+        for session_key in session_keys:
+            socket = ApplicationCommunicator(websocket_application, {
+                'type': 'websocket',
+                'path': '/ws/messages/',
+                'headers': [(b'cookie', f'sessionid={session_key}'.encode())],
+            })
+            await socket.send_input({'type': 'websocket.connect'})
+            await socket.receive_output(5)
+            sockets.append(socket)
+        connect_seconds = time.perf_counter() - started
+        per_socket = (tracemalloc.get_traced_memory()[0] - baseline) / len(sockets)
+        tracemalloc.stop()
+        self.stdout.write(
+            f'{len(sockets)} idle sockets connected in {connect_seconds:.2f}s, '
+            f'{per_socket / 1024:.1f} KiB traced per socket'
+        )
+
+        latencies = []
+        client = APIClient()
+        for i in range(options['messages']):
+            conversation = conversations[i % len(conversations)]
+            sender = users[(i % len(conversations)) * options['group_size']]
+            recipients = [
+                sockets[index] for index, user in enumerate(users)
+                if (index // options['group_size']) == (i % len(conversations))
+            ]
+
+            def post():
+                client.force_authenticate(sender)
+                client.post(
+                    f'/api/conversations/{conversation.conversation_id}/messages/',
+                    {'message_body': f'benchmark {i}'}, format='json'
+                )
+
+            written = time.perf_counter()
+            await sync_to_async(post)()
+            for socket in recipients:
+                await socket.receive_output(5)
+                latencies.append((time.perf_counter() - written) * 1000)
+
+        latencies.sort()
+        self.stdout.write(
+            f'{len(latencies)} deliveries: '
+            f'p50 {statistics.median(latencies):.2f} ms, '
+            f'p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms, '
+            f'max {latencies[-1]:.2f} ms (measured from the start of the POST)'
+        )
+
+        for socket in sockets:
+            await socket.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        for socket in sockets:
+            await socket.wait(5)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats.models import Conversation, ConversationParticipant
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute last message, last activity and message count of '
+        'conversations, and the unread counts of their participants'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        pks = Conversation.objects.order_by('pk').values_list('pk', flat=True)
+
+        rebuilt = 0
+        last_pk = None
+        while True:
+            chunk = pks if last_pk is None else pks.filter(pk__gt=last_pk)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                break
+            # One short transaction per chunk keeps writers unblocked
+            with transaction.atomic():
+                rebuilt += Conversation.objects.filter(
+                    pk__in=chunk
+                ).refresh_summaries()
+                ConversationParticipant.objects.filter(
+                    conversation_id__in=chunk
+                ).refresh_unread_counts()
+            last_pk = chunk[-1]
+            self.stdout.write(f'Rebuilt {rebuilt} conversation summaries')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Done: {rebuilt} conversation summaries rebuilt'
+        ))
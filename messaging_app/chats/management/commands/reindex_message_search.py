@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chats import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of message bodies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        if not search.is_supported(connection):
+            raise CommandError('Full-text search requires the SQLite backend')
+
+        indexed = search.rebuild(
+            connection,
+            chunk_size=options['chunk_size'],
+            progress=lambda count: self.stdout.write(f'Indexed {count} messages'),
+        )
+        self.stdout.write(self.style.SUCCESS(f'Done: {indexed} messages indexed'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chats import directory
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the user directory search index from names and emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        indexed = directory.rebuild(
+            chunk_size=options['chunk_size'],
+            progress=lambda count: self.stdout.write(f'Indexed {count} users'),
+        )
+        self.stdout.write(self.style.SUCCESS(f'Done: {indexed} users indexed'))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chats import replication
+from chats.routers import get_replica
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database into the read replica, once or periodically'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', help='Replica alias (default: CHATS_READ_REPLICA)')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Seconds between copies; 0 copies once and exits'
+        )
+
+    def handle(self, *args, **options):
+        target = options['database'] or get_replica()
+        if target is None:
+            raise CommandError('Pass --database or set CHATS_READ_REPLICA')
+        while True:
+            started = time.perf_counter()
+            replication.replicate(target=target)
+            self.stdout.write(
+                f'Replicated into {target} in {(time.perf_counter() - started) * 1000:.1f} ms'
+            )
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,125 @@
+"""
+Per-user cache of conversation membership used for authorization checks
+
+Each user's conversation ids are cached as a frozenset under the cache
+alias named by CHATS_MEMBERSHIP_CACHE. Membership writes invalidate the
+affected users immediately and again once the transaction commits, so a
+concurrent request cannot re-cache a pre-commit view.
+
+The alias must name a cache shared by all processes: with a per-process
+backend, other processes would keep authorizing removed participants
+until their entries expire. Outside DEBUG `chats.checks` refuses one.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import Conversation
+from .routers import use_primary
+
+KEY_PREFIX = 'chats:membership:'
+
+
+class MembershipStats:
+    """
+    Process-wide hit/miss/invalidation counters of the membership cache
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_invalidations(self, count):
+        with self._lock:
+            self.invalidations += count
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hit_rate, 4),
+        }
+
+
+stats = MembershipStats()
+
+
+def get_cache_alias():
+    return getattr(settings, 'CHATS_MEMBERSHIP_CACHE', 'default')
+
+
+def get_cache():
+    return caches[get_cache_alias()]
+
+
+def cache_key(user_id):
+    return f'{KEY_PREFIX}{user_id}'
+
+
+def get_conversation_ids(user):
+    """
+    Return the frozenset of conversation ids `user` participates in
+    """
+    cache = get_cache()
+    key = cache_key(user.pk)
+    conversation_ids = cache.get(key)
+    stats.record(hit=conversation_ids is not None)
+    if conversation_ids is None:
+        # Never cache a lagging replica's view of a membership change
+        with use_primary():
+            conversation_ids = frozenset(Conversation.objects.filter(
+                participants=user
+            ).values_list('conversation_id', flat=True))
+        cache.set(key, conversation_ids)
+    return conversation_ids
+
+
+def is_participant(user, conversation_id):
+    """
+    Return whether `user` participates in the conversation `conversation_id`
+
+    Malformed ids are treated as conversations the user is not part of.
+    """
+    if not isinstance(conversation_id, uuid.UUID):
+        try:
+            conversation_id = uuid.UUID(str(conversation_id))
+        except ValueError:
+            return False
+    return conversation_id in get_conversation_ids(user)
+
+
+def invalidate(user_ids):
+    """
+    Drop the cached membership of `user_ids` now and after commit
+    """
+    keys = [cache_key(user_id) for user_id in set(user_ids)]
+    if not keys:
+        return
+
+    def delete():
+        get_cache().delete_many(keys)
+        stats.record_invalidations(len(keys))
+
+    delete()
+    transaction.on_commit(delete)
@@ -0,0 +1,89 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_conversation_activity_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Adopt the implicit participants table as an explicit through model.
+        # The table, columns and unique index already exist, so only the
+        # migration state changes here.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ConversationParticipant',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chats.conversation')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'conversations_participants',
+                        'unique_together': {('conversation', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='conversation',
+                    name='participants',
+                    field=models.ManyToManyField(related_name='conversations', through='chats.ConversationParticipant', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        # Membership lookups by user need (user, conversation); the single
+        # column foreign key indexes are prefixes of the composite indexes.
+        migrations.AlterField(
+            model_name='conversationparticipant',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='chats.conversation'),
+        ),
+        migrations.AlterField(
+            model_name='conversationparticipant',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='conversationparticipant',
+            index=models.Index(fields=['user', 'conversation'], name='conversatio_user_id_9899b1_idx'),
+        ),
+        # Drop indexes duplicating primary keys, unique constraints, foreign
+        # key indexes or the leading columns of composite indexes.
+        migrations.RemoveIndex(
+            model_name='user',
+            name='users_email_4b85f2_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='users_user_id_83dd09_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='conversation',
+            name='conversatio_convers_144068_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='messages_message_83462e_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='messages_sender__6ae55a_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='messages_convers_8904b4_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='messages_sent_at_219716_idx',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chats.conversation'),
+        ),
+    ]
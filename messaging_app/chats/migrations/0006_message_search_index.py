@@ -0,0 +1,54 @@
+from django.db import migrations
+
+# Statements frozen from chats.search at the time of this migration, so
+# that later changes to that module do not rewrite it
+
+CREATE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "message_body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, message_body) VALUES (new.rowid, new.message_body);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.rowid;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message_body ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.rowid;
+        INSERT INTO messages_fts(rowid, message_body) VALUES (new.rowid, new.message_body);
+    END""",
+    'DELETE FROM messages_fts',
+    'INSERT INTO messages_fts(rowid, message_body) SELECT rowid, message_body FROM messages',
+    "INSERT INTO messages_fts(messages_fts) VALUES ('optimize')",
+]
+
+DROP_INDEX = [
+    'DROP TRIGGER IF EXISTS messages_fts_insert',
+    'DROP TRIGGER IF EXISTS messages_fts_delete',
+    'DROP TRIGGER IF EXISTS messages_fts_update',
+    'DROP TABLE IF EXISTS messages_fts',
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in CREATE_INDEX:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_INDEX:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_explicit_participants_and_index_cleanup'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
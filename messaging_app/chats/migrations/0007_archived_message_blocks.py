@@ -0,0 +1,32 @@
+# Generated by Django 5.2.4 on 2026-10-18 05:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0006_message_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_sent_at', models.DateTimeField()),
+                ('first_message_id', models.UUIDField()),
+                ('last_sent_at', models.DateTimeField()),
+                ('last_message_id', models.UUIDField()),
+                ('offset', models.PositiveBigIntegerField()),
+                ('length', models.PositiveIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('conversation', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_blocks', to='chats.conversation')),
+            ],
+            options={
+                'db_table': 'archived_message_blocks',
+                'indexes': [models.Index(fields=['conversation', 'first_sent_at'], name='archived_me_convers_4f6375_idx'), models.Index(fields=['conversation', 'last_sent_at'], name='archived_me_convers_d50e9b_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:33
+
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_summaries(apps, schema_editor):
+    """
+    Summarize the conversations that predate 0004, which start_at_latest
+    reads from
+    """
+    Conversation = apps.get_model('chats', 'Conversation')
+    Message = apps.get_model('chats', 'Message')
+    ArchivedBlock = apps.get_model('chats', 'ArchivedBlock')
+    alias = schema_editor.connection.alias
+    latest = Message.objects.using(alias).filter(
+        conversation=OuterRef('pk')
+    ).order_by('-sent_at', '-message_id')
+    message_count = Message.objects.using(alias).filter(
+        conversation=OuterRef('pk')
+    ).order_by().values('conversation').annotate(count=Count('pk')).values('count')
+    archived_count = ArchivedBlock.objects.using(alias).filter(
+        conversation=OuterRef('pk')
+    ).order_by().values('conversation').annotate(
+        count=Sum('message_count')
+    ).values('count')
+    Conversation.objects.using(alias).update(
+        message_count=(
+            Coalesce(Subquery(message_count), 0) +
+            Coalesce(Subquery(archived_count), 0)
+        ),
+        last_message=Subquery(latest.values('pk')[:1]),
+        last_activity_at=Coalesce(
+            Subquery(latest.values('sent_at')[:1]), F('created_at')
+        ),
+    )
+
+
+def start_at_latest(apps, schema_editor):
+    """
+    Start existing members with their conversation's history read
+    """
+    Conversation = apps.get_model('chats', 'Conversation')
+    ConversationParticipant = apps.get_model('chats', 'ConversationParticipant')
+    latest = Conversation.objects.filter(pk=OuterRef('conversation_id'))
+    ConversationParticipant.objects.using(schema_editor.connection.alias).update(
+        last_read_at=Subquery(latest.values('last_message__sent_at')[:1]),
+        last_read_message_id=Subquery(latest.values('last_message_id')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0008_pending_notifications'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='last_read_message_id',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+        migrations.RunPython(start_at_latest, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:48
+
+import re
+import unicodedata
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Tokenization frozen from chats.directory at the time of this migration,
+# so that later changes to that module do not rewrite it
+
+MAX_TOKEN_LENGTH = 64
+CHUNK_SIZE = 10000
+
+_WORD = re.compile(r'[^\W_]+')
+
+
+def split_words(text):
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    normalized = ''.join(
+        char for char in decomposed if not unicodedata.combining(char)
+    ).casefold()
+    return [word[:MAX_TOKEN_LENGTH] for word in _WORD.findall(normalized)]
+
+
+def index_existing_users(apps, schema_editor):
+    User = apps.get_model('chats', 'User')
+    UserSearchToken = apps.get_model('chats', 'UserSearchToken')
+    alias = schema_editor.connection.alias
+    users = User.objects.using(alias).order_by('pk').only(
+        'pk', 'first_name', 'last_name', 'email'
+    )
+    last_pk = None
+    while True:
+        chunk = users if last_pk is None else users.filter(pk__gt=last_pk)
+        chunk = list(chunk[:CHUNK_SIZE])
+        if not chunk:
+            break
+        UserSearchToken.objects.using(alias).bulk_create([
+            UserSearchToken(user_id=user.pk, token=token)
+            for user in chunk
+            for token in sorted(set(
+                split_words(user.first_name) + split_words(user.last_name) +
+                split_words(user.email)
+            ))
+        ])
+        last_pk = chunk[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0010_user_token_epoch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'user_search_tokens',
+                'indexes': [models.Index(fields=['token', 'user'], name='user_search_token_61d0f3_idx')],
+                'unique_together': {('user', 'token')},
+            },
+        ),
+        migrations.RunPython(index_existing_users, migrations.RunPython.noop),
+    ]
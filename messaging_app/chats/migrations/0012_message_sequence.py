@@ -0,0 +1,52 @@
+# Generated by Django 5.2.4 on 2026-10-18 07:31
+
+from django.db import migrations, models
+
+# Same statement as chats.sequence.CREATE_TRIGGER, frozen here so that
+# later changes to that module do not rewrite this migration
+CREATE_TRIGGER = """CREATE TRIGGER IF NOT EXISTS messages_sequence_insert AFTER INSERT ON messages
+    WHEN new.sequence IS NULL BEGIN
+        UPDATE messages SET sequence = (
+            SELECT coalesce(max(sequence), 0) + 1 FROM messages
+        ) WHERE rowid = new.rowid;
+    END"""
+
+
+def number_existing_messages(apps, schema_editor):
+    """
+    Number existing messages in (sent_at, message_id) order and start the trigger
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        'UPDATE messages SET sequence = numbered.n FROM ('
+        'SELECT message_id, row_number() OVER (ORDER BY sent_at, message_id) AS n '
+        'FROM messages) AS numbered '
+        'WHERE numbered.message_id = messages.message_id'
+    )
+    schema_editor.execute(CREATE_TRIGGER)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TRIGGER IF EXISTS messages_sequence_insert')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0011_user_search_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='sequence',
+            field=models.BigIntegerField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'sequence'], name='messages_convers_cac290_idx'),
+        ),
+        migrations.RunPython(number_existing_messages, drop_trigger),
+    ]
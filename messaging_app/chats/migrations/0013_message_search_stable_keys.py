@@ -0,0 +1,86 @@
+from django.db import migrations
+
+# Statements frozen from chats.search at the time of this migration, so
+# that later changes to that module do not rewrite it
+
+DROP_INDEX = [
+    'DROP TRIGGER IF EXISTS messages_fts_insert',
+    'DROP TRIGGER IF EXISTS messages_fts_delete',
+    'DROP TRIGGER IF EXISTS messages_fts_update',
+    'DROP TABLE IF EXISTS messages_fts',
+    'DROP TABLE IF EXISTS messages_fts_keys',
+]
+
+CREATE_TABLE = (
+    "CREATE VIRTUAL TABLE messages_fts USING fts5("
+    "message_body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+
+CREATE_KEYED_INDEX = [
+    'CREATE TABLE messages_fts_keys ('
+    'id INTEGER PRIMARY KEY, message_id char(32) NOT NULL UNIQUE)',
+    CREATE_TABLE,
+    """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts_keys(message_id) VALUES (new.message_id);
+        INSERT INTO messages_fts(rowid, message_body)
+            VALUES ((SELECT id FROM messages_fts_keys WHERE message_id = new.message_id), new.message_body);
+    END""",
+    """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = (SELECT id FROM messages_fts_keys WHERE message_id = old.message_id);
+        DELETE FROM messages_fts_keys WHERE message_id = old.message_id;
+    END""",
+    """CREATE TRIGGER messages_fts_update AFTER UPDATE OF message_body ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = (SELECT id FROM messages_fts_keys WHERE message_id = old.message_id);
+        INSERT INTO messages_fts(rowid, message_body)
+            VALUES ((SELECT id FROM messages_fts_keys WHERE message_id = new.message_id), new.message_body);
+    END""",
+    'INSERT INTO messages_fts_keys(id, message_id) '
+    'SELECT row_number() OVER (ORDER BY rowid), message_id FROM messages',
+    'INSERT INTO messages_fts(rowid, message_body) '
+    'SELECT k.id, m.message_body FROM messages_fts_keys k '
+    'JOIN messages m ON m.message_id = k.message_id',
+]
+
+CREATE_ROWID_INDEX = [
+    CREATE_TABLE,
+    """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, message_body) VALUES (new.rowid, new.message_body);
+    END""",
+    """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.rowid;
+    END""",
+    """CREATE TRIGGER messages_fts_update AFTER UPDATE OF message_body ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = old.rowid;
+        INSERT INTO messages_fts(rowid, message_body) VALUES (new.rowid, new.message_body);
+    END""",
+    'INSERT INTO messages_fts(rowid, message_body) SELECT rowid, message_body FROM messages',
+]
+
+
+def key_index_by_message(apps, schema_editor):
+    """
+    Re-create the index keyed through messages_fts_keys instead of the
+    rowid of messages, which VACUUM may renumber
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_INDEX + CREATE_KEYED_INDEX:
+        schema_editor.execute(statement)
+
+
+def key_index_by_rowid(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_INDEX + CREATE_ROWID_INDEX:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0012_message_sequence'),
+    ]
+
+    operations = [
+        migrations.RunPython(key_index_by_message, key_index_by_rowid),
+    ]
@@ -0,0 +1,58 @@
+from django.db import migrations
+
+# Statements frozen from chats.sequence at the time of this migration, so
+# that later changes to that module do not rewrite it
+
+DROP_TRIGGER = 'DROP TRIGGER IF EXISTS messages_sequence_insert'
+
+CREATE_COUNTER = [
+    'CREATE TABLE IF NOT EXISTS messages_sequence_counter '
+    '(id integer PRIMARY KEY CHECK (id = 1), value bigint NOT NULL)',
+    'INSERT OR IGNORE INTO messages_sequence_counter (id, value) '
+    'SELECT 1, coalesce(max(sequence), 0) FROM messages',
+    """CREATE TRIGGER messages_sequence_insert AFTER INSERT ON messages
+    WHEN new.sequence IS NULL BEGIN
+        UPDATE messages_sequence_counter SET value = value + 1 WHERE id = 1;
+        UPDATE messages SET sequence = (
+            SELECT value FROM messages_sequence_counter WHERE id = 1
+        ) WHERE rowid = new.rowid;
+    END""",
+]
+
+CREATE_MAX_TRIGGER = """CREATE TRIGGER messages_sequence_insert AFTER INSERT ON messages
+    WHEN new.sequence IS NULL BEGIN
+        UPDATE messages SET sequence = (
+            SELECT coalesce(max(sequence), 0) + 1 FROM messages
+        ) WHERE rowid = new.rowid;
+    END"""
+
+
+def count_sequences(apps, schema_editor):
+    """
+    Hand out sequences from a counter instead of the highest one in use,
+    which goes back when the newest message is deleted
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in [DROP_TRIGGER] + CREATE_COUNTER:
+        schema_editor.execute(statement)
+
+
+def number_from_max(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in [
+        DROP_TRIGGER, CREATE_MAX_TRIGGER, 'DROP TABLE IF EXISTS messages_sequence_counter'
+    ]:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0013_message_search_stable_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(count_sequences, number_from_max),
+    ]
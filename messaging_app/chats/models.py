@@ -1,6 +1,8 @@
 import uuid
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 class UserManager(BaseUserManager):
@@ -71,6 +73,8 @@ class User(AbstractUser):
         null=False
     )
     created_at = models.DateTimeField(default=timezone.now)
+    # Bumped to revoke every signed token issued to the user so far
+    token_epoch = models.PositiveIntegerField(default=0, editable=False)
     
     # Remove username field and use email as the unique identifier
     username = None
@@ -82,14 +86,89 @@ class User(AbstractUser):
     
     class Meta:
         db_table = 'users'
-        indexes = [
-            models.Index(fields=['email']),
-            models.Index(fields=['user_id']),
-        ]
     
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.email})"
 
+class ConversationQuerySet(models.QuerySet):
+    """
+    QuerySet maintaining the denormalized activity summary of conversations
+    """
+    def with_last_message(self):
+        """
+        Join the summarized last message and its sender
+        """
+        return self.select_related('last_message__sender')
+
+    def record_message(self, message, count=1):
+        """
+        Count newly inserted messages and make `message` the last one if newest
+
+        `count` lets bulk inserts record a whole batch at once, passing the
+        newest message of the batch.
+        """
+        is_latest = (
+            Q(last_message__isnull=True) |
+            Q(last_activity_at__lt=message.sent_at) |
+            Q(last_activity_at=message.sent_at, last_message__lt=message.pk)
+        )
+        return self.update(
+            message_count=F('message_count') + count,
+            last_message=Case(
+                When(is_latest, then=Value(message.pk)),
+                default=F('last_message'),
+            ),
+            last_activity_at=Case(
+                When(is_latest, then=Value(message.sent_at)),
+                default=F('last_activity_at'),
+            ),
+        )
+
+    def forget_message(self):
+        """
+        Uncount a deleted message and re-read the newest remaining one
+        """
+        latest = Message.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by('-sent_at', '-message_id')
+        return self.update(
+            message_count=F('message_count') - 1,
+            last_message=Subquery(latest.values('pk')[:1]),
+            last_activity_at=Coalesce(
+                Subquery(latest.values('sent_at')[:1]), F('created_at')
+            ),
+        )
+
+    def refresh_summaries(self):
+        """
+        Recompute the summary of every conversation in the queryset
+        """
+        latest = Message.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by('-sent_at', '-message_id')
+        message_count = Message.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by().values('conversation').annotate(
+            count=Count('pk')
+        ).values('count')
+        # Archived messages are still part of the conversation's history
+        archived_count = ArchivedBlock.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by().values('conversation').annotate(
+            count=Sum('message_count')
+        ).values('count')
+        return self.update(
+            message_count=(
+                Coalesce(Subquery(message_count), 0) +
+                Coalesce(Subquery(archived_count), 0)
+            ),
+            last_message=Subquery(latest.values('pk')[:1]),
+            last_activity_at=Coalesce(
+                Subquery(latest.values('sent_at')[:1]), F('created_at')
+            ),
+        )
+
+
 class Conversation(models.Model):
     """
     Model representing a conversation between multiple users
@@ -102,27 +181,174 @@ class Conversation(models.Model):
     )
     participants = models.ManyToManyField(
         User,
+        through='ConversationParticipant',
         related_name='conversations',
         blank=False
     )
     created_at = models.DateTimeField(default=timezone.now)
+
+    # Activity summary, kept in step with message writes
+    last_message = models.ForeignKey(
+        'Message',
+        on_delete=models.SET_NULL,
+        related_name='+',
+        null=True,
+        blank=True,
+        editable=False
+    )
+    last_activity_at = models.DateTimeField(default=timezone.now, editable=False)
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ConversationQuerySet.as_manager()
     
     class Meta:
         db_table = 'conversations'
         indexes = [
-            models.Index(fields=['conversation_id']),
             models.Index(fields=['created_at']),
+            models.Index(fields=['last_activity_at']),
         ]
     
     def __str__(self):
+        # Names come from prefetched participants only, so that printing a
+        # conversation, as admin changelists do per row, never queries
+        participants = getattr(self, '_prefetched_objects_cache', {}).get('participants')
+        if participants is None:
+            return f"Conversation {self.conversation_id}"
+        participants = list(participants)
         participant_names = ", ".join([
             f"{user.first_name} {user.last_name}" 
-            for user in self.participants.all()[:2]
+            for user in participants[:2]
         ])
-        if self.participants.count() > 2:
-            participant_names += f" and {self.participants.count() - 2} others"
+        if len(participants) > 2:
+            participant_names += f" and {len(participants) - 2} others"
         return f"Conversation: {participant_names}"
 
+def read_before(sent_at, message_id):
+    """
+    Match memberships whose read watermark precedes the given message
+    """
+    return (
+        Q(last_read_at__isnull=True) |
+        Q(last_read_at__lt=sent_at) |
+        Q(last_read_at=sent_at, last_read_message_id__lt=message_id)
+    )
+
+
+class ConversationParticipantQuerySet(models.QuerySet):
+    """
+    QuerySet maintaining the read state of conversation members
+
+    A member has read every message up to their watermark, the
+    (last_read_at, last_read_message_id) key of a message. Messages of
+    others after it are unread, and so are all of them while no
+    watermark is set. `unread_count` is kept in step with message writes
+    so that listing conversations never counts messages.
+    """
+    def add_unread(self, count=1):
+        """
+        Count newly inserted messages as unread
+
+        Callers leave out the sender and the members who already read past
+        the messages.
+        """
+        return self.update(unread_count=F('unread_count') + count)
+
+    def forget_unread(self, message):
+        """
+        Uncount a deleted message for the members who had not read it yet
+        """
+        return self.filter(
+            read_before(message.sent_at, message.pk), unread_count__gt=0
+        ).update(unread_count=F('unread_count') - 1)
+
+    def start_at_latest(self):
+        """
+        Mark the history of the conversation as read for new members
+        """
+        latest = Conversation.objects.filter(pk=OuterRef('conversation_id'))
+        return self.filter(last_read_at__isnull=True).update(
+            last_read_at=Subquery(latest.values('last_message__sent_at')[:1]),
+            last_read_message_id=Subquery(latest.values('last_message_id')[:1]),
+            unread_count=0,
+        )
+
+    def mark_read(self, sent_at, message_id):
+        """
+        Move watermarks forward to the given message and recount what is
+        left unread after it
+
+        Watermarks already past the message are left alone. Counting from
+        the newest message costs next to nothing.
+        """
+        return self.filter(read_before(sent_at, message_id)).update(
+            last_read_at=sent_at,
+            last_read_message_id=message_id,
+            unread_count=Coalesce(Subquery(
+                unread_messages().filter(
+                    Q(sent_at__gt=sent_at) | Q(sent_at=sent_at, message_id__gt=message_id)
+                ).values('count')
+            ), 0),
+        )
+
+    def refresh_unread_counts(self):
+        """
+        Recompute the unread count of every membership in the queryset
+        """
+        unread = unread_messages().filter(
+            Q(sent_at__gt=OuterRef('last_read_at')) |
+            Q(sent_at=OuterRef('last_read_at'),
+              message_id__gt=OuterRef('last_read_message_id'))
+        )
+        return self.filter(last_read_at__isnull=True).update(
+            unread_count=Coalesce(Subquery(unread_messages().values('count')), 0)
+        ) + self.filter(last_read_at__isnull=False).update(
+            unread_count=Coalesce(Subquery(unread.values('count')), 0)
+        )
+
+
+def unread_messages():
+    """
+    Count the messages of others in the conversation of the outer membership
+    """
+    return Message.objects.filter(
+        conversation=OuterRef('conversation_id')
+    ).exclude(
+        sender=OuterRef('user_id')
+    ).order_by().values('conversation').annotate(count=Count('pk'))
+
+
+class ConversationParticipant(models.Model):
+    """
+    Model representing a user's membership in a conversation
+    """
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        # Covered by the (conversation, user) unique index
+        db_index=False
+    )
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        # Covered by the (user, conversation) index
+        db_index=False
+    )
+
+    # Read state; the watermark is no foreign key as archiving removes
+    # the message rows it points to
+    last_read_at = models.DateTimeField(null=True, blank=True, editable=False)
+    last_read_message_id = models.UUIDField(null=True, blank=True, editable=False)
+    unread_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ConversationParticipantQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'conversations_participants'
+        unique_together = [('conversation', 'user')]
+        indexes = [
+            models.Index(fields=['user', 'conversation']),
+        ]
+
 class Message(models.Model):
     """
     Model representing a message in a conversation
@@ -143,20 +369,120 @@ class Message(models.Model):
         Conversation,
         on_delete=models.CASCADE,
         related_name='messages',
-        null=False
+        null=False,
+        # Covered by the (conversation, sent_at, message_id) index
+        db_index=False
     )
     message_body = models.TextField(null=False, blank=False)
     sent_at = models.DateTimeField(default=timezone.now)
+    # Commit order of the message, set by a database trigger (see
+    # chats.sequence); None on instances until reloaded
+    sequence = models.BigIntegerField(null=True, db_index=True, editable=False)
     
     class Meta:
         db_table = 'messages'
         indexes = [
-            models.Index(fields=['message_id']),
-            models.Index(fields=['sender']),
-            models.Index(fields=['conversation']),
-            models.Index(fields=['sent_at']),
+            models.Index(fields=['sent_at', 'message_id']),
+            models.Index(fields=['conversation', 'sent_at', 'message_id']),
+            models.Index(fields=['conversation', 'sequence']),
         ]
         ordering = ['sent_at']
+
+    def save(self, *args, **kwargs):
+        """
+        Save the message and update the conversation summary and unread
+        counts atomically
+        """
+        adding = self._state.adding
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            if adding:
+                Conversation.objects.filter(
+                    pk=self.conversation_id
+                ).record_message(self)
+                ConversationParticipant.objects.filter(
+                    conversation_id=self.conversation_id
+                ).exclude(user_id=self.sender_id).filter(
+                    read_before(self.sent_at, self.pk)
+                ).add_unread()
     
     def __str__(self):
-        return f"Message from {self.sender.first_name}: {self.message_body[:50]}..."
\ No newline at end of file
+        # Name the sender only when loaded with the message, so that
+        # printing a message never queries
+        if Message.sender.is_cached(self):
+            sender = self.sender.first_name
+        else:
+            sender = self.sender_id
+        return f"Message from {sender}: {self.message_body[:50]}..."
+
+
+class ArchivedBlock(models.Model):
+    """
+    Index entry locating one compressed block of archived messages
+
+    Blocks of a conversation are appended to its segment file in
+    (sent_at, message_id) order and never overlap, so the first and last
+    keys are enough to find the blocks covering a page.
+    """
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='archived_blocks',
+        # Covered by the (conversation, first_sent_at) index
+        db_index=False
+    )
+    first_sent_at = models.DateTimeField()
+    first_message_id = models.UUIDField()
+    last_sent_at = models.DateTimeField()
+    last_message_id = models.UUIDField()
+    offset = models.PositiveBigIntegerField()
+    length = models.PositiveIntegerField()
+    message_count = models.PositiveIntegerField()
+
+    class Meta:
+        db_table = 'archived_message_blocks'
+        indexes = [
+            models.Index(fields=['conversation', 'first_sent_at']),
+            models.Index(fields=['conversation', 'last_sent_at']),
+        ]
+
+class PendingNotification(models.Model):
+    """
+    A new message waiting to be notified to one recipient with the next batch
+    """
+    recipient = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='pending_notifications',
+        # Covered by the (recipient, message) unique index
+        db_index=False
+    )
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+
+    class Meta:
+        db_table = 'pending_notifications'
+        unique_together = [('recipient', 'message')]
+
+class UserSearchToken(models.Model):
+    """
+    A normalized word of a user's name or email, indexing the user directory
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        # Covered by the (user, token) unique index
+        db_index=False
+    )
+    token = models.CharField(max_length=64)
+
+    class Meta:
+        db_table = 'user_search_tokens'
+        unique_together = [('user', 'token')]
+        indexes = [
+            models.Index(fields=['token', 'user']),
+        ]
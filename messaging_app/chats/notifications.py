@@ -0,0 +1,169 @@
+"""
+Notifications of new messages, batched per recipient
+
+`queue_notifications` is a message side effect run by the task pipeline.
+It records a pending notification for every participant but the sender.
+It then schedules one `flush_notifications` task per recipient, WINDOW
+seconds out, unless one is already scheduled. The flush sends everything
+pending for the recipient as a single batch:
+
+    {
+        "message_count": 3,
+        "conversations": [
+            {"conversation_id": "...", "message_count": 3,
+             "last_message_id": "...", "last_sender": "Alice",
+             "preview": "..."}
+        ]
+    }
+
+Batches are handed to the backend chosen by CHATS_NOTIFICATIONS:
+
+    CHATS_NOTIFICATIONS = {
+        'BACKEND': 'chats.notifications.LoggingBackend',
+        'WINDOW': 10,
+        'CACHE': 'default',
+    }
+
+The flag marking a scheduled flush lives in the CACHE alias, which must
+be shared by all processes enqueueing tasks. Pending rows are deleted
+before a batch is sent, so a batch whose delivery fails is dropped
+rather than sent twice.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import tasks
+from .models import ConversationParticipant, PendingNotification
+from .routers import use_primary
+
+DEFAULT_NOTIFICATIONS = {
+    'BACKEND': 'chats.notifications.LoggingBackend',
+    'WINDOW': 10,
+    'CACHE': 'default',
+}
+
+SCHEDULED_PREFIX = 'chats:notifications:scheduled:'
+
+PREVIEW_LENGTH = 100
+
+logger = logging.getLogger(__name__)
+
+# Batches sent through the MemoryBackend, like django.core.mail.outbox
+outbox = []
+
+
+class LoggingBackend:
+    """
+    Write each batch to the chats.notifications logger
+    """
+    def send(self, user_id, batch):
+        logger.info(
+            'Notifying %s of %d new messages in %d conversations',
+            user_id, batch['message_count'], len(batch['conversations'])
+        )
+
+
+class MemoryBackend:
+    """
+    Collect batches in `outbox` as (user_id, batch) pairs, for tests
+    """
+    def send(self, user_id, batch):
+        outbox.append((str(user_id), batch))
+
+
+def get_config():
+    return {**DEFAULT_NOTIFICATIONS, **getattr(settings, 'CHATS_NOTIFICATIONS', {})}
+
+
+def get_backend():
+    return import_string(get_config()['BACKEND'])()
+
+
+def scheduled_key(user_id):
+    return f'{SCHEDULED_PREFIX}{user_id}'
+
+
+def queue_notifications(messages):
+    """
+    Record pending notifications of `messages` and schedule their flushes
+    """
+    if not messages:
+        return
+    conversation_ids = {message.conversation_id for message in messages}
+    # A lagging replica could miss a new participant
+    with use_primary():
+        participants = {}
+        for conversation_id, user_id in ConversationParticipant.objects.filter(
+                conversation_id__in=conversation_ids
+        ).values_list('conversation_id', 'user_id'):
+            participants.setdefault(conversation_id, []).append(user_id)
+        pending = [
+            PendingNotification(recipient_id=user_id, message_id=message.pk)
+            for message in messages
+            for user_id in participants.get(message.conversation_id, ())
+            if user_id != message.sender_id
+        ]
+        # Ignoring conflicts makes a retried task harmless
+        PendingNotification.objects.bulk_create(pending, ignore_conflicts=True)
+    for user_id in {notification.recipient_id for notification in pending}:
+        schedule_flush(user_id)
+
+
+def schedule_flush(user_id):
+    """
+    Schedule a flush of the user's pending notifications unless one is due
+    """
+    config = get_config()
+    # The flag outlives the window a little, in case the worker lags behind
+    if caches[config['CACHE']].add(
+            scheduled_key(user_id), True, timeout=config['WINDOW'] * 2 + 60):
+        tasks.flush_notifications.apply_async(
+            (str(user_id),), countdown=config['WINDOW']
+        )
+
+
+def flush(user_id):
+    """
+    Send the user's pending notifications as one batch and return it
+    """
+    config = get_config()
+    # Cleared first: messages queued from now on schedule the next flush
+    caches[config['CACHE']].delete(scheduled_key(user_id))
+    with use_primary(), transaction.atomic():
+        pending = list(PendingNotification.objects.filter(
+            recipient_id=user_id
+        ).select_related('message__sender').order_by(
+            'message__sent_at', 'message__message_id'
+        ))
+        PendingNotification.objects.filter(
+            pk__in=[notification.pk for notification in pending]
+        ).delete()
+    if not pending:
+        return None
+    batch = summarize([notification.message for notification in pending])
+    get_backend().send(user_id, batch)
+    return batch
+
+
+def summarize(messages):
+    """
+    Group `messages`, oldest first, into a batch by conversation
+    """
+    conversations = {}
+    for message in messages:
+        entry = conversations.setdefault(message.conversation_id, {
+            'conversation_id': str(message.conversation_id),
+            'message_count': 0,
+        })
+        entry['message_count'] += 1
+        entry['last_message_id'] = str(message.message_id)
+        entry['last_sender'] = message.sender.first_name
+        entry['preview'] = message.message_body[:PREVIEW_LENGTH]
+    return {
+        'message_count': len(messages),
+        'conversations': list(conversations.values()),
+    }
@@ -0,0 +1,279 @@
+import uuid
+from base64 import b64decode, b64encode
+from collections import namedtuple
+from urllib import parse
+
+from django.core import signing
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+Cursor = namedtuple('Cursor', ['sent_at', 'message_id', 'reverse'])
+
+SYNC_WATERMARK_SALT = 'chats.sync.watermark'
+
+
+def encode_watermark(user, sequence):
+    """
+    Return an opaque, signed sync watermark bound to `user`
+    """
+    return signing.Signer(salt=SYNC_WATERMARK_SALT).sign_object({
+        'u': str(user.pk),
+        'q': sequence,
+    })
+
+
+def decode_watermark(user, token):
+    """
+    Return the message sequence a watermark issued to `user` resumes after
+
+    Watermarks issued before sequences existed decode to the forward
+    `Cursor` they hold. Raises ValueError if the token is malformed,
+    tampered with or was issued to someone else.
+    """
+    try:
+        data = signing.Signer(salt=SYNC_WATERMARK_SALT).unsign_object(token)
+        if data.get('u') != str(user.pk):
+            raise ValueError('Invalid watermark')
+        if 'q' in data:
+            if not isinstance(data['q'], int) or isinstance(data['q'], bool):
+                raise ValueError('Invalid watermark')
+            return data['q']
+        sent_at = parse_datetime(data['s'])
+        message_id = uuid.UUID(data['m'])
+    except (signing.BadSignature, AttributeError, KeyError, TypeError, ValueError):
+        raise ValueError('Invalid watermark')
+    if sent_at is None:
+        raise ValueError('Invalid watermark')
+    return Cursor(sent_at, message_id, reverse=False)
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination for messages ordered by (sent_at, message_id)
+
+    Unlike LIMIT/OFFSET pagination, every page is fetched with a range
+    seek on the (sent_at, message_id) index starting right after the
+    boundary row of the previous page, so page 1000 costs the same as
+    page 1 and no COUNT(*) is issued.
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+
+        if self.cursor is None:
+            reverse = False
+        else:
+            reverse = self.cursor.reverse
+            queryset = queryset.filter(self.get_boundary_filter(self.cursor))
+
+        if reverse:
+            queryset = queryset.order_by('-sent_at', '-message_id')
+        else:
+            queryset = queryset.order_by('sent_at', 'message_id')
+
+        # Fetch one extra row to find out whether there is another page
+        results = list(queryset[:self.page_size + 1])
+        # Views keeping part of the history elsewhere add their rows past
+        # the same cursor, in the same order
+        get_archived_rows = getattr(view, 'get_archived_rows', None)
+        if get_archived_rows is not None:
+            archived = get_archived_rows(self.cursor, self.page_size + 1)
+            if archived:
+                results = sorted(
+                    results + archived,
+                    key=lambda row: (row.sent_at, row.message_id),
+                    reverse=reverse,
+                )[:self.page_size + 1]
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if reverse:
+            self.page.reverse()
+            self.has_previous = has_more
+            self.has_next = True
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+
+        return self.page
+
+    @staticmethod
+    def get_boundary_filter(cursor):
+        """
+        Build the filter selecting rows strictly after (or before) the cursor
+
+        The leading sent_at range lets the database seek straight into the
+        index; the OR clause only breaks ties between equal timestamps.
+        """
+        if cursor.reverse:
+            return Q(sent_at__lte=cursor.sent_at) & (
+                Q(sent_at__lt=cursor.sent_at) |
+                Q(message_id__lt=cursor.message_id)
+            )
+        return Q(sent_at__gte=cursor.sent_at) & (
+            Q(sent_at__gt=cursor.sent_at) |
+            Q(message_id__gt=cursor.message_id)
+        )
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                size = int(request.query_params[self.page_size_query_param])
+                if size > 0:
+                    return min(size, self.max_page_size)
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            last = self.page[-1]
+            cursor = Cursor(last.sent_at, last.message_id, reverse=False)
+        else:
+            cursor = self.cursor._replace(reverse=False)
+        return self.encode_cursor(cursor)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            first = self.page[0]
+            cursor = Cursor(first.sent_at, first.message_id, reverse=True)
+        else:
+            cursor = self.cursor._replace(reverse=True)
+        return self.encode_cursor(cursor)
+
+    def decode_cursor(self, request):
+        """
+        Given a request with a cursor, return a `Cursor` instance
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            sent_at = parse_datetime(tokens['s'][0])
+            message_id = uuid.UUID(tokens['m'][0])
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+        except (TypeError, ValueError, KeyError, IndexError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if sent_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(sent_at, message_id, reverse)
+
+    @classmethod
+    def encode_token(cls, cursor):
+        """
+        Return the opaque query parameter value for a `Cursor` instance
+        """
+        tokens = {
+            's': cursor.sent_at.isoformat(),
+            'm': cursor.message_id.hex,
+        }
+        if cursor.reverse:
+            tokens['r'] = '1'
+        querystring = parse.urlencode(tokens)
+        return b64encode(querystring.encode('ascii')).decode('ascii')
+
+    def encode_cursor(self, cursor):
+        """
+        Given a `Cursor` instance, return an url with encoded cursor
+        """
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, self.encode_token(cursor)
+        )
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+def estimate_count(queryset):
+    """
+    Estimate the rows of an unfiltered queryset from table statistics
+
+    Returns None when the queryset is filtered or the database keeps no
+    usable statistics. On SQLite the estimate is the span of rowids,
+    two index lookups, which overshoots by the rows deleted in between;
+    archived history is the oldest and does not count. On PostgreSQL it
+    is pg_class.reltuples, as of the last ANALYZE.
+    """
+    if not isinstance(queryset, QuerySet):
+        return None
+    query = queryset.query
+    if query.where or query.distinct or query.combinator or query.is_sliced:
+        return None
+    connection = connections[queryset.db]
+    table = connection.ops.quote_name(queryset.model._meta.db_table)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # Separate subqueries keep SQLite's min/max index optimization
+            cursor.execute(
+                f'SELECT (SELECT MAX(_rowid_) FROM {table}) - '
+                f'(SELECT MIN(_rowid_) FROM {table}) + 1'
+            )
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                [queryset.model._meta.db_table],
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Django paginator estimating the size of large unfiltered tables
+
+    Counting every row of a table with millions of them takes seconds, and
+    the admin counts on every changelist page. Filtered querysets and
+    estimates under `exact_threshold` rows are still counted exactly.
+    """
+    exact_threshold = 100000
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is None or estimate < self.exact_threshold:
+            return super().count
+        return estimate
+
@@ -0,0 +1,232 @@
+"""
+In-process publish/subscribe layer used for real-time message delivery
+
+The backend is chosen with the CHATS_PUBSUB setting, in the same shape as
+Django's CACHES entries:
+
+    CHATS_PUBSUB = {
+        'BACKEND': 'chats.pubsub.InMemoryBackend',
+        'OPTIONS': {},
+    }
+"""
+import asyncio
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_PUBSUB = {
+    'BACKEND': 'chats.pubsub.InMemoryBackend',
+    'OPTIONS': {},
+}
+
+
+class BaseSubscription:
+    """
+    A set of channels registered with a backend
+    """
+    def __init__(self, backend, channels):
+        self.backend = backend
+        self.channels = set()
+        for channel in channels:
+            self.add(channel)
+
+    def add(self, channel):
+        """
+        Start receiving payloads published on `channel`
+        """
+        if channel not in self.channels:
+            self.channels.add(channel)
+            self.backend.register(channel, self)
+
+    def discard(self, channel):
+        """
+        Stop receiving payloads published on `channel`
+        """
+        if channel in self.channels:
+            self.channels.remove(channel)
+            self.backend.unregister(channel, self)
+
+    def close(self):
+        """
+        Stop receiving payloads on every channel
+        """
+        for channel in self.channels:
+            self.backend.unregister(channel, self)
+        self.channels.clear()
+
+    def deliver(self, channel, payload):
+        raise NotImplementedError
+
+
+class Subscription(BaseSubscription):
+    """
+    A set of channels delivering payloads to one asyncio consumer
+
+    Payloads may be delivered from any thread; they are handed over to the
+    event loop the subscription was created on. The queue is bounded so a
+    slow consumer cannot grow memory without limit: once it overflows the
+    subscription is marked and the consumer is expected to disconnect.
+    """
+    def __init__(self, backend, channels, max_queue=1000):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.overflowed = False
+        super().__init__(backend, channels)
+
+    def deliver(self, channel, payload):
+        """
+        Hand a payload to the consumer; safe to call from any thread
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._put((channel, payload))
+        elif not self.loop.is_closed():
+            # A closed loop has no consumer left to deliver to
+            self.loop.call_soon_threadsafe(self._put, (channel, payload))
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self):
+        """
+        Wait for the next `(channel, payload)` pair
+        """
+        return await self.queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+class ThreadSubscription(BaseSubscription):
+    """
+    A set of channels waking up one blocked thread, for long-polling views
+    """
+    def __init__(self, backend, channels):
+        self.event = threading.Event()
+        super().__init__(backend, channels)
+
+    def deliver(self, channel, payload):
+        self.event.set()
+
+    def wait(self, timeout):
+        """
+        Block until something is published or `timeout` seconds pass
+        """
+        published = self.event.wait(timeout)
+        self.event.clear()
+        return published
+
+
+class InMemoryBackend:
+    """
+    Deliver payloads to subscribers living in the current process
+    """
+    def __init__(self, max_queue=1000):
+        self.max_queue = max_queue
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        """
+        Return a `Subscription` to `channels`; must be called from async code
+        """
+        return Subscription(self, channels, max_queue=self.max_queue)
+
+    def subscribe_thread(self, channels):
+        """
+        Return a `ThreadSubscription` to `channels` for synchronous code
+        """
+        return ThreadSubscription(self, channels)
+
+    def register(self, channel, subscription):
+        with self._lock:
+            self._subscribers[channel].add(subscription)
+
+    def unregister(self, channel, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+    def publish(self, channel, payload):
+        """
+        Deliver `payload` to every subscriber of `channel`
+        """
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.deliver(channel, payload)
+
+
+class RedisBackend(InMemoryBackend):
+    """
+    Fan out across processes through Redis pub/sub
+
+    Publishing goes to Redis; one listener per process relays every
+    message on the prefix back into the in-memory registry.
+    """
+    def __init__(self, url='redis://localhost:6379/0', prefix='chats:', **kwargs):
+        super().__init__(**kwargs)
+        import redis
+
+        self.url = url
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._listener = None
+
+    def publish(self, channel, payload):
+        self._client.publish(self.prefix + channel, payload)
+
+    def subscribe(self, channels):
+        subscription = super().subscribe(channels)
+        if self._listener is None or self._listener.done():
+            self._listener = subscription.loop.create_task(self._listen())
+        return subscription
+
+    async def _listen(self):
+        import redis.asyncio
+
+        client = redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.psubscribe(self.prefix + '*')
+        async for message in pubsub.listen():
+            if message['type'] != 'pmessage':
+                continue
+            channel = message['channel'].decode()[len(self.prefix):]
+            super().publish(channel, message['data'].decode())
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    """
+    Return the process-wide backend configured by CHATS_PUBSUB
+    """
+    config = getattr(settings, 'CHATS_PUBSUB', DEFAULT_PUBSUB)
+    backend_class = import_string(config['BACKEND'])
+    return backend_class(**config.get('OPTIONS', {}))
+
+
+def conversation_channel(conversation_id):
+    return f'conversation:{conversation_id}'
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
@@ -0,0 +1,259 @@
+"""
+Per-request SQL accounting against per-action query budgets
+
+`QueryRecorder` counts and times the statements run on every database
+alias while it is active. It groups them by fingerprint, which is the
+SQL with its literals and lists of placeholders normalized. A
+fingerprint run more than once in a request is reported as duplicated,
+which is what an N+1 pattern looks like.
+
+Viewsets declare budgets per action:
+
+    class ConversationViewSet(viewsets.ModelViewSet):
+        query_budgets = {'list': 6, 'retrieve': 6}
+
+`QueryBudgetMiddleware` records requests as configured by
+CHATS_QUERY_BUDGETS:
+
+    CHATS_QUERY_BUDGETS = {
+        'ENFORCE': False,
+        'SAMPLE_RATE': 0.01,
+    }
+
+With ENFORCE on, as `chats.runner.QueryBudgetTestRunner` sets it for
+the test suite, every request is recorded and one exceeding its action's
+budget raises QueryBudgetExceeded, which fails the test that made it.
+Otherwise a SAMPLE_RATE fraction of requests is recorded and summarized
+in a chats.queries log line, at WARNING level when the budget is
+exceeded or statements were duplicated.
+
+`assert_query_budget()` checks any block of code the same way.
+"""
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+DEFAULT_QUERY_BUDGETS = {
+    'ENFORCE': False,
+    'SAMPLE_RATE': 0.01,
+}
+
+# Longest fingerprints kept in log lines
+FINGERPRINT_LOG_LENGTH = 200
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+# Transaction control depends on the caller's transaction, not on the view
+_TRANSACTION_CONTROL = re.compile(
+    r'\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b', re.IGNORECASE
+)
+
+logger = logging.getLogger('chats.queries')
+
+# Depth of Celery tasks running eagerly in the current context
+_eager_tasks = ContextVar('chats_eager_tasks', default=0)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def get_config():
+    return {**DEFAULT_QUERY_BUDGETS, **getattr(settings, 'CHATS_QUERY_BUDGETS', {})}
+
+
+def fingerprint(sql):
+    """
+    Normalize `sql` so that runs of the same statement compare equal
+    """
+    sql = _LITERAL.sub('?', sql)
+    sql = _PLACEHOLDER_LIST.sub('(...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryRecorder:
+    """
+    Record every statement run on any database alias while active
+
+    Transaction control statements are left out, so that the same view
+    runs as many statements inside a test's transaction as outside. So
+    are those of Celery tasks run eagerly, which belong to a worker in
+    production.
+    """
+    def __init__(self):
+        self.statements = []
+        self._stack = None
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for alias in connections:
+            self._stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+
+    def __call__(self, execute, sql, params, many, context):
+        if _eager_tasks.get() or _TRANSACTION_CONTROL.match(sql):
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.statements.append(
+                (fingerprint(sql), time.perf_counter() - started)
+            )
+
+    def __len__(self):
+        return len(self.statements)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration in self.statements)
+
+    def duplicates(self):
+        """
+        Return {fingerprint: count} of the statements run more than once
+        """
+        counts = Counter(sql for sql, _ in self.statements)
+        return {sql: count for sql, count in counts.most_common() if count > 1}
+
+    def summary(self, budget=None):
+        return {
+            'queries': len(self),
+            'budget': budget,
+            'duration_ms': round(self.duration * 1000, 3),
+            'duplicates': self.duplicates(),
+        }
+
+
+def enter_eager_task(task=None, **kwargs):
+    if task is not None and task.request.is_eager:
+        _eager_tasks.set(_eager_tasks.get() + 1)
+
+
+def exit_eager_task(task=None, **kwargs):
+    if task is not None and task.request.is_eager:
+        _eager_tasks.set(_eager_tasks.get() - 1)
+
+
+def get_budget(request):
+    """
+    Return the query budget of the viewset action serving `request`, or None
+    """
+    match = getattr(request, 'resolver_match', None)
+    view = match.func if match else None
+    actions = getattr(view, 'actions', None)
+    if not actions:
+        return None
+    action = actions.get(request.method.lower())
+    if action is None and request.method == 'HEAD':
+        action = actions.get('get')
+    return getattr(view.cls, 'query_budgets', {}).get(action)
+
+
+def describe(request):
+    match = getattr(request, 'resolver_match', None)
+    view = match.func if match else None
+    if getattr(view, 'actions', None):
+        action = view.actions.get(request.method.lower(), request.method.lower())
+        return f'{view.cls.__name__}.{action}'
+    return match.view_name if match else ''
+
+
+def check(recorder, budget, label):
+    """
+    Raise QueryBudgetExceeded if `recorder` ran more than `budget` statements
+    """
+    if budget is not None and len(recorder) > budget:
+        duplicates = ''.join(
+            f'\n  {count}x {sql[:FINGERPRINT_LOG_LENGTH]}'
+            for sql, count in recorder.duplicates().items()
+        )
+        raise QueryBudgetExceeded(
+            f'{label} ran {len(recorder)} queries, over its budget of {budget}'
+            + (f'; duplicated:{duplicates}' if duplicates else '')
+        )
+
+
+def log_summary(request, recorder, budget):
+    summary = recorder.summary(budget)
+    over = budget is not None and summary['queries'] > budget
+    logger.log(
+        logging.WARNING if over or summary['duplicates'] else logging.INFO,
+        '%s %s %s: %d queries (budget %s) in %.1f ms, %d duplicated',
+        request.method, request.path, describe(request), summary['queries'],
+        budget, summary['duration_ms'], sum(summary['duplicates'].values()),
+        extra={'query_summary': {
+            **summary,
+            'duplicates': {
+                sql[:FINGERPRINT_LOG_LENGTH]: count
+                for sql, count in summary['duplicates'].items()
+            },
+        }},
+    )
+
+
+@contextmanager
+def assert_query_budget(budget, label='Block'):
+    """
+    Fail if the block runs more than `budget` statements; yields the recorder
+    """
+    with QueryRecorder() as recorder:
+        yield recorder
+    check(recorder, budget, label)
+
+
+class QueryBudgetMiddleware:
+    """
+    Record the statements of requests and check them against their budget
+
+    Under ASGI the recording wraps the awaited view on the event loop, so
+    async views are budgeted without being pushed onto a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        config = get_config()
+        if not self.is_recorded(config):
+            return self.get_response(request)
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        self.process_recording(request, recorder, config)
+        return response
+
+    async def __acall__(self, request):
+        config = get_config()
+        if not self.is_recorded(config):
+            return await self.get_response(request)
+        with QueryRecorder() as recorder:
+            response = await self.get_response(request)
+        self.process_recording(request, recorder, config)
+        return response
+
+    def is_recorded(self, config):
+        return config['ENFORCE'] or random.random() < config['SAMPLE_RATE']
+
+    def process_recording(self, request, recorder, config):
+        budget = get_budget(request)
+        if config['ENFORCE']:
+            check(recorder, budget, f'{request.method} {request.path} ({describe(request)})')
+        else:
+            log_summary(request, recorder, budget)
@@ -0,0 +1,243 @@
+"""
+WebSocket delivery of new messages over the ASGI entry point
+
+Clients connect to ws://<host>/ws/messages/ with their session cookie and
+receive a JSON event for every message posted to their conversations:
+
+    {"type": "message.created", "message": {...}}
+
+Joining and leaving a conversation is announced as conversation.joined
+and conversation.left, and subscribes or unsubscribes the socket.
+
+Browsers send the session cookie with cross-site handshakes too, so a
+handshake whose Origin is neither an ALLOWED_HOSTS host nor one of
+CORS_ALLOWED_ORIGINS is refused. Clients other than browsers send no
+Origin and are not affected.
+"""
+import asyncio
+import json
+import logging
+from functools import wraps
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.http.request import split_domain_port, validate_host
+from rest_framework.renderers import JSONRenderer
+
+from .models import Conversation
+from .pubsub import get_backend, conversation_channel, user_channel
+from .serializers import MessageSerializer
+
+WEBSOCKET_PATH = '/ws/messages/'
+
+logger = logging.getLogger(__name__)
+
+# Close codes in the 4000-4999 range reserved for applications
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_NOT_FOUND = 4404
+CLOSE_OVERFLOW = 4408
+
+
+def publishing(publish):
+    """
+    Log the errors of a publishing function instead of raising them
+
+    Publishing runs once the change has committed, so an unreachable
+    backend must not turn a successful write into an error response.
+    Subscribers that missed the event catch up through sync.
+    """
+    @wraps(publish)
+    def wrapper(*args, **kwargs):
+        try:
+            publish(*args, **kwargs)
+        except Exception:
+            logger.exception('%s failed', publish.__name__)
+    return wrapper
+
+
+def message_event(data):
+    """
+    Render the event announcing a serialized message to its subscribers
+    """
+    return JSONRenderer().render({
+        'type': 'message.created',
+        'message': data,
+    }).decode()
+
+
+@publishing
+def publish_message(message):
+    """
+    Push a committed message to every subscriber of its conversation
+
+    The payload is rendered once and shared by all subscribers.
+    """
+    get_backend().publish(
+        conversation_channel(message.conversation_id),
+        message_event(MessageSerializer(message).data)
+    )
+
+
+@publishing
+def publish_events(conversation_id, payloads):
+    """
+    Push events rendered by `message_event` to a conversation's subscribers
+    """
+    backend = get_backend()
+    channel = conversation_channel(conversation_id)
+    for payload in payloads:
+        backend.publish(channel, payload)
+
+
+@publishing
+def publish_membership(user_id, conversation_id):
+    """
+    Tell the sockets of a user to subscribe to a newly joined conversation
+    """
+    payload = json.dumps({
+        'type': 'conversation.joined',
+        'conversation_id': str(conversation_id),
+    })
+    get_backend().publish(user_channel(user_id), payload)
+
+
+@publishing
+def publish_departure(user_id, conversation_id):
+    """
+    Tell the sockets of a user to unsubscribe from a conversation they left
+    """
+    payload = json.dumps({
+        'type': 'conversation.left',
+        'conversation_id': str(conversation_id),
+    })
+    get_backend().publish(user_channel(user_id), payload)
+
+
+def get_header(scope, name):
+    """
+    Return the value of header `name` (lowercase bytes) of a scope, or None
+    """
+    for header, value in scope.get('headers', []):
+        if header == name:
+            return value.decode('latin-1')
+    return None
+
+
+def is_allowed_origin(origin):
+    """
+    Return whether a browser on `origin` may open a socket
+    """
+    if origin in getattr(settings, 'CORS_ALLOWED_ORIGINS', ()):
+        return True
+    domain, _ = split_domain_port(urlsplit(origin).netloc)
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        # Same fallback as HttpRequest.get_host()
+        allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+    return bool(domain) and validate_host(domain, allowed_hosts)
+
+
+def get_session_key(scope):
+    """
+    Read the session id from the cookie header of a connection scope
+    """
+    cookie = SimpleCookie()
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            cookie.load(value.decode('latin-1'))
+    morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+    return morsel.value if morsel else None
+
+
+@sync_to_async
+def authenticate(scope):
+    """
+    Return the authenticated user of a connection scope, or None
+    """
+    session_key = get_session_key(scope)
+    if not session_key:
+        return None
+    engine = import_module(settings.SESSION_ENGINE)
+    # get_user() only needs the session of the request
+    user = get_user(SimpleNamespace(session=engine.SessionStore(session_key)))
+    return user if user.is_authenticated else None
+
+
+@sync_to_async
+def get_conversation_ids(user):
+    return list(Conversation.objects.filter(
+        participants=user
+    ).values_list('conversation_id', flat=True))
+
+
+async def forward_events(subscription, send):
+    """
+    Send every published payload to the socket until the queue overflows
+    """
+    async for channel, payload in subscription:
+        if subscription.overflowed:
+            # The client fell too far behind; make it reconnect and resync
+            await send({'type': 'websocket.close', 'code': CLOSE_OVERFLOW})
+            return
+        if channel not in subscription.channels:
+            # Published before the socket left, but not yet forwarded
+            continue
+        if channel.startswith('user:'):
+            event = json.loads(payload)
+            if event['type'] == 'conversation.joined':
+                subscription.add(conversation_channel(event['conversation_id']))
+            elif event['type'] == 'conversation.left':
+                subscription.discard(conversation_channel(event['conversation_id']))
+        await send({'type': 'websocket.send', 'text': payload})
+
+
+async def websocket_application(scope, receive, send):
+    """
+    ASGI application serving the real-time message socket
+    """
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    if scope['path'] != WEBSOCKET_PATH:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+
+    origin = get_header(scope, b'origin')
+    if origin is not None and not is_allowed_origin(origin):
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+
+    user = await authenticate(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+
+    conversation_ids = await get_conversation_ids(user)
+    channels = [user_channel(user.user_id)]
+    channels += [conversation_channel(pk) for pk in conversation_ids]
+    subscription = get_backend().subscribe(channels)
+    await send({'type': 'websocket.accept'})
+
+    forwarder = asyncio.create_task(forward_events(subscription, send))
+    try:
+        while True:
+            receiver = asyncio.ensure_future(receive())
+            done, _ = await asyncio.wait(
+                {receiver, forwarder}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if forwarder in done:
+                receiver.cancel()
+                break
+            # Client frames are ignored; only disconnects matter
+            if receiver.result()['type'] == 'websocket.disconnect':
+                break
+    finally:
+        forwarder.cancel()
+        subscription.close()
@@ -0,0 +1,62 @@
+"""
+Stand-in for database replication between two SQLite files
+
+`replicate()` copies the primary into the replica with SQLite's online
+backup API, so the replica always holds a consistent snapshot of the
+primary as of when the copy started. That start time is the replication
+position, which the copy records in a table of the replica itself, so
+every process reading the replica also sees how far it has caught up.
+Consumers compare it with the version stamps of `chats.versions` to tell
+whether the replica already holds a change. Production deployments would
+ask the database for the replica's replay position instead.
+"""
+import time
+
+from django.db import DatabaseError, connections
+
+from .routers import PRIMARY, get_replica
+
+POSITION_TABLE = 'chats_replication_position'
+
+
+def replicate(source=PRIMARY, target=None):
+    """
+    Copy `source` into `target` and publish the new replication position
+    """
+    target = target or get_replica()
+    started = time.time_ns()
+    for alias in (source, target):
+        connections[alias].ensure_connection()
+    connections[source].connection.backup(connections[target].connection)
+    # The backup replaced the whole replica, position table included
+    with connections[target].cursor() as cursor:
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {POSITION_TABLE} '
+            '(id integer PRIMARY KEY CHECK (id = 1), position bigint NOT NULL)'
+        )
+        cursor.execute(
+            f'INSERT OR REPLACE INTO {POSITION_TABLE} (id, position) VALUES (1, %s)',
+            [started]
+        )
+    return started
+
+
+def position(replica=None):
+    """
+    Return the time in nanoseconds up to which the replica holds all commits
+    """
+    try:
+        with connections[replica or get_replica()].cursor() as cursor:
+            cursor.execute(f'SELECT position FROM {POSITION_TABLE} WHERE id = 1')
+            row = cursor.fetchone()
+    except DatabaseError:
+        # Between a copy and recording its position, assume nothing replicated
+        return 0
+    return row[0] if row else 0
+
+
+def is_replicated(version):
+    """
+    Return whether the replica holds every change stamped up to `version`
+    """
+    return version <= position()
@@ -0,0 +1,161 @@
+"""
+Primary/replica database routing with read-your-writes stickiness
+
+Reads of the chats models go to the alias named by CHATS_READ_REPLICA and
+everything else goes to `default`. Routing is off while the setting is
+None. A request that writes, or that uses an unsafe HTTP method, reads
+from the primary for the rest of the request. The middleware then pins
+its user in the shared versions cache, so that the user's next requests,
+from any client and to any process, also read from the primary until
+replication has caught up with the write.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+PRIMARY = 'default'
+PIN_KEY = 'chats:replica:pinned:{}'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RoutingState:
+    """
+    Routing decisions of the current request
+    """
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state = ContextVar('chats_routing_state', default=None)
+
+
+def get_replica():
+    return getattr(settings, 'CHATS_READ_REPLICA', None)
+
+
+def is_pinned():
+    state = _state.get()
+    return state is not None and state.pinned
+
+
+def get_sticky_seconds():
+    return getattr(settings, 'CHATS_REPLICA_STICKY_SECONDS', 5)
+
+
+def _pin_key(user):
+    return PIN_KEY.format(user.pk)
+
+
+def pin_user(user):
+    """
+    Make `user` read from the primary for CHATS_REPLICA_STICKY_SECONDS
+    """
+    from . import versions
+
+    window = get_sticky_seconds()
+    versions.get_cache().set(_pin_key(user), time.time() + window, timeout=window)
+
+
+def apply_user_pin(user):
+    """
+    Pin the current request to the primary if `user` wrote recently
+    """
+    from . import versions
+
+    state = _state.get()
+    if state is None or state.pinned or not getattr(user, 'is_authenticated', False):
+        return
+    if versions.get_cache().get(_pin_key(user), 0) > time.time():
+        state.pinned = True
+
+
+@contextmanager
+def use_primary():
+    """
+    Read from the primary inside the block
+    """
+    state = _state.get()
+    token = None
+    if state is None:
+        state = RoutingState()
+        token = _state.set(state)
+    pinned = state.pinned
+    state.pinned = True
+    try:
+        yield
+    finally:
+        state.pinned = pinned or state.wrote
+        if token is not None:
+            _state.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """
+    Send chats reads to the replica unless the current request is pinned
+    """
+    def db_for_read(self, model, **hints):
+        replica = get_replica()
+        if replica is None or model._meta.app_label != 'chats' or is_pinned():
+            return None
+        return replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.pinned = state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        aliases = {PRIMARY, get_replica()}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive their schema through replication
+        return db == PRIMARY
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Pin requests to the primary after their user wrote
+
+    Pinning lasts CHATS_REPLICA_STICKY_SECONDS after the last write, which
+    should exceed the replication interval. Session users are looked up
+    before the view runs; users of the API's token authentication are
+    checked by ReplicaStickinessMixin once DRF has authenticated them.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if get_replica() is None:
+            return self.get_response(request)
+        state = RoutingState(pinned=request.method not in SAFE_METHODS)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        user = getattr(request, 'user', None)
+        if (state.wrote or request.method not in SAFE_METHODS) \
+                and getattr(user, 'is_authenticated', False):
+            pin_user(user)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if _state.get() is not None:
+            apply_user_pin(getattr(request, 'user', None))
+
+
+class ReplicaStickinessMixin:
+    """
+    Read from the primary for a viewset's users who wrote recently
+    """
+    def perform_authentication(self, request):
+        super().perform_authentication(request)
+        apply_user_pin(request.user)
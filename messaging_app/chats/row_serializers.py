@@ -0,0 +1,153 @@
+"""
+Read-only fast path turning `values_list()` rows into serializer output
+
+`RowSerializer` looks at a DRF serializer class once and generates a
+plain Python function that unpacks a database row tuple and builds the
+same nested dicts as `serializer.data`. Per row it does one tuple unpack
+and a few `str()` calls. Field objects, `get_attribute`, OrderedDicts
+and model instances are all skipped. The output renders to the same
+JSON bytes as the serializer it was compiled from.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.settings import ISO_8601, api_settings
+
+from .timing import phase
+
+# Field types whose representation of a database value is the value itself
+PASSTHROUGH_FIELDS = (
+    serializers.CharField,
+    serializers.ChoiceField,
+    serializers.IntegerField,
+    serializers.BooleanField,
+)
+
+
+def format_datetime(value, tz):
+    """
+    Same output as DRF's DateTimeField.to_representation in ISO 8601 mode
+    """
+    if tz is not None and timezone.is_aware(value):
+        value = value.astimezone(tz)
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+class RowSerializer:
+    """
+    Compile a serializer class into a row-to-dict function
+
+    `columns` lists the lookups to pass to `values_list()`. Their order
+    matches the tuple positions the compiled function expects.
+    """
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self.columns = []
+        body = self._compile_fields(serializer_class(), prefix='')
+        names = ', '.join(f'c{i}' for i in range(len(self.columns)))
+        source = (
+            'def serialize_row(row, tz):\n'
+            f'    {names}, = row\n'
+            f'    return {body}\n'
+        )
+        namespace = {'_str': str, 'format_datetime': format_datetime}
+        filename = f'<row serializer {serializer_class.__name__}>'
+        exec(compile(source, filename, 'exec'), namespace)
+        self.source = source
+        self.serialize_row = namespace['serialize_row']
+        # Same shape as the named rows of values_list()
+        self.row_class = namedtuple('Row', self.columns)
+
+    def _column(self, lookup):
+        self.columns.append(lookup)
+        return f'c{len(self.columns) - 1}'
+
+    def _compile_fields(self, serializer, prefix):
+        items = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if field.source == '*' or '.' in field.source:
+                raise ImproperlyConfigured(
+                    f'{type(serializer).__name__}.{name}: only plain model '
+                    'attributes can be compiled'
+                )
+            lookup = prefix + field.source
+            if isinstance(field, serializers.BaseSerializer):
+                if getattr(field, 'many', False):
+                    raise ImproperlyConfigured(
+                        f'{type(serializer).__name__}.{name}: to-many nesting '
+                        'cannot be compiled into a single row'
+                    )
+                expression = self._compile_fields(field, prefix=lookup + '__')
+            else:
+                expression = self._compile_value(serializer, name, field, lookup)
+            items.append(f'{name!r}: {expression}')
+        return '{' + ', '.join(items) + '}'
+
+    def _compile_value(self, serializer, name, field, lookup):
+        column = self._column(lookup)
+        if isinstance(field, serializers.DateTimeField):
+            output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+            if output_format is None or output_format.lower() != ISO_8601:
+                raise ImproperlyConfigured(
+                    f'{type(serializer).__name__}.{name}: only ISO 8601 '
+                    'datetimes can be compiled'
+                )
+            converted = f'format_datetime({column}, tz)'
+        elif isinstance(field, (serializers.UUIDField, serializers.PrimaryKeyRelatedField)):
+            # Rendered by the JSON encoder as str(uuid) either way
+            converted = f'_str({column})'
+        elif isinstance(field, PASSTHROUGH_FIELDS):
+            return f'{column}'
+        else:
+            raise ImproperlyConfigured(
+                f'{type(serializer).__name__}.{name}: {type(field).__name__} '
+                'is not supported by the row serializer'
+            )
+        return f'(None if {column} is None else {converted})'
+
+    def serialize(self, rows):
+        """
+        Serialize an iterable of `values_list(*self.columns)` rows
+        """
+        with phase('serialize'):
+            return list(self.iterate(rows))
+
+    def iterate(self, rows):
+        """
+        Lazily serialize `rows`, for streaming responses
+        """
+        tz = timezone.get_current_timezone() if settings.USE_TZ else None
+        serialize_row = self.serialize_row
+        for row in rows:
+            yield serialize_row(row, tz)
+
+    def values_list(self, queryset):
+        """
+        Return `queryset` as named rows carrying exactly the compiled columns
+        """
+        return queryset.values_list(*self.columns, named=True)
+
+    def row_from_instance(self, instance):
+        """
+        Build the row `values_list()` would return for a model instance
+
+        Used for instances that are not in the database, such as archived
+        messages. Relations must already be loaded.
+        """
+        values = []
+        for lookup in self.columns:
+            *path, name = lookup.split('__')
+            obj = instance
+            for part in path:
+                obj = getattr(obj, part)
+            # values_list() returns the raw id of a foreign key column
+            values.append(getattr(obj, obj._meta.get_field(name).attname))
+        return self.row_class(*values)
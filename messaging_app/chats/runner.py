@@ -0,0 +1,24 @@
+"""
+Test runner enforcing the query budgets of `chats.querybudget`
+
+Point TEST_RUNNER at `QueryBudgetTestRunner` to make every request that
+exceeds its action's budget fail the test that made it, whatever the
+CHATS_QUERY_BUDGETS of the settings module.
+"""
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from .querybudget import get_config
+
+
+class QueryBudgetTestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.enforced_budgets = override_settings(
+            CHATS_QUERY_BUDGETS={**get_config(), 'ENFORCE': True}
+        )
+        self.enforced_budgets.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.enforced_budgets.disable()
+        super().teardown_test_environment(**kwargs)
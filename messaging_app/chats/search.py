@@ -0,0 +1,242 @@
+"""
+Full-text search over message bodies backed by an SQLite FTS5 index
+
+The index is the `messages_fts` virtual table, holding a copy of each
+`message_body`. Messages have UUID keys while FTS5 rows need integer
+ones, so `messages_fts_keys` gives every indexed message a stable
+integer key. The rowid of `messages` cannot serve: VACUUM may renumber
+it. Triggers on `messages` keep both tables in sync for every write
+path, including bulk_create and queryset deletes. Rebuilding `messages`,
+as some SQLite migrations do, drops those triggers. The post_migrate
+hook notices the missing triggers and rebuilds the index, once the
+migration creating this form of it has run.
+"""
+import re
+
+from django.db import connection as default_connection, transaction
+from django.db.models import prefetch_related_objects
+
+from .models import Message
+
+FTS_TABLE = 'messages_fts'
+KEYS_TABLE = 'messages_fts_keys'
+# Migration installing the statements below
+MIGRATION = ('chats', '0013_message_search_stable_keys')
+
+CREATE_TABLES = [
+    f"CREATE TABLE IF NOT EXISTS {KEYS_TABLE} ("
+    "id INTEGER PRIMARY KEY, message_id char(32) NOT NULL UNIQUE)",
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "message_body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+]
+
+KEY_OF = f'(SELECT id FROM {KEYS_TABLE} WHERE message_id = {{row}}.message_id)'
+
+CREATE_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO {KEYS_TABLE}(message_id) VALUES (new.message_id);
+        INSERT INTO {FTS_TABLE}(rowid, message_body)
+            VALUES ({KEY_OF.format(row='new')}, new.message_body);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = {KEY_OF.format(row='old')};
+        DELETE FROM {KEYS_TABLE} WHERE message_id = old.message_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF message_body ON messages BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = {KEY_OF.format(row='old')};
+        INSERT INTO {FTS_TABLE}(rowid, message_body)
+            VALUES ({KEY_OF.format(row='new')}, new.message_body);
+    END""",
+]
+
+DROP_STATEMENTS = [
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_insert',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_delete',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_update',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+    f'DROP TABLE IF EXISTS {KEYS_TABLE}',
+]
+
+# Ranking every match of a very common word is what makes naive bm25
+# search slow, so only the most recent visible matches (highest keys)
+# are ranked. Snippets are built for the final page only.
+SEARCH_SQL = f"""
+    SELECT m.*, top.rank AS rank,
+           snippet({FTS_TABLE}, 0, '[', ']', '...', 12) AS snippet
+    FROM {FTS_TABLE}
+    JOIN (
+        SELECT rid, rank FROM (
+            SELECT {FTS_TABLE}.rowid AS rid, bm25({FTS_TABLE}) AS rank
+            FROM {FTS_TABLE}
+            JOIN {KEYS_TABLE} k ON k.id = {FTS_TABLE}.rowid
+            JOIN messages m ON m.message_id = k.message_id
+            JOIN conversations_participants p
+              ON p.conversation_id = m.conversation_id AND p.user_id = %s
+            WHERE {FTS_TABLE} MATCH %s {{conversation_filter}}
+            ORDER BY {FTS_TABLE}.rowid DESC
+            LIMIT %s
+        )
+        ORDER BY rank
+        LIMIT %s
+    ) top ON top.rid = {FTS_TABLE}.rowid
+    JOIN {KEYS_TABLE} k ON k.id = {FTS_TABLE}.rowid
+    JOIN messages m ON m.message_id = k.message_id
+    WHERE {FTS_TABLE} MATCH %s
+    ORDER BY top.rank
+"""
+
+# Message ids matching an FTS5 query, for filtering querysets
+MATCHING_IDS_SQL = (
+    f'SELECT message_id FROM {KEYS_TABLE} WHERE id IN ('
+    f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s)'
+)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def is_supported(connection=default_connection):
+    return connection.vendor == 'sqlite'
+
+
+def install(connection=default_connection):
+    """
+    Create the index tables and their triggers if they are missing
+    """
+    with connection.cursor() as cursor:
+        for statement in CREATE_TABLES:
+            cursor.execute(statement)
+        for statement in CREATE_TRIGGERS:
+            cursor.execute(statement)
+
+
+def uninstall(connection=default_connection):
+    with connection.cursor() as cursor:
+        for statement in DROP_STATEMENTS:
+            cursor.execute(statement)
+
+
+def triggers_installed(connection=default_connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s",
+            [f'{FTS_TABLE}_%'],
+        )
+        return cursor.fetchone()[0] == len(CREATE_TRIGGERS)
+
+
+def rebuild(connection=default_connection, chunk_size=10000, progress=None):
+    """
+    Re-create the index from `messages` in rowid order, chunk by chunk
+
+    Keys are handed out in the same order, so the most recently written
+    messages keep the highest keys. The whole rebuild runs in one
+    transaction so searches never observe a half-built index, and
+    rowids cannot change while it reads them.
+    """
+    indexed = 0
+    with transaction.atomic(using=connection.alias):
+        install(connection)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(f'DELETE FROM {KEYS_TABLE}')
+            last_rowid = 0
+            while True:
+                cursor.execute(
+                    'SELECT max(rowid), count(*) FROM ('
+                    'SELECT rowid FROM messages WHERE rowid > %s '
+                    'ORDER BY rowid LIMIT %s)',
+                    [last_rowid, chunk_size],
+                )
+                upper, count = cursor.fetchone()
+                if not count:
+                    break
+                cursor.execute(
+                    f'INSERT INTO {KEYS_TABLE}(id, message_id) '
+                    f'SELECT {indexed} + row_number() OVER (ORDER BY rowid), message_id '
+                    'FROM messages WHERE rowid > %s AND rowid <= %s',
+                    [last_rowid, upper],
+                )
+                cursor.execute(
+                    f'INSERT INTO {FTS_TABLE}(rowid, message_body) '
+                    f'SELECT k.id, m.message_body FROM {KEYS_TABLE} k '
+                    'JOIN messages m ON m.message_id = k.message_id '
+                    'WHERE k.id > %s',
+                    [indexed],
+                )
+                indexed += count
+                last_rowid = upper
+                if progress:
+                    progress(indexed)
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+    return indexed
+
+
+def ensure_index(using='default', **kwargs):
+    """
+    post_migrate hook re-installing the index after `messages` was rebuilt
+    """
+    from django.db import connections
+    from django.db.migrations.recorder import MigrationRecorder
+
+    connection = connections[using]
+    if not is_supported(connection):
+        return
+    if 'messages' not in connection.introspection.table_names():
+        return
+    # Earlier schemas lack what the statements refer to
+    if MIGRATION not in MigrationRecorder(connection).applied_migrations():
+        return
+    if not triggers_installed(connection):
+        rebuild(connection)
+
+
+def build_match_query(text):
+    """
+    Turn free text into a safe FTS5 query
+
+    Every word must match; the last word also matches as a prefix so
+    results appear while the user is still typing.
+    """
+    tokens = TOKEN_RE.findall(text)
+    if not tokens:
+        return None
+    terms = ['"{}"'.format(token) for token in tokens]
+    terms[-1] += '*'
+    return ' AND '.join(terms)
+
+
+def search_messages(user, text, conversation_id=None, limit=20, candidates=1000):
+    """
+    Return messages visible to `user` matching `text`, best match first
+
+    Only the `candidates` most recently indexed matches are ranked. Each
+    message has a `rank` attribute (bm25, lower is better) and a `snippet`
+    attribute. Backends without FTS5 fall back to a substring match.
+    """
+    if not is_supported():
+        queryset = Message.objects.filter(
+            conversation__participants=user, message_body__icontains=text
+        )
+        if conversation_id:
+            queryset = queryset.filter(conversation_id=conversation_id)
+        results = list(queryset.select_related('sender').order_by('-sent_at')[:limit])
+        for message in results:
+            message.rank, message.snippet = None, message.message_body
+        return results
+
+    match = build_match_query(text)
+    if match is None:
+        return []
+
+    params = [user.pk.hex, match]
+    conversation_filter = ''
+    if conversation_id:
+        conversation_filter = 'AND m.conversation_id = %s'
+        params.append(conversation_id.hex)
+    params += [candidates, limit, match]
+
+    results = list(Message.objects.raw(
+        SEARCH_SQL.format(conversation_filter=conversation_filter), params
+    ))
+    prefetch_related_objects(results, 'sender')
+    return results
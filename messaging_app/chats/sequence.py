@@ -0,0 +1,82 @@
+"""
+Commit-ordered sequence numbers of messages
+
+`sent_at` is stamped before the message is written, and bulk uploads may
+backdate it, so a message can commit after others with a later
+`sent_at`. Sync reads changes in `Message.sequence` order instead. An
+SQLite trigger takes it from the one-row `messages_sequence_counter`
+table right after the row is inserted. The counter only goes up, so
+deleting the newest message never hands its number out again, which
+would hide the next message from clients already past it. SQLite lets
+one transaction write at a time and it keeps the write lock until it
+commits, so sequences are handed out in commit order: a reader that has
+seen sequence n will never see a smaller one commit later.
+
+The trigger covers every write path, bulk_create included. Rebuilding
+`messages`, as some SQLite migrations do, drops it, so the post_migrate
+hook re-installs it when missing, once the migration adding the counter
+has run. Other databases have no trigger; the chats.E001 system check
+refuses them.
+"""
+from django.db import connection as default_connection
+
+TRIGGER = 'messages_sequence_insert'
+COUNTER_TABLE = 'messages_sequence_counter'
+# Migration installing the statements below
+MIGRATION = ('chats', '0014_message_sequence_counter')
+
+CREATE_COUNTER = [
+    f'CREATE TABLE IF NOT EXISTS {COUNTER_TABLE} '
+    '(id integer PRIMARY KEY CHECK (id = 1), value bigint NOT NULL)',
+    f'INSERT OR IGNORE INTO {COUNTER_TABLE} (id, value) '
+    'SELECT 1, coalesce(max(sequence), 0) FROM messages',
+]
+
+CREATE_TRIGGER = f"""CREATE TRIGGER IF NOT EXISTS {TRIGGER} AFTER INSERT ON messages
+    WHEN new.sequence IS NULL BEGIN
+        UPDATE {COUNTER_TABLE} SET value = value + 1 WHERE id = 1;
+        UPDATE messages SET sequence = (
+            SELECT value FROM {COUNTER_TABLE} WHERE id = 1
+        ) WHERE rowid = new.rowid;
+    END"""
+
+DROP_TRIGGER = f'DROP TRIGGER IF EXISTS {TRIGGER}'
+
+
+def is_supported(connection=default_connection):
+    return connection.vendor == 'sqlite'
+
+
+def install(connection=default_connection):
+    with connection.cursor() as cursor:
+        for statement in CREATE_COUNTER:
+            cursor.execute(statement)
+        cursor.execute(CREATE_TRIGGER)
+
+
+def trigger_installed(connection=default_connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name = %s",
+            [TRIGGER],
+        )
+        return cursor.fetchone()[0] == 1
+
+
+def ensure_trigger(using='default', **kwargs):
+    """
+    post_migrate hook re-installing the trigger after `messages` was rebuilt
+    """
+    from django.db import connections
+    from django.db.migrations.recorder import MigrationRecorder
+
+    connection = connections[using]
+    if not is_supported(connection):
+        return
+    if 'messages' not in connection.introspection.table_names():
+        return
+    # Earlier schemas lack what the statements refer to
+    if MIGRATION not in MigrationRecorder(connection).applied_migrations():
+        return
+    if not trigger_installed(connection):
+        install(connection)
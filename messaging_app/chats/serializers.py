@@ -1,7 +1,13 @@
+from django.urls import reverse
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.utils.urls import replace_query_param
+from . import archive
 from .models import User, Conversation, Message
+from .pagination import Cursor, MessageCursorPagination
+from .timing import TimedSerializerMixin
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for User model
     """
@@ -29,7 +35,7 @@ class UserSerializer(serializers.ModelSerializer):
         user.save()
         return user
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for Message model with sender details
     """
@@ -47,7 +53,33 @@ class MessageSerializer(serializers.ModelSerializer):
             'sent_at': {'read_only': True},
         }
 
-class ConversationSerializer(serializers.ModelSerializer):
+class MessageSearchResultSerializer(MessageSerializer):
+    """
+    Serializer for a full-text search hit with its rank and snippet
+    """
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+    
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['rank', 'snippet']
+
+class BulkMessageSerializer(serializers.Serializer):
+    """
+    Lightweight serializer validating one message of a bulk upload
+    """
+    message_body = serializers.CharField(allow_blank=False, trim_whitespace=False)
+    sent_at = serializers.DateTimeField(required=False)
+    
+    def validate_sent_at(self, value):
+        """
+        Reject future timestamps, which would stay the conversation's last
+        message and move sync watermarks past every message sent until then
+        """
+        if value > timezone.now():
+            raise serializers.ValidationError('sent_at cannot be in the future.')
+        return value
+
+class ConversationSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Serializer for Conversation model with nested relationships
     """
@@ -57,19 +89,75 @@ class ConversationSerializer(serializers.ModelSerializer):
         write_only=True,
         required=True
     )
-    messages = MessageSerializer(many=True, read_only=True)
+    messages = serializers.SerializerMethodField()
+    older_messages = serializers.SerializerMethodField()
+    # Only the newest messages are embedded; older history is paginated
+    recent_messages_limit = 20
     
     class Meta:
         model = Conversation
         fields = [
             'conversation_id', 'participants', 'participant_ids', 
-            'messages', 'created_at'
+            'messages', 'older_messages', 'created_at'
         ]
         extra_kwargs = {
             'conversation_id': {'read_only': True},
             'created_at': {'read_only': True},
         }
     
+    def get_recent_messages(self, obj):
+        """
+        Return the newest messages, oldest first, and whether there are more
+        
+        One extra row is fetched through the (conversation, sent_at,
+        message_id) index to learn whether older history exists, so the
+        cost does not depend on the size of the conversation. Archived
+        messages are read only if they can be among the newest.
+        """
+        cache = self.context.setdefault('recent_messages', {})
+        if obj.pk not in cache:
+            limit = self.recent_messages_limit
+            newest = list(Message.objects.filter(
+                conversation=obj
+            ).select_related('sender').order_by('-sent_at', '-message_id')[:limit + 1])
+            if archive.is_enabled():
+                last_archived = archive.last_key(obj.pk)
+                if last_archived and (
+                        len(newest) <= limit or last_archived > archive.key(newest[-1])):
+                    newest = sorted(
+                        newest + archive.read_messages(
+                            obj.pk, Cursor(None, None, reverse=True), limit + 1
+                        ),
+                        key=archive.key, reverse=True,
+                    )[:limit + 1]
+            cache[obj.pk] = (newest[:limit][::-1], len(newest) > limit)
+        return cache[obj.pk]
+    
+    def get_messages(self, obj):
+        """
+        Serialize the most recent messages of the conversation
+        """
+        messages, _ = self.get_recent_messages(obj)
+        return MessageSerializer(messages, many=True, context=self.context).data
+    
+    def get_older_messages(self, obj):
+        """
+        Link to the nested messages page preceding the embedded messages
+        """
+        messages, has_older = self.get_recent_messages(obj)
+        if not has_older:
+            return None
+        oldest = messages[0]
+        token = MessageCursorPagination.encode_token(
+            Cursor(oldest.sent_at, oldest.message_id, reverse=True)
+        )
+        url = reverse('conversation-messages-list', kwargs={
+            'conversation_conversation_id': obj.pk,
+        })
+        url = replace_query_param(url, MessageCursorPagination.cursor_query_param, token)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+    
     def create(self, validated_data):
         """
         Create a conversation with participants and proper validation
@@ -95,36 +183,31 @@ class ConversationSerializer(serializers.ModelSerializer):
         
         return conversation
 
-class ConversationListSerializer(serializers.ModelSerializer):
+class ConversationListSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Lightweight serializer for listing conversations
     """
     participants = UserSerializer(many=True, read_only=True)
     last_message = serializers.SerializerMethodField()
-    message_count = serializers.SerializerMethodField()
+    # Annotated from the requesting user's membership by the view
+    unread_count = serializers.IntegerField(read_only=True, default=0)
     
     class Meta:
         model = Conversation
         fields = [
             'conversation_id', 'participants', 'created_at', 
-            'last_message', 'message_count'
+            'last_message', 'message_count', 'unread_count'
         ]
     
     def get_last_message(self, obj):
         """
-        Get the most recent message in the conversation
+        Get the most recent message from the conversation summary
         """
-        last_message = obj.messages.order_by('-sent_at').first()
+        last_message = obj.last_message
         if last_message:
             return {
                 'message_body': last_message.message_body,
                 'sent_at': last_message.sent_at,
                 'sender': f"{last_message.sender.first_name} {last_message.sender.last_name}"
             }
-        return None
-    
-    def get_message_count(self, obj):
-        """
-        Get the total number of messages in the conversation
-        """
-        return obj.messages.count()
\ No newline at end of file
+        return None
\ No newline at end of file
@@ -0,0 +1,155 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import archive, directory, membership, realtime, tasks, tokens, versions
+from .models import User, Conversation, ConversationParticipant, Message
+
+
+@receiver(post_delete, sender=Message)
+def update_summary_on_delete(sender, instance, **kwargs):
+    """
+    Keep the conversation summary and unread counts in step with deleted
+    messages
+
+    Deletions go through the collector, which runs inside a transaction and
+    sends this signal for queryset and cascade deletes alike.
+    """
+    Conversation.objects.filter(
+        pk=instance.conversation_id
+    ).forget_message()
+    ConversationParticipant.objects.filter(
+        conversation_id=instance.conversation_id
+    ).exclude(user_id=instance.sender_id).forget_unread(instance)
+    versions.bump(conversation_ids=[instance.conversation_id])
+
+
+@receiver(post_save, sender=Message)
+def bump_version_on_save(sender, instance, **kwargs):
+    """
+    Invalidate conditional GETs of lists showing a created or edited message
+    """
+    versions.bump(conversation_ids=[instance.conversation_id])
+
+
+@receiver(post_save, sender=Message)
+def enqueue_side_effects_on_create(sender, instance, created, **kwargs):
+    """
+    Run the side effects of a new message on a worker after it commits
+    """
+    if created:
+        tasks.enqueue_messages([instance.pk])
+
+
+@receiver(post_save, sender=User)
+def forget_cached_user_on_save(sender, instance, **kwargs):
+    """
+    Make token authentication in this process see role and status changes
+    """
+    tokens.users.discard(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def index_user_on_save(sender, instance, created, update_fields, raw=False,
+                       **kwargs):
+    """
+    Keep the user directory search index in step with names and emails
+    """
+    if raw or (not created and update_fields and
+               not set(update_fields) & {'first_name', 'last_name', 'email'}):
+        return
+    directory.index_users([instance])
+
+
+@receiver(post_save, sender=User)
+def bump_versions_on_profile_change(sender, instance, created, update_fields,
+                                    **kwargs):
+    """
+    Invalidate conditional GETs of lists showing the user's profile
+    
+    New users are not in any conversation yet, and login only touches
+    last_login, which no list shows.
+    """
+    if created or (update_fields and set(update_fields) <= {'last_login'}):
+        return
+    versions.bump(conversation_ids=membership.get_conversation_ids(instance))
+
+
+@receiver(m2m_changed, sender=ConversationParticipant)
+def invalidate_membership_on_m2m_change(sender, instance, action, reverse,
+                                        pk_set, **kwargs):
+    """
+    Invalidate the membership cache of users added to or removed from a
+    conversation through the participants related managers, and start
+    the read state of added users
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # user.conversations.add(...) and friends: only this user changed
+        user_ids = [instance.pk]
+        if action == 'pre_clear':
+            conversation_ids = list(
+                instance.conversations.values_list('conversation_id', flat=True)
+            )
+        else:
+            conversation_ids = pk_set
+    else:
+        conversation_ids = [instance.pk]
+        if action == 'pre_clear':
+            user_ids = list(instance.participants.values_list('user_id', flat=True))
+        else:
+            user_ids = pk_set
+    if action == 'post_add':
+        ConversationParticipant.objects.filter(
+            conversation_id__in=conversation_ids, user_id__in=user_ids
+        ).start_at_latest()
+    membership.invalidate(user_ids)
+    # Removed users no longer show up as participants, so bump them too
+    versions.bump(conversation_ids=conversation_ids, user_ids=user_ids)
+
+
+@receiver(post_save, sender=ConversationParticipant)
+def start_read_state_on_create(sender, instance, created, raw=False, **kwargs):
+    """
+    Start a member added by writing a membership row with the history read
+    """
+    if created and not raw:
+        ConversationParticipant.objects.filter(pk=instance.pk).start_at_latest()
+
+
+@receiver(post_save, sender=ConversationParticipant)
+@receiver(post_delete, sender=ConversationParticipant)
+def invalidate_membership_on_row_change(sender, instance, **kwargs):
+    """
+    Invalidate the membership cache when a membership row is written directly,
+    as the admin inline and cascading deletes do
+    """
+    membership.invalidate([instance.user_id])
+    versions.bump(
+        conversation_ids=[instance.conversation_id], user_ids=[instance.user_id]
+    )
+
+
+@receiver(post_delete, sender=ConversationParticipant)
+def announce_departure_on_delete(sender, instance, **kwargs):
+    """
+    Unsubscribe the open sockets of a removed member once it commits
+
+    participants.remove() and clear() delete membership rows one by one
+    while this receiver is connected, so they end up here too.
+    """
+    transaction.on_commit(partial(
+        realtime.publish_departure, instance.user_id, instance.conversation_id
+    ))
+
+
+@receiver(post_delete, sender=Conversation)
+def delete_archive_segment(sender, instance, **kwargs):
+    """
+    Remove the archived history of a deleted conversation once it commits
+    """
+    if archive.is_enabled():
+        transaction.on_commit(partial(archive.delete_segment, instance.pk))
@@ -0,0 +1,116 @@
+"""
+Production tuning of SQLite connections
+
+Every new SQLite connection is configured from the CHATS_SQLITE profile:
+
+    CHATS_SQLITE = {
+        'JOURNAL_MODE': 'WAL',
+        'SYNCHRONOUS': 'NORMAL',
+        'BUSY_TIMEOUT': 5000,
+        'MMAP_SIZE': 256 * 1024 * 1024,
+        'CACHE_SIZE': -64 * 1024,
+        'TEMP_STORE': 'MEMORY',
+        'TRANSACTION_MODE': 'IMMEDIATE',
+        'OPTIMIZE_INTERVAL': 3600,
+    }
+
+Missing keys take these values and None, the default, disables the
+tuning; the project settings enable it with CHATS_SQLITE_TUNING=1. The
+journal mode is stored in the database file, so once a tuned connection
+switches a file to WAL, every later connection to it uses WAL too. In WAL
+mode readers no longer block on the writer. `synchronous=NORMAL` is
+durable there except against power loss. The busy timeout makes writers
+queue instead of failing with "database is locked". Immediate transactions
+take the write lock at BEGIN, since a deferred transaction upgrading its
+read lock fails at once, whatever the timeout. CACHE_SIZE follows
+SQLite's convention: negative values are KiB, positive ones are pages.
+
+`PRAGMA optimize` runs at most once per OPTIMIZE_INTERVAL seconds per
+database and process. It runs when a connection opens and when a request
+finishes with a persistent connection still open.
+"""
+import time
+
+from django.conf import settings
+from django.db import connections
+
+PROFILE = {
+    'JOURNAL_MODE': 'WAL',
+    'SYNCHRONOUS': 'NORMAL',
+    'BUSY_TIMEOUT': 5000,
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    'CACHE_SIZE': -64 * 1024,
+    'TEMP_STORE': 'MEMORY',
+    'TRANSACTION_MODE': 'IMMEDIATE',
+    'OPTIMIZE_INTERVAL': 3600,
+}
+
+# Monotonic time of the last PRAGMA optimize of each database file
+_optimized_at = {}
+
+
+def get_profile():
+    profile = getattr(settings, 'CHATS_SQLITE', None)
+    if profile is None:
+        return None
+    return {**PROFILE, **profile}
+
+
+def get_pragmas(profile, in_memory=False):
+    """
+    Return the PRAGMA statements applying `profile`, in order
+    """
+    # The busy timeout comes first so the other statements wait for locks
+    pragmas = [
+        f"PRAGMA busy_timeout = {int(profile['BUSY_TIMEOUT'])}",
+        f"PRAGMA synchronous = {profile['SYNCHRONOUS']}",
+        f"PRAGMA cache_size = {int(profile['CACHE_SIZE'])}",
+        f"PRAGMA temp_store = {profile['TEMP_STORE']}",
+    ]
+    if not in_memory:
+        # In-memory databases have neither a journal file nor a file to map
+        pragmas.insert(1, f"PRAGMA journal_mode = {profile['JOURNAL_MODE']}")
+        pragmas.append(f"PRAGMA mmap_size = {int(profile['MMAP_SIZE'])}")
+    return pragmas
+
+
+def optimize(connection, profile, force=False):
+    """
+    Run PRAGMA optimize on `connection` if its database is due
+    """
+    key = connection.settings_dict['NAME']
+    now = time.monotonic()
+    last = _optimized_at.get(key)
+    if not force and last is not None and now - last < profile['OPTIMIZE_INTERVAL']:
+        return False
+    # Concurrent threads may both run it; that only costs a little time
+    _optimized_at[key] = now
+    connection.connection.execute('PRAGMA optimize')
+    return True
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Apply the CHATS_SQLITE profile to a newly created connection
+    """
+    profile = get_profile()
+    if profile is None or connection.vendor != 'sqlite':
+        return
+    # Raw statements, so that tuning never shows up in captured queries
+    for pragma in get_pragmas(profile, connection.is_in_memory_db()):
+        connection.connection.execute(pragma)
+    if connection.transaction_mode is None and profile['TRANSACTION_MODE']:
+        connection.transaction_mode = profile['TRANSACTION_MODE'].upper()
+    optimize(connection, profile)
+
+
+def optimize_open_connections(**kwargs):
+    """
+    Optimize persistent connections that outlived the request
+    """
+    profile = get_profile()
+    if profile is None:
+        return
+    for connection in connections.all(initialized_only=True):
+        if connection.vendor == 'sqlite' and connection.connection is not None:
+            optimize(connection, profile)
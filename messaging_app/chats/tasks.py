@@ -0,0 +1,70 @@
+"""
+Celery tasks running the side effects of new messages off the request path
+
+Creating a message enqueues `process_messages` once its transaction
+commits, so a worker never looks for a row that is not there yet and a
+rolled back message has no side effects. The task calls every function
+named by CHATS_MESSAGE_SIDE_EFFECTS with the list of new messages:
+
+    CHATS_MESSAGE_SIDE_EFFECTS = [
+        'chats.notifications.queue_notifications',
+    ]
+
+Side effects are added there rather than to the views, so their cost
+never shows up in the latency of posting a message. They may run more
+than once if a worker dies mid-task and should be idempotent.
+"""
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import notifications
+from .models import Message
+from .routers import use_primary
+
+DEFAULT_SIDE_EFFECTS = [
+    'chats.notifications.queue_notifications',
+]
+
+
+def get_side_effects():
+    return [
+        import_string(path)
+        for path in getattr(settings, 'CHATS_MESSAGE_SIDE_EFFECTS', DEFAULT_SIDE_EFFECTS)
+    ]
+
+
+def enqueue_messages(message_ids):
+    """
+    Enqueue the side effects of new messages once the transaction commits
+    """
+    message_ids = [str(pk) for pk in message_ids]
+    if message_ids:
+        transaction.on_commit(lambda: process_messages.delay(message_ids))
+
+
+@shared_task(ignore_result=True)
+def process_messages(message_ids):
+    """
+    Run every configured side effect on the new messages in `message_ids`
+
+    Messages deleted in the meantime are skipped.
+    """
+    # The task may run before a read replica has the messages
+    with use_primary():
+        messages = list(Message.objects.filter(
+            pk__in=message_ids
+        ).select_related('sender').order_by('sent_at', 'message_id'))
+    if not messages:
+        return
+    for side_effect in get_side_effects():
+        side_effect(messages)
+
+
+@shared_task(ignore_result=True)
+def flush_notifications(user_id):
+    """
+    Send the user's pending notifications as one batch
+    """
+    notifications.flush(user_id)
@@ -1,3 +1,2257 @@
-from django.test import TestCase
+import json
+import pstats
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from messaging_app.celery import app as celery_app
+
+from . import (
+    archive, checks, directory, membership, notifications, realtime,
+    replication, routers, sequence, sqlite, tasks, timing, tokens, versions,
+)
+from .models import (
+    User, Conversation, ConversationParticipant, Message, ArchivedBlock,
+    PendingNotification, UserSearchToken,
+)
+from .pagination import SYNC_WATERMARK_SALT, EstimatedCountPaginator
+from .export import stream_export
+from .querybudget import (
+    QueryBudgetExceeded, QueryRecorder, assert_query_budget, fingerprint
+)
+from .realtime import websocket_application
+from .serializers import ConversationSerializer, MessageSerializer
+from .views import ConversationViewSet, MessageViewSet
+
+
+def make_user(email, first_name='Test', last_name='User'):
+    """Create a user with a usable password"""
+    return User.objects.create_user(
+        email=email, first_name=first_name, last_name=last_name,
+        password='password123'
+    )
+
+
+class MessageCursorPaginationTests(TestCase):
+    """Test keyset pagination of the message endpoints"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+
+        # Pairs of messages share a timestamp to exercise the tie-breaker
+        start = timezone.now() - timedelta(hours=1)
+        cls.messages = sorted(
+            Message.objects.bulk_create([
+                Message(
+                    sender=cls.alice,
+                    conversation=cls.conversation,
+                    message_body=f'message {i}',
+                    sent_at=start + timedelta(seconds=i // 2),
+                )
+                for i in range(25)
+            ]),
+            key=lambda m: (m.sent_at, m.message_id),
+        )
+        cls.url = f'/api/conversations/{cls.conversation.conversation_id}/messages/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def collect(self, url, params=None, link='next'):
+        """Follow pagination links and return every page of message ids"""
+        pages = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append([m['message_id'] for m in response.data['results']])
+            if not response.data[link]:
+                return pages
+            response = self.client.get(response.data[link])
+
+    def test_forward_walk_returns_every_message_once(self):
+        """Following next links yields all messages in keyset order"""
+        pages = self.collect(self.url, {'page_size': 10})
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        flat = [message_id for page in pages for message_id in page]
+        self.assertEqual(flat, [str(m.message_id) for m in self.messages])
+
+    def test_backward_walk_mirrors_forward_walk(self):
+        """Following previous links from the last page walks back to the start"""
+        response = self.client.get(self.url, {'page_size': 10})
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+
+        pages = self.collect(response.data['previous'], link='previous')
+        flat = [message_id for page in reversed(pages) for message_id in page]
+        expected = [str(m.message_id) for m in self.messages[:20]]
+        self.assertEqual(flat, expected)
+
+    def test_top_level_route_uses_cursor_pagination(self):
+        """The /api/messages/ route also pages by cursor without a count"""
+        response = self.client.get('/api/messages/', {'page_size': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('count', response.data)
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertIsNone(response.data['previous'])
+
+    def test_invalid_cursor_is_rejected(self):
+        """A malformed cursor returns 404 instead of a server error"""
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ConversationListQueryTests(TestCase):
+    """Test that listing conversations runs a fixed number of queries"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice', 'Smith')
+        cls.bob = make_user('bob@example.com', 'Bob', 'Jones')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def create_conversations(self, count, messages_each=3):
+        """Create conversations between alice and bob with a few messages"""
+        start = timezone.now() - timedelta(days=1)
+        for i in range(count):
+            conversation = Conversation.objects.create()
+            conversation.participants.set([self.alice, self.bob])
+            Message.objects.bulk_create([
+                Message(
+                    sender=self.bob,
+                    conversation=conversation,
+                    message_body=f'conversation {i} message {j}',
+                    sent_at=start + timedelta(minutes=i * 10 + j),
+                )
+                for j in range(messages_each)
+            ])
+        # bulk_create bypasses save(), so rebuild the summaries afterwards
+        Conversation.objects.refresh_summaries()
+
+    def test_query_count_is_independent_of_page_size(self):
+        """Count, list and participants prefetch regardless of page size"""
+        self.create_conversations(2)
+        with self.assertNumQueries(3):
+            small = self.client.get('/api/conversations/')
+        self.create_conversations(18)
+        with self.assertNumQueries(3):
+            large = self.client.get('/api/conversations/')
+        self.assertEqual(len(small.data['results']), 2)
+        self.assertEqual(len(large.data['results']), 20)
+
+    def test_last_message_and_count_are_annotated(self):
+        """The summary matches the newest message and the message total"""
+        self.create_conversations(1, messages_each=4)
+        response = self.client.get('/api/conversations/')
+        summary = response.data['results'][0]
+        self.assertEqual(summary['message_count'], 4)
+        self.assertEqual(summary['last_message']['message_body'],
+                         'conversation 0 message 3')
+        self.assertEqual(summary['last_message']['sender'], 'Bob Jones')
+
+    def test_empty_conversation_has_no_last_message(self):
+        """A conversation without messages reports none and a zero count"""
+        self.create_conversations(1, messages_each=0)
+        summary = self.client.get('/api/conversations/').data['results'][0]
+        self.assertIsNone(summary['last_message'])
+        self.assertEqual(summary['message_count'], 0)
+
+
+class ConversationSummaryTests(TestCase):
+    """Test the denormalized conversation activity summary"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+        self.start = timezone.now() - timedelta(hours=1)
+
+    def send(self, body, minutes):
+        """Save a message sent `minutes` after the start time"""
+        return Message.objects.create(
+            sender=self.alice, conversation=self.conversation,
+            message_body=body, sent_at=self.start + timedelta(minutes=minutes)
+        )
+
+    def test_insert_updates_summary(self):
+        """Saving messages counts them and tracks the newest one"""
+        self.send('first', 1)
+        newest = self.send('second', 5)
+        self.send('backfilled', 3)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 3)
+        self.assertEqual(self.conversation.last_message, newest)
+        self.assertEqual(self.conversation.last_activity_at, newest.sent_at)
+
+    def test_delete_updates_summary(self):
+        """Deleting the newest message falls back to the previous one"""
+        first = self.send('first', 1)
+        self.send('second', 5).delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 1)
+        self.assertEqual(self.conversation.last_message, first)
+
+        Message.objects.filter(conversation=self.conversation).delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 0)
+        self.assertIsNone(self.conversation.last_message)
+        self.assertEqual(self.conversation.last_activity_at,
+                         self.conversation.created_at)
+
+    def test_inbox_is_ordered_by_last_activity(self):
+        """The conversation list puts the most recently active first"""
+        older = Conversation.objects.create()
+        older.participants.set([self.alice, self.bob])
+        Message.objects.create(
+            sender=self.bob, conversation=older, message_body='old',
+            sent_at=self.start
+        )
+        self.send('recent', 30)
+
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        results = client.get('/api/conversations/').data['results']
+        self.assertEqual(
+            [c['conversation_id'] for c in results],
+            [str(self.conversation.conversation_id), str(older.conversation_id)]
+        )
+
+    def test_rebuild_command_recomputes_summaries(self):
+        """The rebuild command fixes summaries of bulk inserted messages"""
+        Message.objects.bulk_create([
+            Message(sender=self.bob, conversation=self.conversation,
+                    message_body=f'bulk {i}',
+                    sent_at=self.start + timedelta(minutes=i))
+            for i in range(5)
+        ])
+        call_command('rebuild_conversation_summaries', chunk_size=1,
+                     stdout=StringIO())
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 5)
+        self.assertEqual(self.conversation.last_message.message_body, 'bulk 4')
+
+
+class ReadStateTests(TestCase):
+    """Test read watermarks and the maintained unread counts"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.carol = make_user('carol@example.com', 'Carol')
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+        self.start = timezone.now() - timedelta(hours=1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, sender, minutes, body='hello'):
+        """Save a message sent `minutes` after the start time"""
+        return Message.objects.create(
+            sender=sender, conversation=self.conversation,
+            message_body=body, sent_at=self.start + timedelta(minutes=minutes)
+        )
+
+    def unread(self, user):
+        return ConversationParticipant.objects.get(
+            conversation=self.conversation, user=user
+        ).unread_count
+
+    def mark_read(self, message=None):
+        data = {} if message is None else {'message_id': str(message.pk)}
+        return self.client.post(
+            f'/api/conversations/{self.conversation.pk}/mark_read/', data,
+            format='json'
+        )
+
+    def test_messages_of_others_are_unread(self):
+        """New messages count for everyone but their sender"""
+        self.send(self.bob, 1)
+        self.send(self.bob, 2)
+        self.send(self.alice, 3)
+        self.assertEqual(self.unread(self.alice), 2)
+        self.assertEqual(self.unread(self.bob), 1)
+
+    def test_list_shows_unread_count_without_counting(self):
+        """The conversation list reads the counter in its usual queries"""
+        self.send(self.bob, 1)
+        self.send(self.bob, 2)
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/api/conversations/')
+        self.assertEqual(len(captured), 3)
+        self.assertNotIn('COUNT(', captured[1]['sql'].upper())
+        self.assertEqual(response.data['results'][0]['unread_count'], 2)
+
+    def test_mark_read_defaults_to_newest_message(self):
+        """Marking read without a message reads everything"""
+        self.send(self.bob, 1)
+        newest = self.send(self.bob, 2)
+        etag = self.client.get('/api/conversations/')['ETag']
+        response = self.mark_read()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unread_count'], 0)
+        self.assertEqual(response.data['last_read_message_id'], newest.pk)
+        self.assertEqual(response.data['last_read_at'], newest.sent_at)
+        # The list of the reader changed
+        listing = self.client.get('/api/conversations/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(listing.status_code, 200)
+        self.assertEqual(listing.data['results'][0]['unread_count'], 0)
+
+    def test_mark_read_up_to_message_only_moves_forward(self):
+        """Reading up to a message leaves later ones unread, never fewer"""
+        first = self.send(self.bob, 1)
+        second = self.send(self.bob, 2)
+        self.send(self.bob, 3)
+        self.send(self.alice, 4)
+        self.assertEqual(self.mark_read(second).data['unread_count'], 1)
+        response = self.mark_read(first)
+        self.assertEqual(response.data['last_read_message_id'], second.pk)
+        self.assertEqual(response.data['unread_count'], 1)
+
+    def test_mark_read_errors(self):
+        """Outsiders are refused and unknown messages are not found"""
+        self.assertEqual(
+            self.client.post(
+                f'/api/conversations/{self.conversation.pk}/mark_read/',
+                {'message_id': 'nope'}, format='json'
+            ).status_code, 400
+        )
+        self.assertEqual(self.mark_read(Message(message_id=uuid.uuid4())).status_code, 404)
+        self.client.force_authenticate(self.carol)
+        self.assertEqual(self.mark_read().status_code, 403)
+
+    def test_deleting_unread_message_uncounts_it(self):
+        """Only members who had not read a deleted message lose a count"""
+        read = self.send(self.bob, 1)
+        unread = self.send(self.bob, 2)
+        self.mark_read(read)
+        read.delete()
+        self.assertEqual(self.unread(self.alice), 1)
+        unread.delete()
+        self.assertEqual(self.unread(self.alice), 0)
+
+    def test_new_member_starts_with_history_read(self):
+        """Joining a conversation does not make its history unread"""
+        newest = self.send(self.bob, 1)
+        self.conversation.participants.add(self.carol)
+        membership = ConversationParticipant.objects.get(
+            conversation=self.conversation, user=self.carol
+        )
+        self.assertEqual(membership.last_read_message_id, newest.pk)
+        self.assertEqual(membership.unread_count, 0)
+        self.send(self.bob, 2)
+        self.assertEqual(self.unread(self.carol), 1)
+
+    def test_bulk_messages_are_counted(self):
+        """Bulk inserts count, and backdated ones only after the watermark"""
+        self.mark_read(self.send(self.alice, 30))
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        url = f'/api/conversations/{self.conversation.pk}/messages/bulk/'
+        response = client.post(url, [{'message_body': 'new'}] * 3, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.unread(self.alice), 3)
+        response = client.post(url, [
+            {'message_body': 'old', 'sent_at': (self.start + timedelta(minutes=1)).isoformat()},
+            {'message_body': 'new'},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.unread(self.alice), 4)
+
+    def test_rebuild_command_recounts_unread(self):
+        """The rebuild command agrees with the maintained counts"""
+        self.mark_read(self.send(self.bob, 1))
+        self.send(self.bob, 2)
+        self.send(self.alice, 3)
+        maintained = {user: self.unread(user) for user in (self.alice, self.bob)}
+        ConversationParticipant.objects.update(unread_count=0)
+        call_command('rebuild_conversation_summaries', stdout=StringIO())
+        self.assertEqual(
+            {user: self.unread(user) for user in (self.alice, self.bob)},
+            maintained
+        )
+
+
+class SchemaIndexTests(TestCase):
+    """Test the indexes serving the chats hot queries"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def indexes(self, table):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+        return [
+            tuple(info['columns']) for info in constraints.values()
+            if info['index'] or info['unique'] or info['primary_key']
+        ]
+
+    def test_conversation_history_is_read_in_index_order(self):
+        """Messages of a conversation come sorted from one index"""
+        plan = self.plan(Message.objects.filter(
+            conversation=self.conversation
+        ).order_by('sent_at', 'message_id')[:20])
+        self.assertEqual(len(plan), 1)
+        self.assertIn('USING INDEX', plan[0])
+        self.assertIn('conversation_id=?', plan[0])
+        self.assertNotIn('TEMP B-TREE', ' '.join(plan))
+
+    def test_conversations_of_user_use_membership_index(self):
+        """Memberships of a user are found from the (user, conversation) index"""
+        plan = self.plan(Conversation.objects.filter(participants=self.alice))
+        membership = next(row for row in plan if 'conversations_participants' in row)
+        self.assertIn('COVERING INDEX', membership)
+        self.assertIn('user_id=?', membership)
+
+    def test_indexes_are_not_duplicated(self):
+        """No index repeats the columns of another, nor is a prefix of one"""
+        for table in ('users', 'conversations', 'conversations_participants', 'messages'):
+            with self.subTest(table=table):
+                indexes = self.indexes(table)
+                self.assertEqual(len(indexes), len(set(indexes)), indexes)
+                for columns in indexes:
+                    longer = [
+                        other for other in indexes
+                        if len(other) > len(columns) and other[:len(columns)] == columns
+                    ]
+                    self.assertEqual(longer, [], columns)
+        self.assertIn(('user_id', 'conversation_id'), self.indexes('conversations_participants'))
+        self.assertIn(
+            ('conversation_id', 'sent_at', 'message_id'), self.indexes('messages')
+        )
+
+    def test_participants_go_through_membership_rows(self):
+        """Adding a participant creates one membership row, and only one"""
+        carol = make_user('carol@example.com', 'Carol')
+        self.conversation.participants.add(carol)
+        self.conversation.participants.add(carol)
+        self.assertEqual(
+            ConversationParticipant.objects.filter(
+                conversation=self.conversation, user=carol
+            ).count(),
+            1
+        )
+        self.assertIn(self.conversation, carol.conversations.all())
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ConversationParticipant.objects.create(
+                conversation=self.conversation, user=carol
+            )
+
+
+class BulkMessageTests(TestCase):
+    """Test the bulk message ingestion endpoint"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.eve = make_user('eve@example.com', 'Eve')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+        cls.url = (
+            f'/api/conversations/{cls.conversation.conversation_id}/messages/bulk/'
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_bulk_create_in_submitted_order(self):
+        """10k messages are created in one request and keep their order"""
+        payload = [{'message_body': f'replayed {i}'} for i in range(10000)]
+        response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['message_ids']), 10000)
+
+        bodies = list(Message.objects.filter(
+            conversation=self.conversation
+        ).order_by('sent_at', 'message_id').values_list('message_body', flat=True))
+        self.assertEqual(bodies, [item['message_body'] for item in payload])
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 10000)
+        self.assertEqual(self.conversation.last_message.message_body, 'replayed 9999')
+
+    def test_query_count_does_not_grow_per_message(self):
+        """Inserts are batched into multi-row statements"""
+        payload = [{'message_body': f'm {i}'} for i in range(2000)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, 201)
+        inserts = [
+            query for query in queries
+            if query['sql'].startswith('INSERT INTO "messages"')
+        ]
+        # As many rows per statement as SQLite's parameter limit allows
+        batch_size = connection.ops.bulk_batch_size(
+            [field for field in Message._meta.concrete_fields], []
+        )
+        chunk_size = MessageViewSet.bulk_chunk_size
+        self.assertEqual(
+            len(inserts), (2000 // chunk_size) * -(-chunk_size // batch_size)
+        )
+        self.assertLess(len(queries) - len(inserts), 10)
+
+    def test_invalid_item_rolls_back_everything(self):
+        """A bad message in a later chunk leaves nothing behind"""
+        payload = [{'message_body': f'm {i}'} for i in range(1500)]
+        payload[1200] = {'message_body': ''}
+        response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(1200, response.data['errors'])
+        self.assertFalse(Message.objects.exists())
+
+    def test_non_participant_is_forbidden(self):
+        """Users outside the conversation cannot bulk post into it"""
+        self.client.force_authenticate(self.eve)
+        response = self.client.post(
+            self.url, [{'message_body': 'hello'}], format='json'
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_too_many_messages_are_rejected(self):
+        """Requests above the per-request limit are refused up front"""
+        payload = [{'message_body': 'x'}] * 10001
+        response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_future_sent_at_is_rejected(self):
+        """A message dated in the future fails the whole batch"""
+        payload = [
+            {'message_body': 'now'},
+            {'message_body': 'later', 'sent_at': (
+                timezone.now() + timedelta(minutes=5)
+            ).isoformat()},
+        ]
+        response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(1, response.data['errors'])
+        self.assertFalse(Message.objects.exists())
+
+    def test_default_sent_at_is_not_in_the_future(self):
+        """Undated messages are stamped at or before the request time"""
+        payload = [{'message_body': f'm {i}'} for i in range(100)]
+        response = self.client.post(self.url, payload, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(Message.objects.filter(sent_at__gt=timezone.now()).exists())
+
+    def test_messages_are_published_once_committed(self):
+        """Every bulk message is pushed to the conversation's sockets"""
+        payload = [{'message_body': f'm {i}'} for i in range(1500)]
+        with mock.patch('chats.realtime.get_backend') as get_backend:
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.post(self.url, payload, format='json')
+            self.assertEqual(response.status_code, 201)
+            get_backend.return_value.publish.assert_not_called()
+            for callback in callbacks:
+                callback()
+        published = get_backend.return_value.publish.call_args_list
+        self.assertEqual(len(published), 1500)
+        self.assertEqual(
+            {call.args[0] for call in published},
+            {f'conversation:{self.conversation.conversation_id}'}
+        )
+        events = [json.loads(call.args[1]) for call in published]
+        self.assertEqual(
+            [event['message']['message_body'] for event in events],
+            [item['message_body'] for item in payload]
+        )
+        self.assertEqual(
+            [event['message']['message_id'] for event in events],
+            [str(pk) for pk in response.data['message_ids']]
+        )
+
+
+class RealtimeDeliveryTests(TestCase):
+    """Test WebSocket delivery of new messages"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.eve = make_user('eve@example.com', 'Eve')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+
+    def session_cookie(self, user):
+        """Log the user in and return the session cookie header"""
+        self.client.force_login(user)
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        return (b'cookie', f'sessionid={session_key}'.encode())
+
+    async def connect(self, user=None, path='/ws/messages/', origin=None):
+        """Return a communicator for a socket carrying the user's session"""
+        headers = []
+        if user is not None:
+            headers.append(await sync_to_async(self.session_cookie)(user))
+        if origin is not None:
+            headers.append((b'origin', origin.encode()))
+        return ApplicationCommunicator(websocket_application, {
+            'type': 'websocket', 'path': path, 'headers': headers,
+        })
+
+    def post_message(self, user, conversation, body):
+        """Create a message through the API and run on-commit hooks"""
+        client = APIClient()
+        client.force_authenticate(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            return client.post(
+                f'/api/conversations/{conversation.conversation_id}/messages/',
+                {'message_body': body}, format='json'
+            )
+
+    async def test_participant_receives_new_message(self):
+        """A created message is pushed to the other participant's socket"""
+        socket = await self.connect(self.bob)
+        await socket.send_input({'type': 'websocket.connect'})
+        self.assertEqual(
+            (await socket.receive_output(1))['type'], 'websocket.accept'
+        )
+
+        response = await sync_to_async(self.post_message)(
+            self.alice, self.conversation, 'hello bob'
+        )
+        self.assertEqual(response.status_code, 201)
+
+        event = json.loads((await socket.receive_output(1))['text'])
+        self.assertEqual(event['type'], 'message.created')
+        self.assertEqual(event['message']['message_body'], 'hello bob')
+
+        await socket.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await socket.wait(1)
+
+    async def test_new_member_is_subscribed_after_joining(self):
+        """add_participant subscribes the new member's open sockets"""
+        socket = await self.connect(self.eve)
+        await socket.send_input({'type': 'websocket.connect'})
+        await socket.receive_output(1)
+
+        def add_eve():
+            client = APIClient()
+            client.force_authenticate(self.alice)
+            with self.captureOnCommitCallbacks(execute=True):
+                client.post(
+                    f'/api/conversations/{self.conversation.conversation_id}'
+                    '/add_participant/',
+                    {'user_id': str(self.eve.user_id)}, format='json'
+                )
+        await sync_to_async(add_eve)()
+        joined = json.loads((await socket.receive_output(1))['text'])
+        self.assertEqual(joined['type'], 'conversation.joined')
+
+        await sync_to_async(self.post_message)(
+            self.bob, self.conversation, 'welcome eve'
+        )
+        event = json.loads((await socket.receive_output(1))['text'])
+        self.assertEqual(event['message']['message_body'], 'welcome eve')
+
+        await socket.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await socket.wait(1)
+
+    def test_publish_failure_does_not_fail_committed_message(self):
+        """A pub/sub outage is logged, the created message is still returned"""
+        with mock.patch('chats.realtime.get_backend') as get_backend:
+            get_backend.return_value.publish.side_effect = ConnectionError
+            with self.assertLogs('chats.realtime', 'ERROR'):
+                response = self.post_message(self.alice, self.conversation, 'hi')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Message.objects.filter(message_body='hi').exists())
+
+    async def test_anonymous_socket_is_closed(self):
+        """Connections without a session are rejected"""
+        socket = await self.connect()
+        await socket.send_input({'type': 'websocket.connect'})
+        event = await socket.receive_output(1)
+        self.assertEqual(event, {'type': 'websocket.close', 'code': 4401})
+
+    async def test_cross_site_origin_is_refused(self):
+        """A page on another site cannot open a socket with the user's cookie"""
+        socket = await self.connect(self.bob, origin='https://evil.example')
+        await socket.send_input({'type': 'websocket.connect'})
+        event = await socket.receive_output(1)
+        self.assertEqual(event, {'type': 'websocket.close', 'code': 4403})
+
+    async def test_allowed_origins_are_accepted(self):
+        """Origins of ALLOWED_HOSTS and CORS_ALLOWED_ORIGINS may connect"""
+        for origin in ('http://localhost:8000', 'http://localhost:3000'):
+            with self.subTest(origin=origin):
+                socket = await self.connect(self.bob, origin=origin)
+                await socket.send_input({'type': 'websocket.connect'})
+                self.assertEqual(
+                    (await socket.receive_output(1))['type'], 'websocket.accept'
+                )
+                await socket.send_input({'type': 'websocket.disconnect', 'code': 1000})
+                await socket.wait(1)
+
+    async def test_removed_member_is_unsubscribed(self):
+        """A member removed from a conversation stops receiving its messages"""
+        socket = await self.connect(self.bob)
+        await socket.send_input({'type': 'websocket.connect'})
+        await socket.receive_output(1)
+
+        def remove_bob():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.conversation.participants.remove(self.bob)
+        await sync_to_async(remove_bob)()
+        left = json.loads((await socket.receive_output(1))['text'])
+        self.assertEqual(left, {
+            'type': 'conversation.left',
+            'conversation_id': str(self.conversation.conversation_id),
+        })
+
+        def post_directly():
+            with self.captureOnCommitCallbacks(execute=True):
+                message = Message.objects.create(
+                    sender=self.alice, conversation=self.conversation,
+                    message_body='bob is gone'
+                )
+                transaction.on_commit(lambda: realtime.publish_message(message))
+        await sync_to_async(post_directly)()
+        self.assertTrue(await socket.receive_nothing(0.2))
+
+        await socket.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await socket.wait(1)
+
+
+class MessageSyncTests(TestCase):
+    """Test the incremental sync endpoint"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.eve = make_user('eve@example.com', 'Eve')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+        cls.private = Conversation.objects.create()
+        cls.private.participants.set([cls.bob, cls.eve])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def sync(self, **params):
+        response = self.client.get('/api/messages/sync/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_returns_only_new_messages_of_own_conversations(self):
+        """Messages after the watermark in the user's conversations are returned"""
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='before')
+        watermark = self.sync()['watermark']
+
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='after')
+        Message.objects.create(sender=self.bob, conversation=self.private,
+                               message_body='not for alice')
+
+        data = self.sync(since=watermark)
+        self.assertEqual([m['message_body'] for m in data['results']], ['after'])
+        self.assertEqual(self.sync(since=data['watermark'])['results'], [])
+
+    def test_limit_sets_has_more(self):
+        """Large backlogs are returned in limited batches"""
+        watermark = self.sync()['watermark']
+        for i in range(5):
+            Message.objects.create(sender=self.bob, conversation=self.conversation,
+                                   message_body=f'm {i}')
+        first = self.sync(since=watermark, limit=3)
+        self.assertTrue(first['has_more'])
+        second = self.sync(since=first['watermark'], limit=3)
+        self.assertFalse(second['has_more'])
+        bodies = [m['message_body'] for m in first['results'] + second['results']]
+        self.assertEqual(bodies, [f'm {i}' for i in range(5)])
+
+    def test_watermark_is_bound_to_user(self):
+        """A watermark issued to another user is rejected"""
+        watermark = self.sync()['watermark']
+        self.client.force_authenticate(self.bob)
+        response = self.client.get('/api/messages/sync/', {'since': watermark})
+        self.assertEqual(response.status_code, 400)
+
+    def test_long_poll_times_out_empty(self):
+        """Without new data the request returns after the wait expires"""
+        watermark = self.sync()['watermark']
+        started = time.monotonic()
+        data = self.sync(since=watermark, wait=0.2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(data['results'], [])
+        self.assertEqual(data['watermark'], watermark)
+
+
+    def test_late_commit_with_earlier_sent_at_is_not_skipped(self):
+        """A message committed after a sync is returned even if dated before it"""
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='first')
+        watermark = self.sync(since=self.sync()['watermark'])['watermark']
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='stamped earlier, committed later',
+                               sent_at=timezone.now() - timedelta(minutes=5))
+        data = self.sync(since=watermark)
+        self.assertEqual(
+            [m['message_body'] for m in data['results']],
+            ['stamped earlier, committed later']
+        )
+
+    def test_sequence_follows_insertion_order(self):
+        """Every write path numbers messages in the order they are written"""
+        first = Message.objects.create(
+            sender=self.bob, conversation=self.conversation, message_body='a'
+        )
+        Message.objects.bulk_create([
+            Message(sender=self.bob, conversation=self.conversation,
+                    message_body=body, sent_at=timezone.now() - timedelta(days=1))
+            for body in ('b', 'c')
+        ])
+        self.assertEqual(
+            list(Message.objects.order_by('sequence').values_list(
+                'message_body', flat=True
+            )),
+            ['a', 'b', 'c']
+        )
+        first.refresh_from_db()
+        self.assertEqual(
+            list(Message.objects.order_by('sequence').values_list('sequence', flat=True)),
+            [first.sequence, first.sequence + 1, first.sequence + 2]
+        )
+
+    def test_sequences_are_not_reused_after_deletes(self):
+        """Deleting the newest message does not hand its sequence out again"""
+        newest = Message.objects.create(
+            sender=self.bob, conversation=self.conversation, message_body='deleted'
+        )
+        newest.refresh_from_db()
+        watermark = self.sync()['watermark']
+        newest.delete()
+        message = Message.objects.create(
+            sender=self.bob, conversation=self.conversation, message_body='next'
+        )
+        message.refresh_from_db()
+        self.assertGreater(message.sequence, newest.sequence)
+        data = self.sync(since=watermark)
+        self.assertEqual([m['message_body'] for m in data['results']], ['next'])
+
+    def test_other_databases_are_refused(self):
+        """Sync is rejected by a system check where no trigger numbers messages"""
+        self.assertEqual(checks.check_message_sequences(), [])
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            errors = checks.check_message_sequences()
+        self.assertEqual([error.id for error in errors], ['chats.E001'])
+
+    def test_missing_trigger_is_reinstalled(self):
+        """The post_migrate hook restores a trigger dropped by a table rebuild"""
+        with connection.cursor() as cursor:
+            cursor.execute(sequence.DROP_TRIGGER)
+        self.assertFalse(sequence.trigger_installed())
+        sequence.ensure_trigger()
+        self.assertTrue(sequence.trigger_installed())
+        message = Message.objects.create(
+            sender=self.bob, conversation=self.conversation, message_body='x'
+        )
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sequence)
+
+    def test_legacy_watermark_resumes_after_its_cursor(self):
+        """Watermarks holding a (sent_at, message_id) cursor still work"""
+        before = Message.objects.create(
+            sender=self.bob, conversation=self.conversation, message_body='before'
+        )
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='after')
+        watermark = signing.Signer(salt=SYNC_WATERMARK_SALT).sign_object({
+            'u': str(self.alice.pk),
+            's': before.sent_at.isoformat(),
+            'm': before.message_id.hex,
+        })
+        data = self.sync(since=watermark)
+        self.assertEqual([m['message_body'] for m in data['results']], ['after'])
+
+
+class MessageSyncLongPollTests(TransactionTestCase):
+    """Test that a long-polling sync request wakes up on a new message"""
+
+    def test_long_poll_wakes_on_commit(self):
+        """A message posted by another thread ends the wait early"""
+        alice = make_user('alice@example.com', 'Alice')
+        bob = make_user('bob@example.com', 'Bob')
+        conversation = Conversation.objects.create()
+        conversation.participants.set([alice, bob])
+
+        client = APIClient()
+        client.force_authenticate(alice)
+        watermark = client.get('/api/messages/sync/').data['watermark']
+
+        def post_later():
+            time.sleep(0.3)
+            poster = APIClient()
+            poster.force_authenticate(bob)
+            poster.post(
+                f'/api/conversations/{conversation.conversation_id}/messages/',
+                {'message_body': 'wake up'}, format='json'
+            )
+
+        thread = threading.Thread(target=post_later)
+        thread.start()
+        started = time.monotonic()
+        data = client.get('/api/messages/sync/', {'since': watermark, 'wait': 10}).data
+        thread.join()
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([m['message_body'] for m in data['results']], ['wake up'])
+
+
+class MessageSearchTests(TestCase):
+    """Test full-text message search"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.eve = make_user('eve@example.com', 'Eve')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+        cls.private = Conversation.objects.create()
+        cls.private.participants.set([cls.bob, cls.eve])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def search(self, **params):
+        response = self.client.get('/api/messages/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data['results']
+
+    def test_ranked_results_with_snippets(self):
+        """Better matches rank first and carry a highlighted snippet"""
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='lunch tomorrow?')
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='lunch lunch lunch, seriously lunch')
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='nothing relevant')
+        results = self.search(q='lunch')
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['message_body'],
+                         'lunch lunch lunch, seriously lunch')
+        self.assertIn('[lunch]', results[1]['snippet'])
+
+    def test_only_own_conversations_are_searched(self):
+        """Messages of conversations the user is not in are never returned"""
+        Message.objects.create(sender=self.bob, conversation=self.private,
+                               message_body='secret plans')
+        self.assertEqual(self.search(q='secret'), [])
+
+    def test_prefix_match_and_special_characters(self):
+        """The last word matches as a prefix and query syntax is neutralized"""
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='see you at the conference')
+        self.assertEqual(len(self.search(q='confer')), 1)
+        self.assertEqual(self.search(q='"conference" OR NEAR('), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        """Edited and deleted messages are reflected in results"""
+        message = Message.objects.create(
+            sender=self.bob, conversation=self.conversation, message_body='apples'
+        )
+        message.message_body = 'oranges'
+        message.save()
+        self.assertEqual(self.search(q='apples'), [])
+        self.assertEqual(len(self.search(q='oranges')), 1)
+        message.delete()
+        self.assertEqual(self.search(q='oranges'), [])
+
+    def test_reindex_command_restores_missing_rows(self):
+        """The reindex command rebuilds the index from messages"""
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='rebuild me')
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM messages_fts')
+        self.assertEqual(self.search(q='rebuild'), [])
+        call_command('reindex_message_search', stdout=StringIO())
+        self.assertEqual(len(self.search(q='rebuild')), 1)
+
+    def test_results_survive_renumbered_rowids(self):
+        """Index rows stay tied to their message when VACUUM renumbers rowids"""
+        first = Message.objects.create(sender=self.bob, conversation=self.conversation,
+                                       message_body='first apple')
+        Message.objects.create(sender=self.bob, conversation=self.conversation,
+                               message_body='second pear')
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE messages SET rowid = rowid + 1000')
+            cursor.execute(
+                'UPDATE messages SET rowid = rowid - 999 WHERE message_id = %s',
+                [first.pk.hex],
+            )
+        results = self.search(q='apple')
+        self.assertEqual([r['message_id'] for r in results], [str(first.pk)])
+        first.delete()
+        self.assertEqual(self.search(q='apple'), [])
+        self.assertEqual(len(self.search(q='pear')), 1)
+
+
+class MembershipCacheTests(TestCase):
+    """Test the per-user conversation membership cache"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.eve = make_user('eve@example.com', 'Eve')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+
+    def setUp(self):
+        membership.get_cache().clear()
+        membership.stats.reset()
+        self.client = APIClient()
+        self.url = f'/api/conversations/{self.conversation.conversation_id}/messages/'
+
+    def test_repeated_checks_hit_the_cache(self):
+        """Only the first check of a user queries the membership table"""
+        self.client.force_authenticate(self.alice)
+        self.client.get(self.url)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(membership.stats.hits, 1)
+        self.assertEqual(membership.stats.misses, 1)
+        self.assertEqual(membership.stats.hit_rate, 0.5)
+
+    def test_add_participant_invalidates_new_member(self):
+        """A newly added user is allowed in right away"""
+        self.client.force_authenticate(self.eve)
+        self.assertEqual(self.client.post(
+            self.url, {'message_body': 'hi'}, format='json'
+        ).status_code, 403)
+
+        self.client.force_authenticate(self.alice)
+        self.client.post(
+            f'/api/conversations/{self.conversation.conversation_id}/add_participant/',
+            {'user_id': str(self.eve.user_id)}, format='json'
+        )
+
+        self.client.force_authenticate(self.eve)
+        self.assertEqual(self.client.post(
+            self.url, {'message_body': 'hi'}, format='json'
+        ).status_code, 201)
+        self.assertGreaterEqual(membership.stats.invalidations, 1)
+
+    def test_conversation_creation_invalidates_participants(self):
+        """Creating a conversation makes it visible to every participant"""
+        self.client.force_authenticate(self.eve)
+        self.assertEqual(membership.get_conversation_ids(self.eve), frozenset())
+
+        response = self.client.post('/api/conversations/', {
+            'participant_ids': [str(self.bob.user_id)]
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        conversation_id = uuid.UUID(response.data['conversation_id'])
+        self.assertIn(conversation_id, membership.get_conversation_ids(self.eve))
+        self.assertIn(conversation_id, membership.get_conversation_ids(self.bob))
+
+    def test_removed_participant_loses_access(self):
+        """Deleting a membership row drops the cached membership"""
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        ConversationParticipant.objects.filter(
+            conversation=self.conversation, user=self.bob
+        ).delete()
+        self.assertFalse(membership.is_participant(self.bob, self.conversation.pk))
+
+    def test_process_local_membership_is_refused_outside_debug(self):
+        """Only a shared membership cache is accepted without DEBUG"""
+        with self.settings(DEBUG=False):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'CHATS_MEMBERSHIP_CACHE'):
+                checks.require_shared_cache(membership.get_cache_alias(),
+                                            'CHATS_MEMBERSHIP_CACHE')
+
+
+class RowSerializerTests(TestCase):
+    """Test the values_list() fast path of the message list endpoints"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = User.objects.create_user(
+            email='bob@example.com', first_name='Bob', last_name='Émile',
+            password='password123', phone_number='+254700000000', role='host'
+        )
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+        start = timezone.now() - timedelta(hours=1)
+        for i, sender in enumerate([cls.alice, cls.bob, cls.alice]):
+            Message.objects.create(
+                sender=sender, conversation=cls.conversation,
+                message_body=f'"quoted" ünïcode {i}\n',
+                sent_at=start + timedelta(minutes=i, microseconds=i * 7),
+            )
+
+    def test_output_renders_to_identical_json(self):
+        """Compiled rows render to the same bytes as MessageSerializer"""
+        row_serializer = MessageViewSet.row_serializer
+        queryset = Message.objects.order_by('sent_at', 'message_id')
+        expected = MessageSerializer(
+            queryset.select_related('sender'), many=True
+        ).data
+        actual = row_serializer.serialize(row_serializer.values_list(queryset))
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(actual), renderer.render(expected))
+        with self.settings(TIME_ZONE='Africa/Nairobi'):
+            self.assertEqual(
+                renderer.render(row_serializer.serialize(
+                    row_serializer.values_list(queryset)
+                )),
+                renderer.render(MessageSerializer(queryset, many=True).data),
+            )
+
+    def test_list_endpoints_use_a_single_query(self):
+        """Nested list and by_conversation each issue one SQL query"""
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        conversation_id = self.conversation.conversation_id
+        client.get('/api/messages/by_conversation/', {'conversation_id': conversation_id})
+        for url, params in [
+            (f'/api/conversations/{conversation_id}/messages/', {}),
+            ('/api/messages/by_conversation/', {'conversation_id': conversation_id}),
+        ]:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(queries), 1)
+
+
+class ConditionalListTests(TestCase):
+    """Test ETag revalidation of the conversation and message lists"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.eve = make_user('eve@example.com', 'Eve')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+        cls.other = Conversation.objects.create()
+        cls.other.participants.set([cls.bob, cls.eve])
+        cls.messages_url = (
+            f'/api/conversations/{cls.conversation.conversation_id}/messages/'
+        )
+
+    def setUp(self):
+        versions.get_cache().clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_lists_answer_304_without_sql(self):
+        """A matching If-None-Match costs no queries once membership is cached"""
+        for url in ['/api/conversations/', self.messages_url, '/api/messages/']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Cache-Control'], 'private, no-cache')
+            with self.assertNumQueries(0):
+                response = self.revalidate(url, response['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+
+    def test_new_message_changes_etags_of_participants_only(self):
+        """A message invalidates the lists of its participants"""
+        etags = {}
+        for user in [self.alice, self.eve]:
+            self.client.force_authenticate(user)
+            etags[user] = self.client.get('/api/conversations/')['ETag']
+        self.client.force_authenticate(self.alice)
+        messages_etag = self.client.get(self.messages_url)['ETag']
+
+        self.client.force_authenticate(self.bob)
+        self.client.post(self.messages_url, {'message_body': 'hi'}, format='json')
+
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(
+            self.revalidate('/api/conversations/', etags[self.alice]).status_code, 200
+        )
+        response = self.revalidate(self.messages_url, messages_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['message_body'], 'hi')
+        self.client.force_authenticate(self.eve)
+        self.assertEqual(
+            self.revalidate('/api/conversations/', etags[self.eve]).status_code, 304
+        )
+
+    def test_membership_and_profile_changes_change_etags(self):
+        """Joining members and renamed participants invalidate the list"""
+        etag = self.client.get('/api/conversations/')['ETag']
+        self.conversation.participants.add(self.eve)
+        self.assertEqual(self.revalidate('/api/conversations/', etag).status_code, 200)
+
+        etag = self.client.get('/api/conversations/')['ETag']
+        self.bob.first_name = 'Robert'
+        self.bob.save()
+        response = self.revalidate('/api/conversations/', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Robert', [
+            p['first_name'] for c in response.data['results'] for p in c['participants']
+        ])
+
+    def test_etag_depends_on_user_and_query(self):
+        """Other users and other pages never share a tag"""
+        etag = self.client.get(self.messages_url)['ETag']
+        self.assertNotEqual(
+            self.client.get(self.messages_url, {'page_size': 1})['ETag'], etag
+        )
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.revalidate(self.messages_url, etag).status_code, 200)
+        self.client.force_authenticate(self.eve)
+        response = self.revalidate(self.messages_url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [])
+        response = self.client.get('/api/conversations/not-a-uuid/messages/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [])
+
+    def test_process_local_versions_are_refused_outside_debug(self):
+        """Only a shared versions cache is accepted without DEBUG"""
+        with self.settings(DEBUG=True):
+            checks.check_shared_caches()
+        with self.settings(DEBUG=False):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'CHATS_VERSION_CACHE'):
+                checks.check_shared_caches()
+            with tempfile.TemporaryDirectory() as directory:
+                with self.settings(CACHES={**settings.CACHES, 'versions': {
+                    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                    'LOCATION': directory,
+                }}):
+                    checks.require_shared_cache('versions', 'CHATS_VERSION_CACHE')
+
+
+class ConversationRetrieveWindowTests(TestCase):
+    """Test the bounded message window of conversation detail responses"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def create_conversation(self, message_count):
+        conversation = Conversation.objects.create()
+        conversation.participants.set([self.alice, self.bob])
+        start = timezone.now() - timedelta(days=1)
+        Message.objects.bulk_create([
+            Message(
+                sender=self.bob, conversation=conversation,
+                message_body=f'message {i}', sent_at=start + timedelta(seconds=i),
+            )
+            for i in range(message_count)
+        ])
+        return conversation
+
+    def retrieve(self, conversation):
+        return self.client.get(f'/api/conversations/{conversation.conversation_id}/')
+
+    def test_window_links_to_older_history(self):
+        """Retrieve embeds the newest messages and links to the page before them"""
+        limit = ConversationSerializer.recent_messages_limit
+        conversation = self.create_conversation(limit + 5)
+        response = self.retrieve(conversation)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [m['message_body'] for m in response.data['messages']],
+            [f'message {i}' for i in range(5, limit + 5)],
+        )
+
+        older = self.client.get(response.data['older_messages'])
+        self.assertEqual(
+            [m['message_body'] for m in older.data['results']],
+            [f'message {i}' for i in range(5)],
+        )
+        self.assertIsNone(self.retrieve(self.create_conversation(3)).data['older_messages'])
+
+    def test_cost_does_not_grow_with_history(self):
+        """Queries and the messages fetched and serialized by retrieve stay flat"""
+        limit = ConversationSerializer.recent_messages_limit
+        costs = []
+        for message_count in [50, 5000]:
+            conversation = self.create_conversation(message_count)
+            with CaptureQueriesContext(connection) as queries, \
+                    mock.patch.object(Message, 'from_db', wraps=Message.from_db) as fetched:
+                response = self.retrieve(conversation)
+            costs.append((len(queries), fetched.call_count, len(response.data['messages'])))
+
+        small, large = costs
+        self.assertEqual(large, small)
+        # The window plus the one extra row that detects older history
+        self.assertEqual(large[1:], (limit + 1, limit))
+
+
+class MessageExportTests(TestCase):
+    """Test the streaming export of a conversation's history"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.eve = make_user('eve@example.com', 'Eve')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+        start = timezone.now() - timedelta(hours=1)
+        Message.objects.bulk_create([
+            Message(
+                sender=cls.bob, conversation=cls.conversation,
+                message_body=f'message {i}\nline two',
+                sent_at=start + timedelta(seconds=i // 2),
+            )
+            for i in range(25)
+        ])
+        cls.url = f'/api/conversations/{cls.conversation.conversation_id}/messages/export/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def export(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def expected(self):
+        queryset = Message.objects.filter(
+            conversation=self.conversation
+        ).order_by('sent_at', 'message_id')
+        return json.loads(JSONRenderer().render(MessageSerializer(queryset, many=True).data))
+
+    def test_jsonl_and_array_match_the_serializer(self):
+        """Both layouts carry the same records as MessageSerializer"""
+        # A small chunk size exercises the joins between chunks
+        with mock.patch.object(MessageViewSet, 'export_chunk_size', 4):
+            lines = self.export().decode().splitlines()
+            array = json.loads(self.export(output='json'))
+        self.assertEqual([json.loads(line) for line in lines], self.expected())
+        self.assertEqual(array, self.expected())
+
+    def test_resume_from_checkpoint(self):
+        """An export resumed from a record continues right after it"""
+        records = [json.loads(line) for line in self.export().decode().splitlines()]
+        checkpoint = records[10]
+        resumed = self.export(
+            sent_at=checkpoint['sent_at'], message_id=checkpoint['message_id']
+        ).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in resumed], records[11:])
+
+    def test_rejects_outsiders_and_bad_parameters(self):
+        """Non-participants, unknown layouts and broken checkpoints are refused"""
+        self.assertEqual(self.client.get(self.url, {'output': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'sent_at': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/messages/export/').status_code, 400)
+        self.client.force_authenticate(self.eve)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    async def test_streams_incrementally_under_asgi(self):
+        """Under ASGI each chunk is sent as soon as it is encoded"""
+        produced = []
+
+        def tracked_export(*args, **kwargs):
+            for chunk in stream_export(*args, **kwargs):
+                produced.append(chunk)
+                yield chunk
+
+        await self.async_client.aforce_login(self.alice)
+        with mock.patch.object(MessageViewSet, 'export_chunk_size', 4), \
+                mock.patch('chats.views.stream_export', tracked_export):
+            response = await self.async_client.get(self.url)
+            self.assertTrue(response.is_async)
+            chunks = aiter(response.streaming_content)
+            first = await anext(chunks)
+            self.assertEqual(produced, [first])
+            rest = [chunk async for chunk in chunks]
+        self.assertEqual(len(produced), 7)
+        lines = b''.join([first, *rest]).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            await sync_to_async(self.expected)()
+        )
+
+
+class MessageArchiveTests(TestCase):
+    """Test archival of old messages and reads across the hot/cold boundary"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+        old = timezone.now() - timedelta(days=400)
+        recent = timezone.now() - timedelta(hours=1)
+        # Pairs of messages share a timestamp to exercise the tie-breaker
+        Message.objects.bulk_create([
+            Message(
+                sender=[cls.alice, cls.bob][i % 2], conversation=cls.conversation,
+                message_body=f'message {i}',
+                sent_at=(old if i < 30 else recent) + timedelta(seconds=i // 2),
+            )
+            for i in range(35)
+        ])
+        Conversation.objects.filter(pk=cls.conversation.pk).refresh_summaries()
+        cls.base = f'/api/conversations/{cls.conversation.conversation_id}/'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = self.settings(CHATS_ARCHIVE={
+            'DIRECTORY': directory.name, 'AGE_DAYS': 365, 'BLOCK_SIZE': 8,
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def walk(self, url, link):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.append([m['message_id'] for m in response.data['results']])
+            url = response.data[link]
+        return ids
+
+    def history(self):
+        """Every read path's view of the conversation, oldest first"""
+        forward = self.walk(self.base + 'messages/?page_size=7', 'next')
+        last_page = self.client.get(self.base + 'messages/?page_size=7')
+        while last_page.data['next']:
+            last_page = self.client.get(last_page.data['next'])
+        backward = self.walk(last_page.data['previous'], 'previous')
+        export = [
+            json.loads(line)['message_id'] for line in b''.join(
+                self.client.get(self.base + 'messages/export/').streaming_content
+            ).decode().splitlines()
+        ]
+        by_conversation = [m['message_id'] for m in self.client.get(
+            '/api/messages/by_conversation/',
+            {'conversation_id': self.conversation.conversation_id}
+        ).data]
+        return forward, backward, export, by_conversation
+
+    def test_reads_are_unchanged_by_archival(self):
+        """Pagination, export and by_conversation page into archived blocks"""
+        before = self.history()
+        self.assertEqual(archive.archive_messages(), 30)
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertEqual(ArchivedBlock.objects.count(), 4)
+        self.assertEqual(self.history(), before)
+        self.assertEqual(archive.archive_messages(), 0)
+
+        Conversation.objects.filter(pk=self.conversation.pk).refresh_summaries()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 35)
+
+    def test_pending_notifications_of_archived_messages_are_dropped(self):
+        """Archival removes the notifications cascading from its messages"""
+        old, recent = Message.objects.order_by('sent_at', 'message_id')[::34]
+        PendingNotification.objects.bulk_create([
+            PendingNotification(recipient=self.bob, message=old),
+            PendingNotification(recipient=self.bob, message=recent),
+        ])
+        archive.archive_messages()
+        self.assertEqual(
+            list(PendingNotification.objects.values_list('message_id', flat=True)),
+            [recent.pk]
+        )
+
+    def test_detail_window_reaches_into_archive(self):
+        """The recent window and its older link include archived messages"""
+        bodies = list(Message.objects.order_by(
+            'sent_at', 'message_id'
+        ).values_list('message_body', flat=True))
+        archive.archive_messages()
+        response = self.client.get(self.base)
+        self.assertEqual(
+            [m['message_body'] for m in response.data['messages']], bodies[15:]
+        )
+        older = self.client.get(response.data['older_messages'])
+        self.assertEqual(
+            [m['message_body'] for m in older.data['results']], bodies[:15]
+        )
+
+    def test_deleting_conversation_removes_segment(self):
+        """A conversation's segment file goes away with it"""
+        archive.archive_messages()
+        path = archive.segment_path(self.conversation.pk)
+        self.assertTrue(path.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.delete()
+        self.assertFalse(path.exists())
+
+
+@override_settings(CHATS_READ_REPLICA='replica')
+class ReadReplicaRoutingTests(TransactionTestCase):
+    """Test replica reads and read-your-writes stickiness"""
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        versions.get_cache().clear()
+        self.alice = make_user('alice@example.com', 'Alice')
+        self.bob = make_user('bob@example.com', 'Bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+        self.url = f'/api/conversations/{self.conversation.conversation_id}/'
+        replication.replicate()
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def bodies(self, client, url=None):
+        response = client.get(url or self.url)
+        self.assertEqual(response.status_code, 200)
+        messages = response.data.get('messages', response.data.get('results'))
+        return [m['message_body'] for m in messages]
+
+    def test_writer_reads_own_write_before_replication(self):
+        """The writer is pinned to the primary; others read the replica"""
+        alice, bob = self.client_for(self.alice), self.client_for(self.bob)
+        response = alice.post(self.url + 'messages/', {'message_body': 'hi'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.cookies)
+
+        # The pin belongs to the user, not to the client that wrote
+        self.assertEqual(self.bodies(self.client_for(self.alice)), ['hi'])
+        self.assertEqual(self.bodies(bob), [])
+        replication.replicate()
+        self.assertEqual(self.bodies(bob), ['hi'])
+
+    def test_lists_ahead_of_replication_read_the_primary(self):
+        """A list whose version the replica lacks is rendered from the primary"""
+        Message.objects.create(
+            sender=self.alice, conversation=self.conversation, message_body='hi'
+        )
+        bob = self.client_for(self.bob)
+        self.assertEqual(self.bodies(bob), [])
+        self.assertEqual(self.bodies(bob, self.url + 'messages/'), ['hi'])
+
+    def test_position_is_recorded_in_the_replica(self):
+        """The replication position survives without any process's cache"""
+        started = replication.replicate()
+        versions.get_cache().clear()
+        self.assertEqual(replication.position(), started)
+        with connections['replica'].cursor() as cursor:
+            cursor.execute(f'DROP TABLE {replication.POSITION_TABLE}')
+        self.assertEqual(replication.position(), 0)
+
+    def test_only_the_primary_is_migrated(self):
+        """Replicas get their schema through replication"""
+        router = routers.PrimaryReplicaRouter()
+        self.assertTrue(router.allow_migrate('default', 'chats'))
+        self.assertFalse(router.allow_migrate('replica', 'chats'))
+        self.assertEqual(router.db_for_read(Message), 'replica')
+        with routers.use_primary():
+            self.assertIsNone(router.db_for_read(Message))
+
+
+@override_settings(CHATS_SQLITE=sqlite.PROFILE)
+class SqliteProfileTests(TestCase):
+    """Test the tuning applied to new SQLite connections"""
+
+    def open(self, name):
+        wrapper = DatabaseWrapper({**connection.settings_dict, 'NAME': name}, alias='tuned')
+        wrapper.ensure_connection()
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        return wrapper.connection.execute(f'PRAGMA {name}').fetchone()[0]
+
+    def test_profile_is_applied_to_files(self):
+        """File databases get WAL, the busy timeout and immediate transactions"""
+        wrapper = self.open(Path(tempfile.mkdtemp()) / 'tuned.sqlite3')
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)
+        self.assertEqual(self.pragma(wrapper, 'busy_timeout'), 5000)
+        self.assertEqual(self.pragma(wrapper, 'cache_size'), -64 * 1024)
+        self.assertEqual(self.pragma(wrapper, 'temp_store'), 2)
+        self.assertEqual(self.pragma(wrapper, 'mmap_size'), 256 * 1024 * 1024)
+        self.assertEqual(wrapper.transaction_mode, 'IMMEDIATE')
+
+    def test_in_memory_databases_keep_their_journal(self):
+        """WAL and mmap do not apply to in-memory databases"""
+        wrapper = self.open(':memory:')
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'memory')
+        self.assertEqual(self.pragma(wrapper, 'busy_timeout'), 5000)
+
+    @override_settings(CHATS_SQLITE=None)
+    def test_profile_can_be_disabled(self):
+        """Without a profile connections keep SQLite's defaults"""
+        wrapper = self.open(Path(tempfile.mkdtemp()) / 'plain.sqlite3')
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'delete')
+        self.assertIsNone(wrapper.transaction_mode)
+
+    def test_optimize_runs_once_per_interval(self):
+        """PRAGMA optimize is rate limited per database file"""
+        wrapper = self.open(Path(tempfile.mkdtemp()) / 'optimized.sqlite3')
+        profile = sqlite.get_profile()
+        self.assertFalse(sqlite.optimize(wrapper, profile))
+        self.assertTrue(sqlite.optimize(wrapper, {**profile, 'OPTIMIZE_INTERVAL': 0}))
+        self.assertTrue(sqlite.optimize(wrapper, profile, force=True))
+
+
+# Cost of the stand-in side effect, patched per test
+side_effect_calls = []
+
+
+def record_side_effect(messages):
+    """Stand-in for side effect work, recording the messages it was given"""
+    side_effect_calls.extend(message.message_body for message in messages)
+
+
+def run_queued_tasks():
+    """Run the tasks waiting in the in-memory broker, as a worker would"""
+    names = []
+    with celery_app.connection_for_read() as conn:
+        queue = conn.SimpleQueue(celery_app.conf.task_default_queue, no_ack=True)
+        while True:
+            try:
+                message = queue.get(block=False)
+            except queue.Empty:
+                return names
+            # Countdowns are not waited for; tasks may enqueue more tasks
+            args, kwargs, _ = message.decode()
+            names.append(message.headers['task'])
+            celery_app.tasks[message.headers['task']].apply(args, kwargs)
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=False,
+    CHATS_MESSAGE_SIDE_EFFECTS=[
+        'chats.notifications.queue_notifications',
+        'chats.tests.record_side_effect',
+    ],
+    CHATS_NOTIFICATIONS={'BACKEND': 'chats.notifications.MemoryBackend'},
+)
+class MessageSideEffectTests(TestCase):
+    """Test the task pipeline running side effects of new messages"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.carol = make_user('carol@example.com', 'Carol')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob, cls.carol])
+
+    def setUp(self):
+        run_queued_tasks()
+        caches['default'].clear()
+        notifications.outbox.clear()
+        side_effect_calls.clear()
+
+    def post_message(self, user, body):
+        """Post a message and run on-commit hooks"""
+        client = APIClient()
+        client.force_authenticate(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                f'/api/conversations/{self.conversation.conversation_id}/messages/',
+                {'message_body': body}, format='json'
+            )
+        self.assertEqual(response.status_code, 201)
+
+    def test_side_effects_are_deferred_to_workers(self):
+        """Side effects run in a worker, never within the posting request"""
+        with mock.patch(f'{__name__}.record_side_effect') as side_effect:
+            for i in range(3):
+                self.post_message(self.alice, f'message {i}')
+            side_effect.assert_not_called()
+
+            run_queued_tasks()
+            self.assertEqual(
+                [message.message_body for call in side_effect.call_args_list
+                 for message in call.args[0]],
+                ['message 0', 'message 1', 'message 2'],
+            )
+
+            # Run inline instead, the work lands on the post itself
+            side_effect.reset_mock()
+            with override_settings(CELERY_TASK_ALWAYS_EAGER=True):
+                self.post_message(self.alice, 'inline')
+            side_effect.assert_called_once()
+
+    def test_notifications_are_batched_per_recipient(self):
+        """Messages within the window reach each recipient as one batch"""
+        for body in ['one', 'two', 'three']:
+            self.post_message(self.alice, body)
+        self.assertEqual(notifications.outbox, [])
+
+        names = run_queued_tasks()
+        self.assertEqual(names.count('chats.tasks.process_messages'), 3)
+        self.assertEqual(names.count('chats.tasks.flush_notifications'), 2)
+        batches = dict(notifications.outbox)
+        self.assertEqual(set(batches), {str(self.bob.pk), str(self.carol.pk)})
+        batch = batches[str(self.bob.pk)]
+        self.assertEqual(batch['message_count'], 3)
+        self.assertEqual(batch['conversations'][0]['message_count'], 3)
+        self.assertEqual(batch['conversations'][0]['last_sender'], 'Alice')
+        self.assertEqual(batch['conversations'][0]['preview'], 'three')
+
+        # A flush clears the window, so the next message schedules another
+        notifications.outbox.clear()
+        self.post_message(self.bob, 'four')
+        run_queued_tasks()
+        self.assertEqual(
+            {user_id for user_id, _ in notifications.outbox},
+            {str(self.alice.pk), str(self.carol.pk)}
+        )
+
+    def test_bulk_and_rolled_back_messages(self):
+        """Bulk inserts enqueue their side effects; rollbacks enqueue none"""
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                Message.objects.create(
+                    sender=self.alice, conversation=self.conversation,
+                    message_body='rolled back'
+                )
+                transaction.set_rollback(True)
+
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                f'/api/conversations/{self.conversation.conversation_id}/messages/bulk/',
+                [{'message_body': 'bulk one'}, {'message_body': 'bulk two'}],
+                format='json'
+            )
+        self.assertEqual(response.status_code, 201)
+        run_queued_tasks()
+        self.assertEqual(side_effect_calls, ['bulk one', 'bulk two'])
+        self.assertEqual(
+            {user_id for user_id, _ in notifications.outbox},
+            {str(self.alice.pk), str(self.carol.pk)}
+        )
+
+
+class QueryBudgetTests(TestCase):
+    """Test per-request SQL accounting and query budgets"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_fingerprint_normalizes_values(self):
+        """Literals and placeholder lists do not split a statement's fingerprint"""
+        self.assertEqual(
+            fingerprint("SELECT  * FROM t WHERE a IN (%s, %s, %s) AND b = 'x'\nLIMIT 21"),
+            "SELECT * FROM t WHERE a IN (...) AND b = ? LIMIT ?"
+        )
+        self.assertEqual(
+            fingerprint('SELECT * FROM t WHERE a IN (%s, %s)'),
+            fingerprint('SELECT * FROM t WHERE a IN (%s, %s, %s, %s)')
+        )
+
+    def test_recorder_flags_duplicates(self):
+        """Repeated statements are reported; transaction control is not counted"""
+        with QueryRecorder() as recorder, transaction.atomic():
+            User.objects.get(pk=self.alice.pk)
+            User.objects.get(pk=self.bob.pk)
+            Conversation.objects.count()
+        self.assertEqual(len(recorder), 3)
+        duplicates = recorder.duplicates()
+        self.assertEqual(list(duplicates.values()), [2])
+        self.assertIn('FROM "users"', next(iter(duplicates)))
+
+    def test_action_over_budget_fails(self):
+        """Requests exceeding their action's budget raise while testing"""
+        self.assertEqual(
+            self.client.get('/api/conversations/').status_code, 200
+        )
+        with mock.patch.dict(ConversationViewSet.query_budgets, {'list': 1}):
+            with self.assertRaisesRegex(QueryBudgetExceeded, 'ConversationViewSet.list'):
+                self.client.get('/api/conversations/')
+        with self.assertRaises(QueryBudgetExceeded):
+            with assert_query_budget(1):
+                list(User.objects.all())
+                list(Conversation.objects.all())
+
+    def test_sampled_requests_are_logged(self):
+        """Outside tests a sample of requests gets a summary log line"""
+        with override_settings(CHATS_QUERY_BUDGETS={'ENFORCE': False, 'SAMPLE_RATE': 1}):
+            with self.assertLogs('chats.queries', 'INFO') as logs:
+                self.client.get('/api/conversations/')
+            self.assertIn('ConversationViewSet.list', logs.output[0])
+            self.assertIn('(budget 6)', logs.output[0])
+            self.assertEqual(logs.records[0].query_summary['budget'], 6)
+
+            with mock.patch.dict(ConversationViewSet.query_budgets, {'list': 1}), \
+                    self.assertLogs('chats.queries', 'WARNING'):
+                self.client.get('/api/conversations/')
+
+        with override_settings(CHATS_QUERY_BUDGETS={'ENFORCE': False, 'SAMPLE_RATE': 0}):
+            with self.assertNoLogs('chats.queries'):
+                self.client.get('/api/conversations/')
+
+    def test_eager_tasks_are_not_counted(self):
+        """Side effects run eagerly belong to the worker, not the request"""
+        message = Message.objects.create(
+            sender=self.alice, conversation=self.conversation, message_body='hi'
+        )
+        with override_settings(CELERY_TASK_ALWAYS_EAGER=True):
+            with assert_query_budget(0):
+                tasks.process_messages.delay([str(message.pk)])
+
+
+@override_settings(CHATS_SERVER_TIMING={'ENABLED': True})
+class ServerTimingTests(TestCase):
+    """Test the Server-Timing breakdown and request profiling"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+        Message.objects.create(
+            sender=cls.bob, conversation=cls.conversation, message_body='hi'
+        )
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+        self.profiles = Path(tempfile.mkdtemp())
+
+    def profile_settings(self, **config):
+        return override_settings(CHATS_SERVER_TIMING={
+            'ENABLED': True, 'PROFILE_DIRECTORY': self.profiles, **config,
+        })
+
+    def test_header_disabled_by_default(self):
+        """Without ENABLED responses do not reveal their timing, but it is logged"""
+        with override_settings(CHATS_SERVER_TIMING={}), \
+                self.assertLogs('chats.timing', 'INFO') as logs:
+            response = self.client.get('/api/conversations/')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(logs.records[0].server_timing['status'], 200)
+
+    def test_header_breaks_down_phases(self):
+        """Responses of chats views carry their time per phase"""
+        with self.assertLogs('chats.timing', 'INFO') as logs:
+            response = self.client.get('/api/conversations/')
+        entries = dict(
+            entry.split(';', 1) for entry in response['Server-Timing'].split(', ')
+        )
+        self.assertEqual(
+            list(entries), ['auth', 'sql', 'serialize', 'render', 'app', 'total']
+        )
+        durations = {
+            name: float(value.split('dur=')[1].split(';')[0])
+            for name, value in entries.items()
+        }
+        self.assertLessEqual(
+            sum(durations[name] for name in timing.PHASES), durations['total'] + 0.5
+        )
+
+        record = logs.records[0].server_timing
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['path'], '/api/conversations/')
+        self.assertIn(f'desc="{record["queries"]} queries"', entries['sql'])
+
+    def test_phases_are_exclusive(self):
+        """Time of a nested phase is not counted in its parent"""
+        timer = timing.RequestTimer()
+        token = timing._current.set(timer)
+        try:
+            with timing.phase('serialize'):
+                with timing.phase('render'):
+                    time.sleep(0.02)
+                with timing.phase('serialize'):
+                    pass
+        finally:
+            timing._current.reset(token)
+        breakdown = timer.finish()
+        self.assertGreaterEqual(breakdown['render'], 20)
+        self.assertLess(breakdown['serialize'], 10)
+
+    def test_profile_on_header_with_token(self):
+        """Requests sending the profile token are profiled into the directory"""
+        with self.profile_settings(PROFILE_TOKEN='secret'):
+            self.client.get('/api/conversations/', HTTP_X_CHATS_PROFILE='wrong')
+            self.assertEqual(list(self.profiles.iterdir()), [])
+
+            # A sync view, which runs on the profiled thread
+            with self.assertLogs('chats.timing', 'INFO') as logs:
+                self.client.get('/api/users/', HTTP_X_CHATS_PROFILE='secret')
+        profile, = self.profiles.iterdir()
+        self.assertEqual(logs.records[0].server_timing['profile'], str(profile))
+        self.assertIn('GET-api-users', profile.name)
+        functions = {name for _, _, name in pstats.Stats(str(profile)).stats}
+        self.assertIn('list', functions)
+
+    def test_token_profiles_without_debug_or_header(self):
+        """Token-authorised profiling works in production settings"""
+        with self.settings(DEBUG=False), \
+                self.profile_settings(ENABLED=False, PROFILE_TOKEN='secret'):
+            response = self.client.get('/api/users/', HTTP_X_CHATS_PROFILE='secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(len(list(self.profiles.iterdir())), 1)
+
+    def test_profile_header_needs_token_or_debug(self):
+        """Without a token the header is ignored unless DEBUG is on"""
+        with self.profile_settings():
+            self.client.get('/api/conversations/', HTTP_X_CHATS_PROFILE='1')
+            self.assertEqual(list(self.profiles.iterdir()), [])
+            with override_settings(DEBUG=True):
+                self.client.get('/api/conversations/', HTTP_X_CHATS_PROFILE='1')
+            self.assertEqual(len(list(self.profiles.iterdir())), 1)
+
+    def test_sampled_profiles(self):
+        """A sample of requests is profiled without any header"""
+        with self.profile_settings(PROFILE_SAMPLE_RATE=1):
+            self.client.get('/api/conversations/')
+            self.client.get(
+                f'/api/conversations/{self.conversation.conversation_id}/messages/'
+            )
+        self.assertEqual(len(list(self.profiles.iterdir())), 2)
+
+    async def test_async_requests_are_not_profiled(self):
+        """Under ASGI requests are timed but never profiled"""
+        await self.async_client.aforce_login(self.alice)
+        with self.profile_settings(PROFILE_SAMPLE_RATE=1):
+            response = await self.async_client.get('/api/users/')
+        self.assertIn('total;dur=', response['Server-Timing'])
+        self.assertEqual(list(self.profiles.iterdir()), [])
+
+
+class TokenAuthenticationTests(TestCase):
+    """Test signed bearer tokens and their query-free authentication"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.set([cls.alice, cls.bob])
+
+    def setUp(self):
+        tokens.users.clear()
+        self.client = APIClient()
+
+    def obtain(self, email='alice@example.com', password='password123'):
+        self.client.credentials()
+        return self.client.post(
+            '/api/tokens/', {'email': email, 'password': password}, format='json'
+        )
+
+    def bearer(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_obtain_and_use_token(self):
+        """Valid credentials give a token that authenticates requests"""
+        self.assertEqual(self.obtain(password='wrong').status_code, 400)
+        self.assertEqual(self.obtain(password='').status_code, 400)
+        response = self.obtain()
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(response.data['expires_at'], timezone.now())
+        self.bearer(response.data['token'])
+        response = self.client.get('/api/conversations/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+
+    def test_authentication_runs_no_sql_once_cached(self):
+        """A token costs as many queries as no authentication at all"""
+        self.bearer(self.obtain().data['token'])
+        self.client.get('/api/users/')
+        with CaptureQueriesContext(connection) as with_token:
+            self.assertEqual(self.client.get('/api/users/').status_code, 200)
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        with CaptureQueriesContext(connection) as forced:
+            client.get('/api/users/')
+        self.assertEqual(len(with_token), len(forced))
+
+    def test_revoke_invalidates_issued_tokens(self):
+        """Revoking logs out every token, and new ones work again"""
+        first = self.obtain().data['token']
+        second = self.obtain().data['token']
+        self.bearer(first)
+        self.assertEqual(self.client.post('/api/tokens/revoke/').status_code, 200)
+        for token in [first, second]:
+            self.bearer(token)
+            response = self.client.get('/api/users/')
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(response.data['detail'], 'Token has been revoked.')
+        self.bearer(self.obtain().data['token'])
+        self.assertEqual(self.client.get('/api/users/').status_code, 200)
+
+    def test_rejects_forged_expired_and_outdated_tokens(self):
+        """Tampered, expired and role-changed tokens are refused"""
+        token = self.obtain().data['token']
+        self.bearer(token[:-2] + ('AA' if not token.endswith('AA') else 'BB'))
+        self.assertEqual(self.client.get('/api/users/').data['detail'], 'Invalid token.')
+
+        with override_settings(CHATS_TOKENS={**tokens.DEFAULT_TOKENS, 'LIFETIME': -1}):
+            self.bearer(self.obtain().data['token'])
+        self.assertEqual(self.client.get('/api/users/').data['detail'],
+                         'Token has expired.')
+
+        self.bearer(token)
+        self.client.get('/api/users/')
+        self.alice.role = 'host'
+        self.alice.save()
+        self.assertEqual(self.client.get('/api/users/').data['detail'],
+                         'Token role is outdated.')
+
+    def test_user_cache_is_bounded(self):
+        """The least recently used users are evicted beyond the cache size"""
+        with override_settings(CHATS_TOKENS={**tokens.DEFAULT_TOKENS, 'USER_CACHE_SIZE': 1}):
+            tokens.users.put(self.alice)
+            tokens.users.put(self.bob)
+            self.assertIsNone(tokens.users.get(str(self.alice.pk)))
+            self.assertEqual(tokens.users.get(str(self.bob.pk)), self.bob)
+
+    def test_process_local_epochs_are_refused_outside_debug(self):
+        """Revocation epochs must live in a shared cache without DEBUG"""
+        with self.settings(DEBUG=False):
+            with self.assertRaisesMessage(ImproperlyConfigured, "CHATS_TOKENS['CACHE']"):
+                checks.require_shared_cache(tokens.get_config()['CACHE'],
+                                            "CHATS_TOKENS['CACHE']")
+            with tempfile.TemporaryDirectory() as directory:
+                with self.settings(CACHES={**settings.CACHES, 'shared': {
+                    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                    'LOCATION': directory,
+                }}, CHATS_MEMBERSHIP_CACHE='shared', CHATS_VERSION_CACHE='shared',
+                        CHATS_TOKENS={**tokens.DEFAULT_TOKENS, 'CACHE': 'shared'}):
+                    checks.check_shared_caches()
+
+
+class AdminChangelistTests(TestCase):
+    """Test that admin changelists run a fixed number of cheap queries"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            email='admin@example.com', first_name='Ada', last_name='Admin',
+            password='password123'
+        )
+        cls.alice = make_user('alice@example.com', 'Alice')
+        cls.bob = make_user('bob@example.com', 'Bob')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def add_conversations(self, count):
+        for i in range(count):
+            conversation = Conversation.objects.create()
+            conversation.participants.set([self.alice, self.bob])
+            Message.objects.create(
+                sender=self.alice, conversation=conversation,
+                message_body=f'hello number {i}'
+            )
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(captured), response
+
+    def test_query_count_is_independent_of_rows(self):
+        """Message and conversation changelists cost the same at any size"""
+        self.add_conversations(2)
+        before = [
+            self.changelist_queries(url)[0]
+            for url in ['/admin/chats/message/', '/admin/chats/conversation/']
+        ]
+        self.add_conversations(10)
+        after = [
+            self.changelist_queries(url)[0]
+            for url in ['/admin/chats/message/', '/admin/chats/conversation/']
+        ]
+        self.assertEqual(before, after)
+
+    def test_participant_count_is_annotated(self):
+        """The participant column shows the count of each conversation"""
+        self.add_conversations(1)
+        Conversation.objects.get().participants.add(self.admin)
+        _, response = self.changelist_queries('/admin/chats/conversation/')
+        self.assertEqual(response.context['cl'].result_list[0].participant_count, 3)
+
+    def test_str_runs_no_queries(self):
+        """Printing conversations and messages never queries"""
+        self.add_conversations(1)
+        conversation = Conversation.objects.get()
+        message = Message.objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(str(conversation), f'Conversation {conversation.pk}')
+            self.assertIn(str(self.alice.pk), str(message))
+        named = Conversation.objects.prefetch_related('participants').get()
+        self.assertIn(str(named), [
+            'Conversation: Alice User, Bob User', 'Conversation: Bob User, Alice User'
+        ])
+        self.assertEqual(
+            str(Message.objects.select_related('sender').get()),
+            'Message from Alice: hello number 0...'
+        )
+
+    def test_search_uses_full_text_index(self):
+        """Searching messages matches words and sender emails"""
+        self.add_conversations(3)
+        Message.objects.create(
+            sender=self.bob, conversation=Conversation.objects.first(),
+            message_body='something else'
+        )
+        _, response = self.changelist_queries('/admin/chats/message/?q=number')
+        self.assertEqual(response.context['cl'].result_count, 3)
+        _, response = self.changelist_queries('/admin/chats/message/?q=bob@example.com')
+        self.assertEqual(
+            [m.message_body for m in response.context['cl'].result_list],
+            ['something else']
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE messages SET rowid = rowid + 1000')
+        _, response = self.changelist_queries('/admin/chats/message/?q=else')
+        self.assertEqual(
+            [m.message_body for m in response.context['cl'].result_list],
+            ['something else']
+        )
+
+    def test_paginator_estimates_large_unfiltered_tables(self):
+        """Unfiltered counts come from rowids past the exact threshold"""
+        self.add_conversations(3)
+        Message.objects.filter(message_body='hello number 1').delete()
+        with mock.patch.object(EstimatedCountPaginator, 'exact_threshold', 0):
+            self.assertEqual(EstimatedCountPaginator(Message.objects.all(), 10).count, 3)
+            self.assertEqual(EstimatedCountPaginator(
+                Message.objects.filter(sender=self.alice), 10
+            ).count, 2)
+        self.assertEqual(EstimatedCountPaginator(Message.objects.all(), 10).count, 2)
+
+
+class UserDirectorySearchTests(TestCase):
+    """Test the indexed prefix search over user names and emails"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = make_user('alice.smith@example.com', 'Alice', 'Smith')
+        cls.al = make_user('al@example.com', 'Al', 'Jones')
+        cls.zoe = make_user('zoe@example.org', 'Zoë', 'Ångström')
+        cls.bob = make_user('bob@example.com', 'Bob', 'Alison')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def search(self, text):
+        return [user.first_name for user in directory.search_users(text)]
+
+    def test_every_word_matches_as_a_prefix(self):
+        """Words match name and email prefixes, regardless of case and accents"""
+        self.assertEqual(self.search('zoe ANG'), ['Zoë'])
+        self.assertEqual(self.search('smi ali'), ['Alice'])
+        self.assertEqual(self.search('example org'), ['Zoë'])
+        self.assertEqual(self.search('ali nobody'), [])
+
+    def test_exact_words_rank_first(self):
+        """A word equal to the query outranks longer words starting with it"""
+        self.assertEqual(self.search('al')[0], 'Al')
+        self.assertEqual(set(self.search('al')), {'Al', 'Alice', 'Bob'})
+
+    def test_single_typo_is_corrected(self):
+        """A word matching nothing is retried one typo away"""
+        self.assertEqual(self.search('alcie'), ['Alice'])
+        self.assertEqual(self.search('smiht alice'), ['Alice'])
+        self.assertEqual(self.search('xq'), [])
+
+    def test_index_follows_user_writes(self):
+        """Renaming re-indexes a user, and deleting one drops their tokens"""
+        self.alice.last_name = 'Walker'
+        self.alice.save()
+        self.assertEqual(self.search('walk'), ['Alice'])
+        self.assertEqual(self.search('smith alice'), ['Alice'])  # email still matches
+        self.assertEqual(self.search('smi'), ['Alice'])
+        self.alice.first_name = 'Alicia'
+        self.alice.save(update_fields=['first_name'])
+        self.assertEqual(self.search('alicia'), ['Alicia'])
+        self.alice.delete()
+        self.assertFalse(UserSearchToken.objects.filter(user_id=self.alice.pk).exists())
+
+    def test_rebuild_command_indexes_bulk_created_users(self):
+        """Users inserted in bulk are found once the index is rebuilt"""
+        User.objects.bulk_create([User(
+            email='carol@example.com', first_name='Carol', last_name='King',
+            password='!'
+        )])
+        self.assertEqual(self.search('carol'), [])
+        call_command('reindex_user_search', chunk_size=2, stdout=StringIO())
+        self.assertEqual(self.search('carol'), ['Carol'])
+
+    def test_search_endpoint(self):
+        """The endpoint ranks users and validates its parameters"""
+        self.assertEqual(self.client.get('/api/users/search/').status_code, 400)
+        self.assertEqual(
+            self.client.get('/api/users/search/', {'q': 'al', 'limit': 'x'}).status_code,
+            400
+        )
+        response = self.client.get('/api/users/search/', {'q': 'al', 'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [user['email'] for user in response.data['results']],
+            ['al@example.com', 'alice.smith@example.com']
+        )
 
-# Create your tests here.
@@ -0,0 +1,304 @@
+"""
+Server-Timing breakdown and on-demand profiling of requests
+
+`ServerTimingMiddleware` attributes the wall time of each request to
+phases and reports it in a Server-Timing header, for example:
+
+    Server-Timing: auth;dur=0.4, sql;dur=2.1;desc="4 queries",
+        serialize;dur=1.0, render;dur=0.3, app;dur=0.9, total;dur=4.7
+
+Every request also gets a chats.timing log record carrying the same
+numbers as `server_timing`. The header shows clients how long each part
+of the request took, so it is only added with ENABLED on, which the
+project settings tie to DEBUG. Every SQL statement is timed on all
+database aliases. The chats viewsets time authentication and rendering through
+`ServerTimingMixin`, and the chats serializers time their output
+through `TimedSerializerMixin`. Phases are exclusive: SQL run while
+serializing counts as SQL, not as serialization. `app` is whatever no
+phase claimed, `total` the whole request.
+
+Requests can also be profiled with cProfile, configured by
+CHATS_SERVER_TIMING:
+
+    CHATS_SERVER_TIMING = {
+        'ENABLED': False,
+        'PROFILE_DIRECTORY': None,
+        'PROFILE_SAMPLE_RATE': 0,
+        'PROFILE_HEADER': 'X-Chats-Profile',
+        'PROFILE_TOKEN': None,
+    }
+
+A PROFILE_SAMPLE_RATE fraction of requests is profiled, whether or not
+ENABLED is on. So is any request whose PROFILE_HEADER carries
+PROFILE_TOKEN. Without a token, the header is honoured only with DEBUG
+on. Profiles are written to PROFILE_DIRECTORY in pstats format;
+profiling is off while it is None.
+Only WSGI requests are profiled. Under ASGI, concurrent requests share
+the event loop's thread, which can run one profiler at a time, and
+their views run on other threads that profiler would not see.
+"""
+import cProfile
+import logging
+import random
+import re
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connections
+from django.utils.crypto import constant_time_compare
+
+DEFAULT_SERVER_TIMING = {
+    'ENABLED': False,
+    'PROFILE_DIRECTORY': None,
+    'PROFILE_SAMPLE_RATE': 0,
+    'PROFILE_HEADER': 'X-Chats-Profile',
+    'PROFILE_TOKEN': None,
+}
+
+# Phases in Server-Timing order
+PHASES = ('auth', 'sql', 'serialize', 'render')
+
+_UNSAFE_FILENAME = re.compile(r'[^A-Za-z0-9]+')
+
+logger = logging.getLogger('chats.timing')
+
+_current = ContextVar('chats_request_timer', default=None)
+
+
+def get_config():
+    return {**DEFAULT_SERVER_TIMING, **getattr(settings, 'CHATS_SERVER_TIMING', {})}
+
+
+class RequestTimer:
+    """
+    Exclusive time spent in each phase of one request
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.totals = defaultdict(float)
+        self.queries = 0
+        # Open phases as [name, started, time claimed by nested phases]
+        self._open = []
+
+    @property
+    def current(self):
+        return self._open[-1][0] if self._open else None
+
+    def start(self, name):
+        self._open.append([name, time.perf_counter(), 0.0])
+
+    def stop(self, name):
+        """
+        Close phase `name`, and any phase left open inside it
+        """
+        if all(open_name != name for open_name, _, _ in self._open):
+            return
+        while self._open:
+            open_name, started, nested = self._open.pop()
+            elapsed = time.perf_counter() - started
+            self.add(open_name, elapsed - nested, elapsed)
+            if open_name == name:
+                return
+
+    def add(self, name, duration, elapsed=None):
+        self.totals[name] += duration
+        if self._open:
+            self._open[-1][2] += duration if elapsed is None else elapsed
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.add('sql', time.perf_counter() - started)
+
+    def finish(self):
+        """
+        Close all phases and return the breakdown in milliseconds
+        """
+        while self._open:
+            self.stop(self._open[-1][0])
+        total = time.perf_counter() - self.started
+        breakdown = {
+            name: round(self.totals[name] * 1000, 3)
+            for name in PHASES if name in self.totals
+        }
+        breakdown['app'] = round(max(total - sum(self.totals.values()), 0) * 1000, 3)
+        breakdown['total'] = round(total * 1000, 3)
+        return breakdown
+
+
+@contextmanager
+def phase(name):
+    """
+    Attribute the time spent in the block to phase `name`
+
+    Does nothing outside a timed request or inside the same phase, so
+    recursive serializers are timed once.
+    """
+    timer = _current.get()
+    if timer is None or timer.current == name:
+        yield
+        return
+    timer.start(name)
+    try:
+        yield
+    finally:
+        timer.stop(name)
+
+
+def format_header(breakdown, queries):
+    entries = []
+    for name, duration in breakdown.items():
+        entry = f'{name};dur={duration:.1f}'
+        if name == 'sql':
+            entry += f';desc="{queries} queries"'
+        entries.append(entry)
+    return ', '.join(entries)
+
+
+class ServerTimingMixin:
+    """
+    Time the authentication and rendering of a viewset's responses
+    """
+    def perform_authentication(self, request):
+        with phase('auth'):
+            super().perform_authentication(request)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        timer = _current.get()
+        if timer is not None and hasattr(response, 'add_post_render_callback'):
+            # The handler renders the response right after the view returns
+            timer.start('render')
+            response.add_post_render_callback(lambda rendered: timer.stop('render'))
+        return response
+
+
+class TimedSerializerMixin:
+    """
+    Time the output of a serializer, many=True lists included
+    """
+    def to_representation(self, instance):
+        with phase('serialize'):
+            return super().to_representation(instance)
+
+
+class ServerTimingMiddleware:
+    """
+    Time every request into a log record and, with ENABLED on, a
+    Server-Timing header, and profile the WSGI requests asking for it
+
+    The timer lives in a context variable, so concurrent ASGI requests on
+    one event loop each time their own work. They are never profiled:
+    cProfile would mix in every coroutine the loop runs meanwhile.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        config = get_config()
+        timer = RequestTimer()
+        profiler = self.get_profiler(request, config)
+        token = _current.set(timer)
+        try:
+            with self.timed_queries(timer), profiling(profiler):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.process_response(request, response, timer, profiler, config)
+
+    async def __acall__(self, request):
+        config = get_config()
+        timer = RequestTimer()
+        profiler = self.get_profiler(request, config)
+        token = _current.set(timer)
+        try:
+            with self.timed_queries(timer), profiling(profiler):
+                response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.process_response(request, response, timer, profiler, config)
+
+    def timed_queries(self, timer):
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(timer))
+        return stack
+
+    def get_profiler(self, request, config):
+        if config['PROFILE_DIRECTORY'] is None or isinstance(request, ASGIRequest):
+            return None
+        requested = request.headers.get(config['PROFILE_HEADER'])
+        if requested is not None:
+            token = config['PROFILE_TOKEN']
+            if (token is None and settings.DEBUG) or (
+                    token is not None and constant_time_compare(requested, token)):
+                return cProfile.Profile()
+        if random.random() < config['PROFILE_SAMPLE_RATE']:
+            return cProfile.Profile()
+        return None
+
+    def process_response(self, request, response, timer, profiler, config):
+        breakdown = timer.finish()
+        if config['ENABLED']:
+            response['Server-Timing'] = format_header(breakdown, timer.queries)
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': timer.queries,
+            **breakdown,
+        }
+        if profiler is not None:
+            record['profile'] = str(write_profile(
+                profiler, config['PROFILE_DIRECTORY'], request
+            ))
+        logger.info(
+            '%s %s %s in %.1f ms', request.method, request.path,
+            response.status_code, breakdown['total'],
+            extra={'server_timing': record},
+        )
+        return response
+
+
+@contextmanager
+def profiling(profiler):
+    if profiler is None:
+        yield
+        return
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+
+
+def write_profile(profiler, directory, request):
+    """
+    Dump `profiler` into `directory` under a name identifying the request
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    slug = _UNSAFE_FILENAME.sub('-', request.path).strip('-')[:80] or 'root'
+    path = directory / (
+        f"{time.strftime('%Y%m%d-%H%M%S')}-{request.method}-{slug}-"
+        f"{uuid.uuid4().hex[:8]}.prof"
+    )
+    profiler.dump_stats(path)
+    return path
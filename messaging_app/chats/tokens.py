@@ -0,0 +1,240 @@
+"""
+Stateless signed bearer tokens, authenticating requests without SQL
+
+Clients trade their credentials for a token at POST /api/tokens/ and send
+it with every request:
+
+    Authorization: Bearer <token>
+
+A token carries the user id, role, expiry and revocation epoch of its
+user, signed with an HMAC keyed by SECRET_KEY. Checking it needs no
+session row. Users are kept in a small in-process LRU cache, and each
+user's revocation epoch in the cache alias named by CACHE. So a
+request with a token for a recently seen user runs no SQL to
+authenticate:
+
+    CHATS_TOKENS = {
+        'LIFETIME': 3600,
+        'USER_CACHE_SIZE': 10000,
+        'USER_CACHE_TTL': 60,
+        'CACHE': 'default',
+    }
+
+POST /api/tokens/revoke/ bumps the user's epoch, which invalidates every
+token issued to them so far; this is how clients log out. A token also
+stops working when its user's role changes or the user is deactivated.
+The LRU cache is per process: other processes notice role changes and
+deactivations once their entry is older than USER_CACHE_TTL seconds.
+Revocations go through CACHE and apply at once in every process sharing
+it. A local-memory CACHE would keep accepting revoked tokens in the
+other processes, so it is only accepted with DEBUG; otherwise the app
+refuses to start (see chats.checks).
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+
+from .models import User
+from .routers import use_primary
+
+DEFAULT_TOKENS = {
+    'LIFETIME': 3600,
+    'USER_CACHE_SIZE': 10000,
+    'USER_CACHE_TTL': 60,
+    'CACHE': 'default',
+}
+
+SALT = 'chats.tokens'
+
+EPOCH_PREFIX = 'chats:tokens:epoch:'
+
+
+def get_config():
+    return {**DEFAULT_TOKENS, **getattr(settings, 'CHATS_TOKENS', {})}
+
+
+def get_cache():
+    return caches[get_config()['CACHE']]
+
+
+def epoch_key(user_id):
+    return f'{EPOCH_PREFIX}{user_id}'
+
+
+def get_signer():
+    return signing.Signer(salt=SALT, algorithm='sha256')
+
+
+class UserCache:
+    """
+    Thread-safe LRU cache of recently authenticated users
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+
+    def get(self, user_id):
+        """
+        Return the cached user `user_id`, or None if absent or too old
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            user, loaded_at = entry
+            if time.monotonic() - loaded_at > get_config()['USER_CACHE_TTL']:
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+            return user
+
+    def put(self, user):
+        size = get_config()['USER_CACHE_SIZE']
+        with self._lock:
+            self._users[str(user.pk)] = (user, time.monotonic())
+            self._users.move_to_end(str(user.pk))
+            while len(self._users) > size:
+                self._users.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._users.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+    def __len__(self):
+        return len(self._users)
+
+
+users = UserCache()
+
+
+def issue(user):
+    """
+    Return a new token for `user` and the datetime it expires at
+    """
+    expires = int(time.time()) + get_config()['LIFETIME']
+    token = get_signer().sign_object({
+        'u': str(user.pk),
+        'r': user.role,
+        'e': expires,
+        'v': user.token_epoch,
+    })
+    return token, datetime.fromtimestamp(expires, tz=dt_timezone.utc)
+
+
+def read(token):
+    """
+    Return the claims of an authentic, unexpired token
+
+    Raises AuthenticationFailed otherwise.
+    """
+    try:
+        claims = get_signer().unsign_object(token)
+    except (signing.BadSignature, ValueError):
+        raise exceptions.AuthenticationFailed('Invalid token.')
+    if not isinstance(claims, dict) or not {'u', 'r', 'e', 'v'} <= claims.keys():
+        raise exceptions.AuthenticationFailed('Invalid token.')
+    if claims['e'] <= time.time():
+        raise exceptions.AuthenticationFailed('Token has expired.')
+    return claims
+
+
+def get_epoch(user_id):
+    """
+    Return the revocation epoch of `user_id`, or None if the user is gone
+    """
+    cache = get_cache()
+    epoch = cache.get(epoch_key(user_id))
+    if epoch is None:
+        # A lagging replica could miss a revocation
+        with use_primary():
+            epoch = User.objects.filter(pk=user_id).values_list(
+                'token_epoch', flat=True
+            ).first()
+        if epoch is not None:
+            cache.add(epoch_key(user_id), epoch, timeout=None)
+    return epoch
+
+
+def get_user(user_id):
+    """
+    Return the user `user_id` from the LRU cache or the database, or None
+    """
+    user = users.get(user_id)
+    if user is None:
+        with use_primary():
+            user = User.objects.filter(pk=user_id).first()
+        if user is not None:
+            users.put(user)
+    return user
+
+
+def revoke(user):
+    """
+    Invalidate every token issued to `user` so far
+    """
+    User.objects.filter(pk=user.pk).update(token_epoch=F('token_epoch') + 1)
+    key = epoch_key(user.pk)
+    # Dropped rather than set, so concurrent revocations cannot leave an
+    # older epoch behind; dropped again after commit for requests that
+    # re-read the old one meanwhile
+    get_cache().delete(key)
+    transaction.on_commit(lambda: get_cache().delete(key))
+    users.discard(user.pk)
+
+
+def check(claims, user, epoch):
+    """
+    Return `user` if the token `claims` still hold for them
+    """
+    if user is None or epoch is None or not user.is_active:
+        raise exceptions.AuthenticationFailed('User inactive or deleted.')
+    if claims['v'] != epoch:
+        raise exceptions.AuthenticationFailed('Token has been revoked.')
+    if claims['r'] != user.role:
+        raise exceptions.AuthenticationFailed('Token role is outdated.')
+    return user
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """
+    Authenticate requests carrying a signed bearer token
+    """
+    keyword = 'Bearer'
+
+    def get_token(self, request):
+        """
+        Return the token of the Authorization header, or None if there is none
+        """
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        try:
+            return auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+
+    def authenticate(self, request):
+        token = self.get_token(request)
+        if token is None:
+            return None
+        claims = read(token)
+        user = check(claims, get_user(claims['u']), get_epoch(claims['u']))
+        return user, token
+
+    def authenticate_header(self, request):
+        return self.keyword
@@ -8,6 +8,7 @@ router = routers.DefaultRouter()
 router.register(r'users', views.UserViewSet)
 router.register(r'conversations', views.ConversationViewSet, basename='conversation')
 router.register(r'messages', views.MessageViewSet, basename='message')
+router.register(r'tokens', views.TokenViewSet, basename='token')
 
 # Create nested router for conversation messages
 conversations_router = nested_routers.NestedDefaultRouter(router, r'conversations', lookup='conversation')
@@ -0,0 +1,140 @@
+"""
+Version stamps backing conditional GETs of the conversation and message lists
+
+Every conversation and every user has a version in the cache alias named
+by CHATS_VERSION_CACHE. Message writes bump the conversation and all of
+its participants. Membership changes bump the conversation and the
+users who joined or left. A list response's ETag is derived from the
+versions it depends on, so checking If-None-Match costs one cache
+round trip and no SQL.
+
+A version is the time in nanoseconds of the last bump. A missing one,
+for example after eviction, is reseeded with the current time, so it
+never repeats a value handed out before. Because versions are times,
+they can also be compared with the replication position to tell whether
+a read replica holds a change.
+
+A bump is only seen by processes sharing the cache, and a process that
+missed one would answer 304 for a stale list until the version changed
+again. The local-memory backend is therefore only accepted with DEBUG,
+where a single process serves requests; otherwise the app refuses to
+start (see chats.checks).
+"""
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+
+from .models import ConversationParticipant
+from .routers import use_primary
+
+CONVERSATION_PREFIX = 'chats:version:conversation:'
+USER_PREFIX = 'chats:version:user:'
+
+
+def get_cache_alias():
+    return getattr(settings, 'CHATS_VERSION_CACHE', 'default')
+
+
+def get_cache():
+    return caches[get_cache_alias()]
+
+
+def conversation_key(conversation_id):
+    return f'{CONVERSATION_PREFIX}{conversation_id}'
+
+
+def user_key(user_id):
+    return f'{USER_PREFIX}{user_id}'
+
+
+def get_versions(keys):
+    """
+    Return the current value of each version in `keys`, seeding missing ones
+    """
+    cache = get_cache()
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # add() keeps a concurrently seeded or bumped value
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def _stamp(keys):
+    get_cache().set_many(dict.fromkeys(keys, time.time_ns()), timeout=None)
+
+
+def bump(conversation_ids=(), user_ids=()):
+    """
+    Bump conversations with all of their participants, plus `user_ids`, now
+    and after commit
+
+    Bumping again on commit means a request that read the old rows while
+    the transaction was still open cannot keep serving them under a
+    matching ETag.
+    """
+    conversation_ids = {str(pk) for pk in conversation_ids}
+    user_ids = {str(pk) for pk in user_ids}
+    if conversation_ids:
+        # A lagging replica could miss a new participant
+        with use_primary():
+            user_ids.update(str(pk) for pk in ConversationParticipant.objects.filter(
+                conversation_id__in=conversation_ids
+            ).values_list('user_id', flat=True))
+    keys = (
+        [conversation_key(pk) for pk in conversation_ids] +
+        [user_key(pk) for pk in user_ids]
+    )
+    if not keys:
+        return
+    _stamp(keys)
+    transaction.on_commit(lambda: _stamp(keys))
+
+
+def list_etag(request, conversation_id=None):
+    """
+    Return the ETag of a list response for the requesting user and the
+    version it was derived from
+
+    Without `conversation_id` the list depends on everything the user can
+    see, which the user's version covers. A conversation's message list
+    only depends on that conversation's version. The full path and the
+    negotiated media type are included so that each URL and format has
+    its own tag.
+    """
+    if conversation_id is None:
+        key = user_key(request.user.pk)
+    else:
+        try:
+            conversation_id = uuid.UUID(str(conversation_id))
+        except ValueError:
+            # No such conversation; the list is empty and stays empty
+            pass
+        key = conversation_key(conversation_id)
+    version, = get_versions([key])
+    source = '|'.join([
+        str(request.user.pk), key, str(version), request.get_full_path(),
+        getattr(request, 'accepted_media_type', ''),
+    ])
+    etag = quote_etag(hashlib.md5(source.encode(), usedforsecurity=False).hexdigest())
+    return etag, version
+
+
+def is_not_modified(request, etag):
+    """
+    Return whether the request's If-None-Match matches `etag`
+    """
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = parse_etags(header)
+    # Weak comparison, as proxies compressing the body weaken the tag
+    return tags == ['*'] or any(
+        tag.removeprefix('W/') == etag for tag in tags
+    )
@@ -1,19 +1,78 @@
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from django.contrib.auth import authenticate
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.db import transaction
+from django.db.models import F, Max, Min, Q
+from django.utils import timezone
+from datetime import timedelta
+from functools import partial
+import time
+import uuid
 
-from .models import User, Conversation, Message
+from .models import (
+    User,
+    Conversation,
+    ConversationParticipant,
+    Message,
+    read_before
+)
+from .pagination import (
+    MessageCursorPagination,
+    encode_watermark,
+    decode_watermark
+)
+from .pubsub import get_backend, conversation_channel, user_channel
+from .realtime import (
+    message_event, publish_events, publish_message, publish_membership
+)
+from .row_serializers import RowSerializer
 from .serializers import (
     UserSerializer, 
     ConversationSerializer, 
     ConversationListSerializer,
-    MessageSerializer
+    MessageSerializer,
+    MessageSearchResultSerializer,
+    BulkMessageSerializer
 )
+from . import archive, directory
+from .export import (
+    FORMATS as EXPORT_FORMATS, aiterate, export_queryset, stream_export
+)
+from .membership import get_conversation_ids, is_participant
+from .search import search_messages
+from . import replication, tasks, tokens, versions
+from .routers import ReplicaStickinessMixin, get_replica, use_primary
+from .timing import ServerTimingMixin
+
+
+def conditional_list(request, render, conversation_id=None):
+    """
+    Answer 304 if the client holds the list's ETag, else `render()` it
+    
+    Either way the response carries the ETag and asks clients to
+    revalidate before reusing it. A list is only rendered from the read
+    replica once replication has passed the version in its ETag;
+    otherwise a stale body could be cached under the new tag.
+    """
+    etag, version = versions.list_etag(request, conversation_id)
+    if versions.is_not_modified(request, etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    elif get_replica() is not None and not replication.is_replicated(version):
+        with use_primary():
+            response = render()
+    else:
+        response = render()
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(ServerTimingMixin, ReplicaStickinessMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing users
     """
@@ -24,8 +83,40 @@ class UserViewSet(viewsets.ModelViewSet):
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['first_name', 'last_name', 'email']
     ordering_fields = ['first_name', 'last_name', 'created_at']
+    directory_default_limit = 10
+    directory_max_limit = 50
+    # SQL statements allowed per request, session authentication included;
+    # search samples each query word and may probe its typo corrections
+    query_budgets = {
+        'list': 4, 'retrieve': 3,
+        'search': 6 + 2 * directory.MAX_QUERY_WORDS,
+    }
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Ranked prefix search over user names and emails, for autocomplete
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response(
+                {'error': 'q parameter is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            limit = int(request.query_params.get('limit', self.directory_default_limit))
+        except ValueError:
+            return Response(
+                {'error': 'Invalid limit'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = max(1, min(limit, self.directory_max_limit))
+        
+        results = directory.search_users(query, limit)
+        serializer = self.get_serializer(results, many=True)
+        return Response({'results': serializer.data})
 
-class ConversationViewSet(viewsets.ModelViewSet):
+class ConversationViewSet(ServerTimingMixin, ReplicaStickinessMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing conversations
     """
@@ -33,16 +124,29 @@ class ConversationViewSet(viewsets.ModelViewSet):
     lookup_field = 'conversation_id'
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['title']
-    ordering_fields = ['created_at', 'updated_at']
-    ordering = ['-updated_at']
+    ordering_fields = ['created_at', 'last_activity_at']
+    ordering = ['-last_activity_at']
+    # SQL statements allowed per request, session authentication included
+    query_budgets = {
+        'list': 6, 'retrieve': 8, 'create': 10, 'add_participant': 8,
+        'mark_read': 5,
+    }
     
     def get_queryset(self):
         """
         Filter conversations to only show those the user participates in
         """
-        return Conversation.objects.filter(
-            participants=self.request.user
-        ).prefetch_related('participants', 'messages')
+        queryset = Conversation.objects.filter(
+            conversationparticipant__user=self.request.user
+        )
+        if self.action == 'list':
+            # Summaries and unread counts are denormalized; never load or
+            # count whole histories. The annotation reuses the membership join.
+            return queryset.with_last_message().prefetch_related(
+                'participants'
+            ).annotate(unread_count=F('conversationparticipant__unread_count'))
+        # ConversationSerializer fetches its bounded message window itself
+        return queryset.prefetch_related('participants')
     
     def get_serializer_class(self):
         """
@@ -52,6 +156,15 @@ class ConversationViewSet(viewsets.ModelViewSet):
             return ConversationListSerializer
         return ConversationSerializer
     
+    def list(self, request, *args, **kwargs):
+        """
+        List the user's conversations, or answer 304 if none of them changed
+        """
+        return conditional_list(
+            request,
+            lambda: super(ConversationViewSet, self).list(request, *args, **kwargs)
+        )
+    
     def create(self, request):
         """
         Create a new conversation
@@ -65,7 +178,13 @@ class ConversationViewSet(viewsets.ModelViewSet):
                 serializer.validated_data['participant_ids'] = participant_ids
             
             conversation = serializer.save()
-            response_serializer = ConversationSerializer(conversation)
+            for user_id in participant_ids:
+                transaction.on_commit(
+                    partial(publish_membership, user_id, conversation.conversation_id)
+                )
+            response_serializer = ConversationSerializer(
+                conversation, context=self.get_serializer_context()
+            )
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
@@ -86,6 +205,9 @@ class ConversationViewSet(viewsets.ModelViewSet):
         try:
             user = User.objects.get(user_id=user_id)
             conversation.participants.add(user)
+            transaction.on_commit(
+                partial(publish_membership, user.user_id, conversation.conversation_id)
+            )
             return Response(
                 {'message': f'User {user.first_name} {user.last_name} added to conversation'},
                 status=status.HTTP_200_OK
@@ -96,17 +218,84 @@ class ConversationViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
 
-class MessageViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=['post'])
+    def mark_read(self, request, conversation_id=None):
+        """
+        Move the user's read watermark up to a message, the newest one unless
+        message_id is given, and return the user's read state
+        """
+        if not is_participant(request.user, conversation_id):
+            return Response(
+                {'error': 'Conversation not found or you are not a participant'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        conversation_id = uuid.UUID(str(conversation_id))
+        
+        message_id = request.data.get('message_id')
+        if message_id:
+            try:
+                message_id = uuid.UUID(str(message_id))
+            except ValueError:
+                return Response(
+                    {'error': 'Invalid message_id'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            read_up_to = Message.objects.filter(
+                conversation_id=conversation_id, pk=message_id
+            ).values_list('sent_at', 'message_id').first()
+            if read_up_to is None:
+                return Response(
+                    {'error': 'Message not found in this conversation'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+        else:
+            read_up_to = Conversation.objects.filter(
+                pk=conversation_id, last_message__isnull=False
+            ).values_list('last_message__sent_at', 'last_message_id').first()
+        
+        membership = ConversationParticipant.objects.filter(
+            conversation_id=conversation_id, user=request.user
+        )
+        with use_primary(), transaction.atomic():
+            if read_up_to is not None and membership.mark_read(*read_up_to):
+                # The unread count is part of the user's conversation list
+                versions.bump(user_ids=[request.user.pk])
+            state = membership.values(
+                'last_read_at', 'last_read_message_id', 'unread_count'
+            ).get()
+        return Response(
+            {'conversation_id': conversation_id, **state},
+            status=status.HTTP_200_OK
+        )
+
+class MessageViewSet(ServerTimingMixin, ReplicaStickinessMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing messages with nested routing support
     """
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageCursorPagination
     lookup_field = 'message_id'
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['content']
-    ordering_fields = ['sent_at']
-    ordering = ['sent_at']
+    # Ordering is owned by the keyset paginator: (sent_at, message_id);
+    # text search goes through the full-text index of the search action
+    filter_backends = []
+    bulk_max_messages = 10000
+    bulk_chunk_size = 1000
+    sync_default_limit = 100
+    sync_max_limit = 500
+    sync_max_wait = 30
+    sync_poll_interval = 1.0
+    search_default_limit = 20
+    search_max_limit = 100
+    export_chunk_size = 2000
+    # Read path building list output straight from values_list() rows
+    row_serializer = RowSerializer(MessageSerializer)
+    # SQL statements allowed per request, session authentication included;
+    # bulk and export scale with their input
+    query_budgets = {
+        'list': 6, 'retrieve': 4, 'create': 6, 'by_conversation': 6,
+        'search': 4, 'changes': 6,
+    }
     
     def get_queryset(self):
         """
@@ -118,24 +307,15 @@ class MessageViewSet(viewsets.ModelViewSet):
         
         if conversation_pk:
             # Nested route: /conversations/{id}/messages/
-            try:
-                conversation = Conversation.objects.get(
-                    conversation_id=conversation_pk,
-                    participants=self.request.user
-                )
-                return Message.objects.filter(
-                    conversation=conversation
-                ).select_related('sender', 'conversation').order_by('sent_at')
-            except Conversation.DoesNotExist:
+            if not is_participant(self.request.user, conversation_pk):
                 return Message.objects.none()
+            return Message.objects.filter(
+                conversation_id=conversation_pk
+            ).select_related('sender', 'conversation').order_by('sent_at')
         else:
             # Top-level route: /messages/
-            user_conversations = Conversation.objects.filter(
-                participants=self.request.user
-            ).values_list('conversation_id', flat=True)
-            
             return Message.objects.filter(
-                conversation_id__in=user_conversations
+                conversation_id__in=get_conversation_ids(self.request.user)
             ).select_related('sender', 'conversation')
     
     def create(self, request, *args, **kwargs):
@@ -147,47 +327,82 @@ class MessageViewSet(viewsets.ModelViewSet):
         
         if conversation_pk:
             # For nested routes, automatically set the conversation
-            try:
-                conversation = Conversation.objects.get(
-                    conversation_id=conversation_pk,
-                    participants=request.user
-                )
-                # Add conversation to request data
-                data = request.data.copy()
-                data['conversation'] = conversation.conversation_id
-                serializer = self.get_serializer(data=data)
-            except Conversation.DoesNotExist:
+            if not is_participant(request.user, conversation_pk):
                 return Response(
                     {'error': 'Conversation not found or you are not a participant'},
                     status=status.HTTP_403_FORBIDDEN
                 )
+            # Add conversation to request data
+            data = request.data.copy()
+            data['conversation'] = conversation_pk
+            serializer = self.get_serializer(data=data)
         else:
             serializer = self.get_serializer(data=request.data)
         
         if serializer.is_valid():
-            if conversation_pk:
-                # For nested routes, we already verified the conversation
-                message = serializer.save(sender=request.user, conversation=conversation)
-            else:
-                # For top-level routes, verify conversation access
-                conversation_id = serializer.validated_data['conversation'].conversation_id
-                try:
-                    conversation = Conversation.objects.get(
-                        conversation_id=conversation_id,
-                        participants=request.user
-                    )
-                    message = serializer.save(sender=request.user)
-                except Conversation.DoesNotExist:
-                    return Response(
-                        {'error': 'Conversation not found or you are not a participant'},
-                        status=status.HTTP_403_FORBIDDEN
-                    )
+            # For top-level routes, verify conversation access
+            conversation_id = serializer.validated_data['conversation'].conversation_id
+            if not is_participant(request.user, conversation_id):
+                return Response(
+                    {'error': 'Conversation not found or you are not a participant'},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            message = serializer.save(sender=request.user)
             
+            # Push to WebSocket subscribers once the message is durable
+            transaction.on_commit(partial(publish_message, message))
             response_serializer = MessageSerializer(message)
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    def list(self, request, *args, **kwargs):
+        """
+        List messages a page at a time without building model instances
+        
+        Answers 304 if the client's ETag shows the messages did not change.
+        Membership changes bump the conversation's version, so the tag of
+        a user who was not a participant goes stale once they join.
+        """
+        return conditional_list(
+            request, self.render_message_page,
+            self.kwargs.get('conversation_conversation_id')
+        )
+    
+    def get_archived_rows(self, cursor, limit):
+        """
+        Return archived rows of the nested route's conversation past `cursor`
+        
+        Called by the paginator so pages cross the hot/cold boundary.
+        """
+        conversation_pk = self.kwargs.get('conversation_conversation_id')
+        if not (archive.is_enabled() and conversation_pk and
+                is_participant(self.request.user, conversation_pk)):
+            return []
+        return [
+            self.row_serializer.row_from_instance(message)
+            for message in archive.read_messages(conversation_pk, cursor, limit)
+        ]
+    
+    def with_archived_rows(self, conversation_id, rows, checkpoint=None):
+        """
+        Prepend the archived history of a conversation to ordered hot `rows`
+        """
+        if not archive.is_enabled():
+            return rows
+        return archive.merge(
+            map(self.row_serializer.row_from_instance,
+                archive.iter_messages(conversation_id, checkpoint)),
+            rows
+        )
+    
+    def render_message_page(self):
+        queryset = self.row_serializer.values_list(
+            self.filter_queryset(self.get_queryset())
+        )
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.row_serializer.serialize(page))
+    
     @action(detail=False, methods=['get'])
     def by_conversation(self, request):
         """
@@ -202,20 +417,392 @@ class MessageViewSet(viewsets.ModelViewSet):
             )
         
         # Verify the user is a participant in the conversation
-        try:
-            conversation = Conversation.objects.get(
-                conversation_id=conversation_id,
-                participants=request.user
+        if not is_participant(request.user, conversation_id):
+            return Response(
+                {'error': 'Conversation not found or you are not a participant'},
+                status=status.HTTP_403_FORBIDDEN
             )
-        except Conversation.DoesNotExist:
+        
+        messages = self.row_serializer.values_list(
+            Message.objects.filter(conversation_id=conversation_id)
+        ).order_by('sent_at', 'message_id')
+        
+        return Response(self.row_serializer.serialize(
+            self.with_archived_rows(conversation_id, messages.iterator())
+        ))
+    
+    @action(detail=False, methods=['get'])
+    def export(self, request, conversation_conversation_id=None):
+        """
+        Stream the whole history of a conversation as JSON Lines or a JSON array
+        
+        `output` selects `jsonl` (default) or `json`. Pass the `sent_at`
+        and `message_id` of the last record received to resume an
+        interrupted export right after it.
+        """
+        if not conversation_conversation_id:
+            return Response(
+                {'error': 'Export requires /conversations/{id}/messages/export/'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not is_participant(request.user, conversation_conversation_id):
             return Response(
                 {'error': 'Conversation not found or you are not a participant'},
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        messages = Message.objects.filter(
-            conversation=conversation
-        ).order_by('sent_at')
+        output = request.query_params.get('output', 'jsonl')
+        if output not in EXPORT_FORMATS:
+            return Response(
+                {'error': f'output must be one of {", ".join(EXPORT_FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
+        checkpoint = None
+        if 'sent_at' in request.query_params or 'message_id' in request.query_params:
+            try:
+                sent_at = parse_datetime(request.query_params.get('sent_at', ''))
+                message_id = uuid.UUID(request.query_params.get('message_id', ''))
+            except ValueError:
+                sent_at = None
+            if sent_at is None:
+                return Response(
+                    {'error': 'A checkpoint needs a valid sent_at and message_id'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            checkpoint = (sent_at, message_id)
+        
+        rows = self.row_serializer.values_list(export_queryset(
+            Message.objects.filter(conversation_id=conversation_conversation_id),
+            checkpoint
+        )).iterator(chunk_size=self.export_chunk_size)
+        rows = self.with_archived_rows(conversation_conversation_id, rows, checkpoint)
+        content = stream_export(rows, self.row_serializer, output, self.export_chunk_size)
+        if isinstance(request._request, ASGIRequest):
+            content = aiterate(content)
+        response = StreamingHttpResponse(content, content_type=EXPORT_FORMATS[output])
+        response['Content-Disposition'] = (
+            f'attachment; filename="conversation-{conversation_conversation_id}.{output}"'
+        )
+        return response
+    
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, conversation_conversation_id=None):
+        """
+        Create many messages in a conversation in a single transaction
+        """
+        if not conversation_conversation_id:
+            return Response(
+                {'error': 'Bulk creation requires /conversations/{id}/messages/bulk/'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        items = request.data
+        if not isinstance(items, list) or not items:
+            return Response(
+                {'error': 'Expected a non-empty list of messages'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > self.bulk_max_messages:
+            return Response(
+                {'error': f'At most {self.bulk_max_messages} messages per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # One membership check for the whole batch
+        if not is_participant(request.user, conversation_conversation_id):
+            return Response(
+                {'error': 'Conversation not found or you are not a participant'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        conversation_id = uuid.UUID(str(conversation_conversation_id))
+        
+        # Messages without sent_at keep their submitted order, all at or
+        # before now
+        now = timezone.now() - timedelta(microseconds=len(items))
+        message_ids = []
+        # Rendered chunk by chunk, pushed to sockets once committed
+        events = []
+        latest = oldest = None
+        with transaction.atomic():
+            # Validate and insert chunk by chunk so only one chunk of model
+            # instances is alive at a time
+            for start in range(0, len(items), self.bulk_chunk_size):
+                serializer = BulkMessageSerializer(
+                    data=items[start:start + self.bulk_chunk_size], many=True
+                )
+                if not serializer.is_valid():
+                    transaction.set_rollback(True)
+                    errors = {
+                        start + index: error
+                        for index, error in enumerate(serializer.errors) if error
+                    }
+                    return Response(
+                        {'errors': errors}, status=status.HTTP_400_BAD_REQUEST
+                    )
+                
+                messages = [
+                    Message(
+                        sender=request.user,
+                        conversation_id=conversation_id,
+                        message_body=data['message_body'],
+                        sent_at=data.get(
+                            'sent_at', now + timedelta(microseconds=start + index)
+                        ),
+                    )
+                    for index, data in enumerate(serializer.validated_data)
+                ]
+                Message.objects.bulk_create(messages)
+                message_ids.extend(message.message_id for message in messages)
+                events.extend(map(message_event, self.row_serializer.iterate(
+                    map(self.row_serializer.row_from_instance, messages)
+                )))
+                # bulk_create sends no post_save, so enqueue side effects here
+                tasks.enqueue_messages([message.message_id for message in messages])
+                
+                newest = max(messages, key=lambda m: (m.sent_at, m.message_id))
+                if latest is None or (newest.sent_at, newest.message_id) > (
+                        latest.sent_at, latest.message_id):
+                    latest = newest
+                first = min(messages, key=lambda m: (m.sent_at, m.message_id))
+                if oldest is None or (first.sent_at, first.message_id) < (
+                        oldest.sent_at, oldest.message_id):
+                    oldest = first
+            
+            # bulk_create bypasses Message.save(), so record the batch here
+            Conversation.objects.filter(
+                pk=conversation_id
+            ).record_message(latest, count=len(message_ids))
+            others = ConversationParticipant.objects.filter(
+                conversation_id=conversation_id
+            ).exclude(user=request.user)
+            others.filter(
+                read_before(oldest.sent_at, oldest.message_id)
+            ).add_unread(len(message_ids))
+            # Backdated messages may land behind a watermark: recount those
+            others.exclude(
+                read_before(oldest.sent_at, oldest.message_id)
+            ).refresh_unread_counts()
+            versions.bump(conversation_ids=[conversation_id])
+            transaction.on_commit(partial(publish_events, conversation_id, events))
+        
+        return Response(
+            {
+                'conversation_id': conversation_id,
+                'message_ids': message_ids,
+            },
+            status=status.HTTP_201_CREATED
+        )
+
+    
+    def get_sync_messages(self, user, sequence, limit):
+        """
+        Return a queryset of up to `limit` + 1 messages committed after
+        `sequence` in the user's conversations
+
+        The membership join starts from the (user, conversation) index and
+        each conversation is read through its (conversation, sequence)
+        index from the watermark onwards.
+        """
+        return Message.objects.filter(
+            conversation__participants=user, sequence__gt=sequence
+        ).select_related('sender').order_by('sequence')[:limit + 1]
+    
+    def get_sync_position(self, since):
+        """
+        Return the sequence a decoded watermark resumes after
+        
+        Watermarks issued before sequences existed hold a (sent_at,
+        message_id) cursor; they resume before the first message past it.
+        Without a watermark, sync starts after the last committed message.
+        """
+        if isinstance(since, int):
+            return since
+        if since is not None:
+            first = Message.objects.filter(
+                MessageCursorPagination.get_boundary_filter(since)
+            ).aggregate(first=Min('sequence'))['first']
+            if first is not None:
+                return first - 1
+        return Message.objects.aggregate(last=Max('sequence'))['last'] or 0
+    
+    def get_sync_channels(self, user, conversation_ids):
+        channels = [user_channel(user.user_id)]
+        channels += [conversation_channel(pk) for pk in conversation_ids]
+        return channels
+    
+    def wait_for_sync_messages(self, user, sequence, limit, wait):
+        """
+        Block until messages arrive after `sequence` or `wait` seconds pass
+
+        Commits wake the request through the pub/sub backend; the periodic
+        re-check also covers backends that cannot notify this thread.
+        """
+        channels = self.get_sync_channels(user, get_conversation_ids(user))
+        deadline = time.monotonic() + wait
+        subscription = get_backend().subscribe_thread(channels)
+        try:
+            # Re-check after subscribing so a commit in between is not missed
+            messages = list(self.get_sync_messages(user, sequence, limit))
+            while not messages:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                subscription.wait(min(remaining, self.sync_poll_interval))
+                messages = list(self.get_sync_messages(user, sequence, limit))
+            return messages
+        finally:
+            subscription.close()
+    
+    def parse_sync_request(self, request, conversation_conversation_id):
+        """
+        Return the limit, wait and decoded watermark of a sync request, or
+        an error response
+        """
+        if conversation_conversation_id:
+            return Response(
+                {'error': 'Sync covers all conversations; use /messages/sync/'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            limit = int(request.query_params.get('limit', self.sync_default_limit))
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            return Response(
+                {'error': 'limit and wait must be numbers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = max(1, min(limit, self.sync_max_limit))
+        wait = max(0, min(wait, self.sync_max_wait))
+        
+        since = request.query_params.get('since') or None
+        if since is not None:
+            try:
+                since = decode_watermark(request.user, since)
+            except ValueError:
+                return Response(
+                    {'error': 'Invalid watermark'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        return limit, wait, since
+    
+    def sync_response(self, user, messages, limit, sequence):
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if messages:
+            sequence = messages[-1].sequence
         serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response({
+            'results': serializer.data,
+            'watermark': encode_watermark(user, sequence),
+            'has_more': has_more,
+        })
+    
+    @action(detail=False, methods=['get'], url_path='sync', url_name='sync')
+    def changes(self, request, conversation_conversation_id=None):
+        """
+        Return messages committed in the user's conversations since a watermark
+        
+        Pass the `watermark` of the previous response as `since`; a call
+        without `since` only establishes a watermark. With `wait=<seconds>`
+        the request is held until new messages arrive or the wait expires.
+        Watermarks follow commit order, so a message committed late, or
+        backdated, is returned by the next call rather than skipped.
+        """
+        parsed = self.parse_sync_request(request, conversation_conversation_id)
+        if isinstance(parsed, Response):
+            return parsed
+        limit, wait, since = parsed
+        
+        # Commit notifications wake long polls before a replica could
+        # have the new rows, so sync always reads the primary
+        with use_primary():
+            sequence = self.get_sync_position(since)
+            if since is None:
+                return self.sync_response(request.user, [], limit, sequence)
+            messages = list(self.get_sync_messages(request.user, sequence, limit))
+            if not messages and wait:
+                messages = self.wait_for_sync_messages(
+                    request.user, sequence, limit, wait
+                )
+        return self.sync_response(request.user, messages, limit, sequence)
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request, conversation_conversation_id=None):
+        """
+        Ranked full-text search over the messages of the user's conversations
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response(
+                {'error': 'q parameter is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        conversation_id = (
+            conversation_conversation_id or
+            request.query_params.get('conversation_id')
+        )
+        try:
+            if conversation_id:
+                conversation_id = uuid.UUID(str(conversation_id))
+            limit = int(request.query_params.get('limit', self.search_default_limit))
+        except ValueError:
+            return Response(
+                {'error': 'Invalid conversation_id or limit'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = max(1, min(limit, self.search_max_limit))
+        
+        # Membership is enforced inside the search query itself
+        results = search_messages(request.user, query, conversation_id, limit)
+        serializer = MessageSearchResultSerializer(results, many=True)
+        return Response({'results': serializer.data})
+
+class TokenViewSet(ServerTimingMixin, ReplicaStickinessMixin, viewsets.ViewSet):
+    """
+    ViewSet issuing and revoking signed bearer tokens
+    """
+    # SQL statements allowed per request, session authentication included
+    query_budgets = {'create': 2, 'revoke': 4}
+    
+    def get_permissions(self):
+        if self.action == 'create':
+            return [AllowAny()]
+        return [IsAuthenticated()]
+    
+    def create(self, request):
+        """
+        Trade an email and password for a token
+        """
+        email = request.data.get('email')
+        password = request.data.get('password')
+        if not email or not password:
+            return Response(
+                {'error': 'email and password are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        user = authenticate(request, email=email, password=password)
+        if user is None:
+            return Response(
+                {'error': 'Invalid email or password'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        token, expires_at = tokens.issue(user)
+        return Response(
+            {'token': token, 'expires_at': expires_at},
+            status=status.HTTP_200_OK
+        )
+    
+    @action(detail=False, methods=['post'])
+    def revoke(self, request):
+        """
+        Revoke every token issued to the user, logging out all their clients
+        """
+        tokens.revoke(request.user)
+        return Response(
+            {'message': 'All tokens revoked'},
+            status=status.HTTP_200_OK
+        )
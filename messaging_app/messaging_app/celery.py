@@ -0,0 +1,16 @@
+"""
+Celery application running the background tasks of the chats app
+
+Configuration comes from the CELERY_* Django settings. Start a worker with:
+
+    celery -A messaging_app worker
+"""
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'messaging_app.settings')
+
+app = Celery('messaging_app')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
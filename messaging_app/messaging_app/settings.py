@@ -25,6 +25,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chats.timing.ServerTimingMiddleware',
+    'chats.querybudget.QueryBudgetMiddleware',
+    'chats.routers.ReplicaStickinessMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -60,7 +63,51 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    # Read replica of default, kept in sync locally by `manage.py replicate`
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.replica.sqlite3',
+    },
+}
+DATABASE_ROUTERS = ['chats.routers.PrimaryReplicaRouter']
+
+# SQLite tuning applied to every new connection; None keeps SQLite's defaults.
+# Opt in with CHATS_SQLITE_TUNING=1: WAL mode is persistent, so the first
+# tuned connection converts the database file for every later user of it.
+CHATS_SQLITE = {
+    'JOURNAL_MODE': 'WAL',
+    'SYNCHRONOUS': 'NORMAL',
+    'BUSY_TIMEOUT': 5000,
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    'CACHE_SIZE': -64 * 1024,
+    'TEMP_STORE': 'MEMORY',
+    'TRANSACTION_MODE': 'IMMEDIATE',
+    'OPTIMIZE_INTERVAL': 3600,
+} if os.environ.get('CHATS_SQLITE_TUNING') else None
+
+# Alias chats reads are sent to; None reads everything from default
+CHATS_READ_REPLICA = None
+# How long a user reads from the primary after writing
+CHATS_REPLICA_STICKY_SECONDS = 5
+
+# SQL query budgets of the chats actions: checked and logged on a sample
+# of requests, and enforced by the test runner
+CHATS_QUERY_BUDGETS = {
+    'ENFORCE': False,
+    'SAMPLE_RATE': 0.01,
+}
+TEST_RUNNER = 'chats.runner.QueryBudgetTestRunner'
+
+# Timing breakdown logged for every request and sent as a Server-Timing
+# header while DEBUG only, and cProfile captures of a sample of requests or
+# of those sending PROFILE_HEADER with PROFILE_TOKEN
+CHATS_SERVER_TIMING = {
+    'ENABLED': DEBUG,
+    'PROFILE_DIRECTORY': BASE_DIR / 'profiles',
+    'PROFILE_SAMPLE_RATE': 0,
+    'PROFILE_HEADER': 'X-Chats-Profile',
+    'PROFILE_TOKEN': os.environ.get('CHATS_PROFILE_TOKEN'),
 }
 
 # Password validation
@@ -95,6 +142,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
+        'chats.tokens.SignedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -103,6 +151,89 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 20
 }
 
+# Caches; the membership cache backs conversation authorization checks.
+# The membership and versions caches must be shared by all processes:
+# local memory is only accepted with DEBUG, e.g. for runserver.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'membership': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chats-membership',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    'versions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chats-versions',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+# Several worker processes need CHATS_REDIS_URL, which moves the caches
+# that must be shared onto Redis: membership, versions, and default with
+# its token revocation epochs
+if os.environ.get('CHATS_REDIS_URL'):
+    for alias in ['default', 'membership', 'versions']:
+        CACHES[alias] = {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['CHATS_REDIS_URL'],
+            'TIMEOUT': CACHES[alias].get('TIMEOUT', 300),
+        }
+CHATS_MEMBERSHIP_CACHE = 'membership'
+CHATS_VERSION_CACHE = 'versions'
+
+# Real-time fan-out backend; use chats.pubsub.RedisBackend across processes
+CHATS_PUBSUB = {
+    'BACKEND': 'chats.pubsub.InMemoryBackend',
+    'OPTIONS': {
+        'max_queue': 1000,
+    },
+}
+
+# Cold storage of old messages; archival and archive reads are off while
+# DIRECTORY is None
+CHATS_ARCHIVE = {
+    'DIRECTORY': None,
+    'AGE_DAYS': 365,
+    'BLOCK_SIZE': 1000,
+}
+
+# Celery runs the side effects of new messages off the request path.
+# Without a broker configured, tasks run in-process as they are enqueued.
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'memory://')
+CELERY_TASK_ALWAYS_EAGER = 'CELERY_BROKER_URL' not in os.environ
+CELERY_TASK_IGNORE_RESULT = True
+
+# Functions called on a worker with each batch of newly created messages
+CHATS_MESSAGE_SIDE_EFFECTS = [
+    'chats.notifications.queue_notifications',
+]
+
+# Notifications of new messages are sent to each recipient at most once
+# per WINDOW seconds
+CHATS_NOTIFICATIONS = {
+    'BACKEND': 'chats.notifications.LoggingBackend',
+    'WINDOW': 10,
+    'CACHE': 'default',
+}
+
+# Signed bearer tokens; authenticating with one runs no SQL for users seen
+# in the last USER_CACHE_TTL seconds. Revocation epochs live in CACHE,
+# which must be shared by all processes serving requests: local memory
+# is only accepted with DEBUG.
+CHATS_TOKENS = {
+    'LIFETIME': 3600,
+    'USER_CACHE_SIZE': 10000,
+    'USER_CACHE_TTL': 60,
+    'CACHE': 'default',
+}
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",